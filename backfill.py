@@ -0,0 +1,52 @@
+"""
+Backfill comment content hashes, the comment search index and word counts.
+
+Hashes are used for comment deduplication, and are set in bulk.
+"""
+import argparse
+from database import (get_db, hash_comments, rebuild_comment_search,
+                      rebuild_word_counts, transaction)
+from logger import log
+
+
+def main(db_path, rehash_all, search_index, word_counts):
+    """
+    Hash comments, then rebuild the search index and word counts if asked to.
+
+    Only comments without a content hash are hashed, unless `rehash_all` is
+    set. Duplicates removed by hashing are taken off the word counts, so they
+    don't need rebuilding after.
+    """
+    con, cur = get_db(db_path)
+    with transaction(con):
+        n_hashed = hash_comments(cur, only_missing=not rehash_all,
+                                 word_counts=not word_counts)
+    log.info('Hashed %d comments', n_hashed)
+
+    if search_index:
+        rebuild_comment_search(cur)
+        con.commit()
+        log.info('Rebuilt the comment search index')
+
+    if word_counts:
+        n_counted = rebuild_word_counts(cur)
+        con.commit()
+        log.info('Counted words in %d comments', n_counted)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-path', type=str)
+    parser.add_argument('--all', action=argparse.BooleanOptionalAction,
+                        help='rehash every comment, not just missing hashes')
+    parser.add_argument('--search-index',
+                        action=argparse.BooleanOptionalAction,
+                        help='rebuild the comment search index from every '
+                        'comment')
+    parser.add_argument('--word-counts',
+                        action=argparse.BooleanOptionalAction,
+                        help='recount the words of every comment')
+
+    args = parser.parse_args()
+
+    main(args.db_path, args.all, args.search_index, args.word_counts)
@@ -0,0 +1,357 @@
+"""
+Run a scraping stage over many items in long-lived worker processes.
+
+Each worker imports the scrapers, opens the database and starts its browsers
+once, then pulls work items from a shared queue until it is empty. All writes
+are handed to a single writer process, which commits them in batches.
+
+With `--jobs`, work items are instead claimed from the job table with a
+lease, so runs can be resumed after a crash and shared between machines.
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+from database import DirectWriter, Job, QueueWriter, get_db, run_writer
+from logger import log
+from metrics import add_metrics_arguments, labels, metrics
+import ratelimit
+import scheduler
+import screenshots
+
+STAGES = ['channels', 'videos', 'comments']
+
+
+def read_items(stage, input_file):
+    """Read work items for a stage from a csv of artists or a list of ids."""
+    if stage == 'channels':
+        reader = csv.DictReader(input_file)
+        for row in reader:
+            yield (row['name'], row['spotify_uri'])
+    else:
+        for line in input_file:
+            item_id = line.strip().split(',')[0]
+            if item_id:
+                yield int(item_id)
+
+
+def run_item(stage, cur, writer, item, args):
+    """Run a single work item for a stage, returning False if it failed."""
+    with labels(stage=stage, item=item), metrics.timer('item'):
+        succeeded = save_item(stage, cur, writer, item, args)
+        metrics.count('items_succeeded' if succeeded else 'items_failed')
+    return succeeded
+
+
+def save_item(stage, cur, writer, item, args):
+    """Scrape and save a single work item for a stage."""
+    # scheduled items have already been checked for staleness
+    force = args.force or args.schedule
+    if stage == 'channels':
+        from channels import save_channel
+        artist_name, spotify_uri = item
+        return save_channel(cur, writer, artist_name, spotify_uri,
+                            args.max_retries, args.overwrite)
+    elif stage == 'videos':
+        from videos import save_videos
+        return save_videos(cur, writer, item, args.max_retries, args.backend,
+                           force, args.incremental)
+    elif stage == 'comments':
+        from comments import save_comments
+        return save_comments(cur, writer, item, args.max_comments,
+                             args.max_retries, args.detector, args.backend,
+                             force, args.incremental, args.detect_processes)
+
+
+def configure_screenshots(stage, args):
+    """Save screenshots of channels in the background, if asked to."""
+    if stage == 'videos':
+        screenshots.configure(args.db_path, args.screenshot_path,
+                              args.screenshot_format, args.screenshot_width,
+                              args.screenshot_sample)
+
+
+def worker(stage, args, work_queue, write_queue, metrics_queue):
+    """
+    Process work items from the queue until a None sentinel is received.
+
+    This worker's metrics are then put on the metrics queue.
+    """
+    from pool import close_pool
+
+    metrics.start(args.trace_path)
+    ratelimit.configure(args.db_path)
+    configure_screenshots(stage, args)
+    # reads use this worker's connection, writes go to the single writer
+    con, cur = get_db(args.db_path)
+    writer = QueueWriter(write_queue)
+    log.info('Worker started for %s stage', stage)
+    n_items = 0
+    try:
+        while True:
+            item = work_queue.get()
+            if item is None:
+                break
+            try:
+                run_item(stage, cur, writer, item, args)
+            except Exception as e:
+                log.exception('Error processing %s item %s: %s',
+                              stage, item, e)
+            n_items += 1
+    finally:
+        close_pool()
+        screenshots.close()
+        con.close()
+        metrics_queue.put(metrics.snapshot())
+    log.info('Worker finished after %d %s items', n_items, stage)
+
+
+class Heartbeat(threading.Thread):
+    """Extend the leases on a worker's jobs until it is stopped."""
+
+    def __init__(self, db_path, owner, lease_seconds):
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.job_ids = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def hold(self, job_ids):
+        """Start extending the leases of jobs."""
+        with self.lock:
+            self.job_ids.update(job_ids)
+
+    def release(self, job_id):
+        """Stop extending the lease of a job."""
+        with self.lock:
+            self.job_ids.discard(job_id)
+
+    def run(self):
+        """Extend leases every third of the lease time."""
+        # sqlite connections can't be shared between threads
+        con, cur = get_db(self.db_path)
+        while not self.stopped.wait(self.lease_seconds / 3):
+            with self.lock:
+                job_ids = list(self.job_ids)
+            Job.heartbeat(cur, job_ids, self.owner, self.lease_seconds)
+            con.commit()
+        con.close()
+
+
+def job_worker(stage, args, metrics_queue):
+    """
+    Claim and process jobs until there are none left for the stage.
+
+    This worker's metrics are then put on the metrics queue.
+    """
+    from pool import close_pool
+
+    metrics.start(args.trace_path)
+    ratelimit.configure(args.db_path)
+    configure_screenshots(stage, args)
+    # jobs are completed after their rows are committed, so writes go
+    # straight to this worker's connection rather than a shared writer
+    con, cur = get_db(args.db_path)
+    writer = DirectWriter(con)
+    owner = '%s:%d' % (socket.gethostname(), os.getpid())
+    heartbeat = Heartbeat(args.db_path, owner, args.lease_seconds)
+    heartbeat.start()
+    log.info('Job worker %s started for %s stage', owner, stage)
+    n_items = 0
+    try:
+        while True:
+            jobs = Job.claim(cur, stage, owner, args.claim_size,
+                             args.lease_seconds, args.max_attempts)
+            con.commit()
+            if len(jobs) == 0:
+                counts = Job.count_by_status(cur, stage)
+                if (counts.get(Job.PENDING, 0) == 0
+                        and counts.get(Job.RUNNING, 0) == 0):
+                    break
+                # wait for backed off jobs, or leases held by other workers
+                time.sleep(args.poll_seconds)
+                continue
+
+            heartbeat.hold(job.id for job in jobs)
+            for job in jobs:
+                try:
+                    error = None
+                    if not run_item(stage, cur, writer, job.item, args):
+                        error = 'Scraping failed'
+                except Exception as e:
+                    log.exception('Error processing %s item %s: %s',
+                                  stage, job.item, e)
+                    con.rollback()
+                    error = e
+                if error is None:
+                    Job.complete(cur, job.id, owner)
+                else:
+                    Job.fail(cur, job.id, owner, error, args.max_attempts,
+                             args.backoff_seconds)
+                con.commit()
+                heartbeat.release(job.id)
+                n_items += 1
+    finally:
+        heartbeat.stopped.set()
+        close_pool()
+        screenshots.close()
+        con.close()
+        metrics_queue.put(metrics.snapshot())
+    log.info('Job worker %s finished after %d %s items',
+             owner, n_items, stage)
+
+
+def get_items(args):
+    """Get work items from the scheduler, or from the input file."""
+    if args.schedule:
+        con, _ = get_db(args.db_path)
+        yield from scheduler.schedule(
+            con, args.stage, args.priority, args.max_age_days, args.top_n,
+            args.budget, args.rate)
+        con.close()
+        return
+
+    input_file = (sys.stdin if args.input in [None, '-']
+                  else open(args.input, newline=''))
+    with input_file:
+        yield from read_items(args.stage, input_file)
+
+
+def collect_metrics(metrics_queue, n_processes):
+    """Merge the metrics put on the queue by each of n processes."""
+    # read before joining, as a process can't exit with unread queue items
+    for _ in range(n_processes):
+        metrics.merge(metrics_queue.get())
+
+
+def run_jobs(args):
+    """
+    Enqueue any items from the scheduler or input file, then run jobs.
+
+    Without an input, only jobs already in the job table are run, so other
+    machines can share the work of a run started elsewhere.
+    """
+    if args.schedule or args.input is not None:
+        con, cur = get_db(args.db_path)
+        Job.enqueue_many(cur, args.stage, get_items(args))
+        con.commit()
+        con.close()
+
+    metrics_queue = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=job_worker,
+                                args=(args.stage, args, metrics_queue))
+        for _ in range(args.workers)
+    ]
+    for process in workers:
+        process.start()
+    collect_metrics(metrics_queue, len(workers))
+    for process in workers:
+        process.join()
+
+    con, cur = get_db(args.db_path)
+    log.info('Finished %s jobs: %s', args.stage,
+             Job.count_by_status(cur, args.stage))
+    con.close()
+
+
+def main(args):
+    """Run a stage over all items from the scheduler or input file."""
+    # bounded so a large input is streamed rather than read up front
+    work_queue = multiprocessing.Queue(maxsize=args.workers * 4)
+    write_queue = multiprocessing.Queue()
+    metrics_queue = multiprocessing.Queue()
+
+    writer = multiprocessing.Process(
+        target=run_writer, args=(args.db_path, write_queue),
+        kwargs={'metrics_queue': metrics_queue})
+    writer.start()
+
+    workers = [
+        multiprocessing.Process(target=worker,
+                                args=(args.stage, args, work_queue,
+                                      write_queue, metrics_queue))
+        for _ in range(args.workers)
+    ]
+    for process in workers:
+        process.start()
+
+    n_items = 0
+    for item in get_items(args):
+        work_queue.put(item)
+        n_items += 1
+    for _ in workers:
+        work_queue.put(None)
+
+    collect_metrics(metrics_queue, len(workers))
+    for process in workers:
+        process.join()
+    write_queue.put(None)
+    collect_metrics(metrics_queue, 1)
+    writer.join()
+    log.info('Finished %s stage for %d items with %d workers',
+             args.stage, n_items, args.workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('stage', choices=STAGES)
+    parser.add_argument('--db-path', type=str)
+    parser.add_argument('--input', type=str, default=None,
+                        help='artist csv for channels, or a list of ids. '
+                        'Reads from stdin by default, unless running jobs')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-retries', type=int, default=None,
+                        help='attempts per item within a run, defaults to 3, '
+                        'or 1 when running jobs')
+    parser.add_argument('--overwrite', action=argparse.BooleanOptionalAction)
+    screenshots.add_screenshot_arguments(parser)
+    parser.add_argument('--max-comments', type=int, default=1000)
+    parser.add_argument('--detector', choices=['spacy', 'langdetect'],
+                        default='spacy')
+    parser.add_argument('--detect-processes', type=int, default=1,
+                        help='processes spacy detects the languages of each '
+                        'chunk of comments with')
+    parser.add_argument('--backend', choices=['selenium', 'innertube'],
+                        default='selenium')
+    parser.add_argument('--force', action=argparse.BooleanOptionalAction,
+                        help='scrape items even if they were updated recently')
+    parser.add_argument('--incremental',
+                        action=argparse.BooleanOptionalAction,
+                        help='stop scrolling at videos or comments that are '
+                        'already known')
+    parser.add_argument('--schedule', action=argparse.BooleanOptionalAction,
+                        help='choose stale items with the scheduler, '
+                        'instead of reading them from the input')
+    scheduler.add_schedule_arguments(parser)
+    parser.add_argument('--jobs', action=argparse.BooleanOptionalAction,
+                        help='claim items from the job table with a lease')
+    parser.add_argument('--claim-size', type=int, default=1,
+                        help='jobs claimed by a worker at a time')
+    parser.add_argument('--lease-seconds', type=int, default=600)
+    parser.add_argument('--max-attempts', type=int, default=5,
+                        help='attempts per job, across runs')
+    parser.add_argument('--backoff-seconds', type=int, default=60,
+                        help='delay before the first retry of a failed job')
+    parser.add_argument('--poll-seconds', type=int, default=10)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    if args.schedule and args.stage not in scheduler.STAGES:
+        parser.error('the %s stage can\'t be scheduled' % args.stage)
+    if args.max_retries is None:
+        # jobs are retried with a backoff across runs instead
+        args.max_retries = 1 if args.jobs else 3
+
+    metrics.start()
+    if args.jobs:
+        run_jobs(args)
+    else:
+        main(args)
+    metrics.finish(args.metrics_path)
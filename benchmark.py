@@ -0,0 +1,293 @@
+"""
+Benchmark the scrapers and database writes against a local fake youtube.
+
+Each case is run for a number of sizes, in a fresh process so its peak
+memory can be measured, and reports items per second, p50 and p95 latency
+and peak RSS. Results can be saved as a baseline, and later runs compared
+against it.
+"""
+import argparse
+from collections import namedtuple
+import json
+import math
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from comments import DETECTORS
+import fakeyoutube
+from logger import log
+
+Case = namedtuple('Case', ['run', 'sizes', 'browser'])
+Result = namedtuple('Result', [
+    'case', 'size', 'items', 'items_per_sec', 'p50', 'p95', 'peak_rss_mb'])
+
+# fraction slower than the baseline a case can be before it is a regression
+TOLERANCE = 0.2
+
+
+def timed(func, *args, **kwargs):
+    """Call a function, returning its result and how long it took."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_scrollable(size, context):
+    """Scroll a fake channel page with find_all_in_scrollable."""
+    from common import find_all_in_scrollable
+    from pool import get_pool
+    with get_pool().driver() as driver:
+        driver.get('%s/@fake%d/videos' % (context.base_url, size))
+        records, seconds = timed(
+            find_all_in_scrollable, driver, '#video-title', 10)
+    return len(records), seconds
+
+
+def bench_selenium_videos(size, context):
+    """Scrape a fake channel with the selenium scraper."""
+    import videos
+    found, seconds = timed(videos.find_youtube_videos,
+                           '%s/@fake%d' % (context.base_url, size))
+    return len(found), seconds
+
+
+def bench_selenium_comments(size, context):
+    """Scrape a fake video with the selenium scraper."""
+    import comments
+    found, seconds = timed(comments.find_youtube_comments,
+                           '%s/watch?v=fake%d' % (context.base_url, size),
+                           size)
+    return len(found), seconds
+
+
+def bench_innertube_videos(size, context):
+    """Scrape a fake channel with the innertube scraper."""
+    import innertube
+    session = fakeyoutube.LocalSession(innertube.get_session(),
+                                       context.base_url)
+    found, seconds = timed(innertube.find_youtube_videos,
+                           '%s/@fake%d' % (context.base_url, size),
+                           max_videos=size, session=session)
+    return len(found), seconds
+
+
+def bench_innertube_comments(size, context):
+    """Scrape a fake video with the innertube scraper."""
+    import innertube
+    session = fakeyoutube.LocalSession(innertube.get_session(),
+                                       context.base_url)
+    found, seconds = timed(innertube.find_youtube_comments,
+                           '%s/watch?v=fake%d' % (context.base_url, size),
+                           size, session=session)
+    return len(found), seconds
+
+
+def bench_detect_languages(size, context):
+    """Detect the languages of fake comments."""
+    from comments import detect_languages
+    texts = [fakeyoutube.comment_text(n) for n in range(size)]
+    languages, seconds = timed(detect_languages, texts,
+                               detector=context.detector)
+    return len(languages), seconds
+
+
+def fresh_db(context):
+    """Create an empty database with an artist, in the benchmark directory."""
+    from database import Artist, get_db
+    db_path = os.path.join(context.tmp_dir, 'benchmark-%d.db' % time.time_ns())
+    con, cur = get_db(db_path)
+    Artist.save(cur, 'Fake artist', 'spotify:artist:fake', context.base_url)
+    con.commit()
+    return con, cur
+
+
+def bench_save_videos(size, context):
+    """Save fake videos for an artist and commit them."""
+    from database import Video
+    con, cur = fresh_db(context)
+    rows = [(1, fakeyoutube.video_title(n),
+             'https://www.youtube.com/watch?v=fake%d' % n, n * 7)
+            for n in range(size)]
+
+    def save():
+        Video.save_many(cur, rows)
+        con.commit()
+    _, seconds = timed(save)
+    con.close()
+    return size, seconds
+
+
+def bench_save_comments(size, context):
+    """Deduplicate fake comments for a video, then save and commit them."""
+    from comments import get_rows, remove_duplicates
+    from common import CommentData
+    from database import Comment, Video
+    con, cur = fresh_db(context)
+    Video.save_many(cur, [(1, 'Fake video', 'https://fake', 0)])
+    con.commit()
+    scraped = [CommentData(fakeyoutube.comment_text(n), 'fake-comment-%d' % n,
+                           '@fan%d' % n, n % 100, int(time.time()), n % 5)
+               for n in range(size)]
+
+    def save():
+        comments, hashes = remove_duplicates(
+            scraped, Comment.get_hashes_by_video(cur, 1))
+        languages = ['en'] * len(comments)
+        Comment.save_many(cur, get_rows(1, comments, languages, hashes))
+        con.commit()
+    _, seconds = timed(save)
+    con.close()
+    return size, seconds
+
+
+CASES = {
+    'scrollable': Case(bench_scrollable, [100, 800, 5000], True),
+    'selenium_videos': Case(bench_selenium_videos, [100, 800], True),
+    'selenium_comments': Case(bench_selenium_comments,
+                              [10, 100, 1000, 10_000], True),
+    'innertube_videos': Case(bench_innertube_videos, [100, 800, 5000], False),
+    'innertube_comments': Case(bench_innertube_comments,
+                               [10, 100, 1000, 10_000], False),
+    'detect_languages': Case(bench_detect_languages, [10, 100, 1000], False),
+    'save_videos': Case(bench_save_videos, [100, 800, 5000], False),
+    'save_comments': Case(bench_save_comments,
+                          [10, 100, 1000, 10_000], False),
+}
+
+
+def percentile(times, p):
+    """Get the pth percentile of a list of times, by nearest rank."""
+    times = sorted(times)
+    return times[max(0, math.ceil(p / 100 * len(times)) - 1)]
+
+
+def run_case(name, size, context):
+    """Run a case for a size, in the current process."""
+    from pool import close_pool
+    case = CASES[name]
+    try:
+        for _ in range(context.warmup):
+            case.run(size, context)
+        items = 0
+        times = []
+        for _ in range(context.repeats):
+            n_items, seconds = case.run(size, context)
+            items = n_items
+            times.append(seconds)
+    finally:
+        close_pool()
+
+    p50 = percentile(times, 50)
+    # linux reports peak RSS in kilobytes
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return Result(name, size, items, items / p50 if p50 > 0 else 0,
+                  p50, percentile(times, 95), peak_rss_mb)
+
+
+def run_cases(cases, context):
+    """Run each case in a fresh process, yielding results as they finish."""
+    # spawned rather than forked, so each process starts with a clean heap
+    mp_context = multiprocessing.get_context('spawn')
+    with mp_context.Pool(1, maxtasksperchild=1) as pool:
+        for name in cases:
+            for size in CASES[name].sizes:
+                if context.sizes and size not in context.sizes:
+                    continue
+                log.info('Running %s with %d items', name, size)
+                try:
+                    yield pool.apply(run_case, (name, size, context))
+                except Exception as e:
+                    log.exception('Error running %s with %d items: %s',
+                                  name, size, e)
+
+
+def result_key(result):
+    """Get the key identifying a result in a baseline."""
+    return '%s[%d]' % (result.case, result.size)
+
+
+def compare(result, baseline):
+    """Describe a result's throughput relative to the baseline."""
+    if result_key(result) not in baseline:
+        return ''
+    before = baseline[result_key(result)]['items_per_sec']
+    if before == 0:
+        return ''
+    change = result.items_per_sec / before - 1
+    flag = '  REGRESSION' if change < -TOLERANCE else ''
+    return '%+.0f%%%s' % (change * 100, flag)
+
+
+def print_results(results, baseline):
+    """Print a table of results, compared to the baseline."""
+    print('%-28s %7s %11s %9s %9s %9s  %s' % (
+        'case', 'items', 'items/s', 'p50 (s)', 'p95 (s)', 'RSS (MB)',
+        'vs baseline'))
+    for result in results:
+        print('%-28s %7d %11.1f %9.3f %9.3f %9.0f  %s' % (
+            result_key(result), result.items, result.items_per_sec,
+            result.p50, result.p95, result.peak_rss_mb,
+            compare(result, baseline)))
+
+
+def main(args):
+    """Run the benchmarks and compare them to the baseline."""
+    baseline = {}
+    if args.baseline is not None and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    cases = args.cases or [name for name, case in CASES.items()
+                           if args.browser or not case.browser]
+    base_url, server = fakeyoutube.start_server()
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            context = argparse.Namespace(
+                base_url=base_url, tmp_dir=tmp_dir, detector=args.detector,
+                sizes=args.sizes, repeats=args.repeats, warmup=args.warmup)
+            results = list(run_cases(cases, context))
+    finally:
+        server.shutdown()
+
+    print_results(results, baseline)
+    regressions = [result for result in results
+                   if 'REGRESSION' in compare(result, baseline)]
+
+    if args.save_baseline:
+        for result in results:
+            baseline[result_key(result)] = result._asdict()
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        log.info('Saved baseline to %s', args.baseline)
+
+    return len(regressions) == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cases', nargs='*',
+                        help='cases to run, defaults to all of %s'
+                        % ', '.join(CASES))
+    parser.add_argument('--sizes', type=int, nargs='*', default=None,
+                        help='only run these sizes of each case')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='untimed runs first, to launch browsers')
+    parser.add_argument('--browser', action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help='run cases that need Chrome')
+    parser.add_argument('--detector', choices=DETECTORS, default='spacy')
+    parser.add_argument('--baseline', type=str,
+                        default='benchmark-baseline.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save these results as the new baseline')
+
+    args = parser.parse_args()
+    for name in args.cases:
+        if name not in CASES:
+            parser.error('unknown case %s' % name)
+
+    if not main(args):
+        raise SystemExit(1)
@@ -1,16 +1,27 @@
 """Find the YouTube channel for an artist."""
-from database import Artist, get_db
-from selenium.webdriver import Chrome
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+from database import Artist, ChannelCache, DirectWriter, get_db
 import argparse
-from common import options
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from logger import log
+from metrics import add_metrics_arguments, labels, metrics
 import os
+import ratelimit
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+# selenium is imported in the functions that use it, so commands that don't
+# need a browser start quickly
+
+# days a channel found by searching is reused for the same artist name
+CACHE_DAYS = 90
+# searches run before their results are committed, when resolving in bulk
+BATCH_SIZE = 50
+
+
+def channel_query(artist_name):
+    """Get the key a channel is cached by, the same for similar names."""
+    return ' '.join(artist_name.lower().split())
+
 
 def find_all_youtube_channels_with_retries(artist_name, max_retries):
     """
@@ -22,15 +33,22 @@ def find_all_youtube_channels_with_retries(artist_name, max_retries):
         log.info('Finding channel for %s, attempt %d',
                  artist_name, n + 1)
         try:
-            return find_youtube_channel(artist_name, options=options)
+            return find_youtube_channel(artist_name)
         except Exception as e:
             log.debug('Error finding channel for %s: ', artist_name, e)
+            if n + 1 < max_retries:
+                ratelimit.backoff(n)
 
     raise Exception('Could not find channel for %s' % artist_name)
 
 
-def find_youtube_channel(artist_name, options=None):
+def find_youtube_channel(artist_name, pool=None):
     """Find the YouTube channel for an artist."""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.wait import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from pool import get_pool
+
     SEARCH_URL = 'https://www.youtube.com/results?search_query=%s'
     # selector for right sidebar channel link
     MUSIC_CHANNEL_SELECTOR = '.ytd-secondary-search-container-renderer a'
@@ -41,14 +59,17 @@ def find_youtube_channel(artist_name, options=None):
     artist_name = artist_name.replace('&', '%26')
     artist_name += ' music'
 
-    with Chrome(options=options) as driver:
+    pool = pool or get_pool()
+    with pool.driver() as driver:
         wait = WebDriverWait(driver, STARTUP_WAIT_TIME)
-        driver.get(SEARCH_URL % artist_name)
+        with ratelimit.limit('search'):
+            with metrics.timer('page_load'):
+                driver.get(SEARCH_URL % artist_name)
 
-        wait.until(EC.presence_of_element_located(
-            (By.CSS_SELECTOR,
-             ','.join([CHANNEL_SELECTOR, MUSIC_CHANNEL_SELECTOR]))
-        ))
+            wait.until(EC.presence_of_element_located(
+                (By.CSS_SELECTOR,
+                 ','.join([CHANNEL_SELECTOR, MUSIC_CHANNEL_SELECTOR]))
+            ))
 
         music_channel_anchor = driver.find_element(
             By.CSS_SELECTOR, MUSIC_CHANNEL_SELECTOR)
@@ -61,33 +82,155 @@ def find_youtube_channel(artist_name, options=None):
         return channel_anchor.get_attribute('href')
 
 
-def main(db_path, artist_name, spotify_uri, max_retries, overwrite):
-    """Find the YouTube channel for an artist and save it to the database."""
-    con, cur = get_db(db_path)
+def save_channel(cur, writer, artist_name, spotify_uri, max_retries,
+                 overwrite):
+    """
+    Find the YouTube channel for an artist and save it to the database.
+
+    Returns False if the channel couldn't be found.
+    """
     artists = Artist.get_by_spotify(cur, spotify_uri)
-    is_in_database = (artists.shape[0] > 0
-                      and artists[Artist.YOUTUBE].iloc[0] is not None)
+    is_in_database = (len(artists) > 0
+                      and artists[0].youtube_url is not None)
     if is_in_database and not overwrite:
         log.error('%s already has a channel in the database, not overwriting.',
                   artist_name)
-        return
+        return True
 
-    try:
-        url = find_all_youtube_channels_with_retries(artist_name, max_retries)
-    except Exception as e:
-        log.exception('Error finding channel for %s: %s', artist_name, e)
-        return
+    query = channel_query(artist_name)
+    # overwriting searches again, in case the cached channel was wrong
+    url = None if overwrite else ChannelCache.get(cur, query, CACHE_DAYS)
+    if url is not None:
+        log.info('Found cached channel for %s', artist_name)
+    else:
+        try:
+            url = find_all_youtube_channels_with_retries(artist_name,
+                                                         max_retries)
+        except Exception as e:
+            log.exception('Error finding channel for %s: %s', artist_name, e)
+            return False
+        writer.submit('ChannelCache.save', query, url)
 
     if is_in_database:
         log.info('Updating %s in database (channel: %s)', artist_name, url)
-        Artist.set_youtube(cur, artists.index[0], url)
+        writer.submit('Artist.set_youtube', artists[0].id, url)
     else:
         log.info('Creating record for %s to database (channel: %s)',
                  artist_name, url)
-        Artist.save(cur, artist_name, spotify_uri, url)
+        writer.submit('Artist.save', artist_name, spotify_uri, url)
 
-    con.commit()
+    writer.flush()
     log.info('Saved %s to database', artist_name)
+    return True
+
+
+def find_channel(artist_name, max_retries):
+    """Find the channel for an artist in a resolver thread, with metrics."""
+    with labels(stage='channels', item=artist_name), metrics.timer('item'):
+        return find_all_youtube_channels_with_retries(artist_name,
+                                                      max_retries)
+
+
+def resolve_channels(cur, writer, artists, max_retries, overwrite, scrapers,
+                     max_age_days=CACHE_DAYS, batch_size=BATCH_SIZE):
+    """
+    Find and save the YouTube channels for many (name, spotify_uri) artists.
+
+    Unless overwriting, artists already in the database are skipped, found
+    with a single lookup, and channels cached within max_age_days are saved
+    without searching. Artists sharing a name are searched for once, by
+    `scrapers` browsers at a time, committing after each batch.
+
+    Returns the number of artists whose channel couldn't be found.
+    """
+    ids = Artist.get_ids_by_spotify(cur)
+    cached = {} if overwrite else ChannelCache.get_all(cur, max_age_days)
+    # artists to save for each search query
+    by_query = {}
+    seen = set()
+    n_skipped = 0
+    for artist_name, spotify_uri in artists:
+        if spotify_uri in seen:
+            continue
+        seen.add(spotify_uri)
+        if spotify_uri in ids and not overwrite:
+            n_skipped += 1
+            continue
+        by_query.setdefault(channel_query(artist_name), []).append(
+            (artist_name, spotify_uri))
+    log.info('Skipped %d artists already in the database', n_skipped)
+
+    def save(query, url):
+        for artist_name, spotify_uri in by_query[query]:
+            if spotify_uri in ids:
+                writer.submit('Artist.set_youtube', ids[spotify_uri], url)
+            else:
+                writer.submit('Artist.save', artist_name, spotify_uri, url)
+
+    queries = []
+    for query in by_query:
+        if query in cached:
+            save(query, cached[query])
+        else:
+            queries.append(query)
+    writer.flush()
+    metrics.count('channels_cached', len(by_query) - len(queries))
+    log.info('Saved %d cached channels, searching for %d',
+             len(by_query) - len(queries), len(queries))
+    if len(queries) == 0:
+        return 0
+
+    # imported only when searching, as it starts selenium
+    from pool import get_pool
+    n_failed = 0
+    # a browser for each search running at once
+    get_pool(size=scrapers)
+    with ThreadPoolExecutor(max_workers=scrapers) as executor:
+        for start in range(0, len(queries), batch_size):
+            futures = {
+                executor.submit(find_channel, by_query[query][0][0],
+                                max_retries): query
+                for query in queries[start:start + batch_size]
+            }
+            for future in as_completed(futures):
+                query = futures[future]
+                try:
+                    url = future.result()
+                except Exception as e:
+                    log.error('Error finding channel for %s: %s', query, e)
+                    metrics.count('items_failed', len(by_query[query]))
+                    n_failed += len(by_query[query])
+                    continue
+                writer.submit('ChannelCache.save', query, url)
+                save(query, url)
+                metrics.count('items_succeeded', len(by_query[query]))
+            writer.flush()
+            log.info('Saved channels for %d of %d searches',
+                     min(start + batch_size, len(queries)), len(queries))
+    return n_failed
+
+
+def main(db_path, artist_name, spotify_uri, max_retries, overwrite):
+    """Find the YouTube channel for an artist and save it to the database."""
+    con, cur = get_db(db_path)
+    ratelimit.configure(db_path)
+    with labels(stage='channels', item=spotify_uri):
+        save_channel(cur, DirectWriter(con), artist_name, spotify_uri,
+                     max_retries, overwrite)
+
+
+def main_bulk(db_path, input_path, max_retries, overwrite, scrapers,
+              max_age_days):
+    """Find and save the YouTube channels for every artist in a csv."""
+    from batch import read_items
+    con, cur = get_db(db_path)
+    ratelimit.configure(db_path)
+    with open(input_path, newline='') as input_file, \
+            labels(stage='channels'):
+        artists = list(read_items('channels', input_file))
+        resolve_channels(cur, DirectWriter(con), artists, max_retries,
+                         overwrite, scrapers, max_age_days)
+    con.close()
 
 
 if __name__ == '__main__':
@@ -97,8 +240,23 @@ if __name__ == '__main__':
     parser.add_argument('--spotify-uri', type=str)
     parser.add_argument('--max-retries', type=int, default=3)
     parser.add_argument('--overwrite', action=argparse.BooleanOptionalAction)
+    parser.add_argument('--input', type=str, default=None,
+                        help='csv of artists with name and spotify_uri '
+                        'columns, to find all of their channels')
+    parser.add_argument('--scrapers', type=int, default=4,
+                        help='browsers searching at once, with --input')
+    parser.add_argument('--cache-days', type=int, default=CACHE_DAYS,
+                        help='reuse channels found within this many days, '
+                        'with --input')
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
 
-    main(args.db_path, args.artist_name, args.spotify_uri,
-         args.max_retries, args.overwrite)
+    metrics.start(args.trace_path)
+    if args.input is not None:
+        main_bulk(args.db_path, args.input, args.max_retries, args.overwrite,
+                  args.scrapers, args.cache_days)
+    else:
+        main(args.db_path, args.artist_name, args.spotify_uri,
+             args.max_retries, args.overwrite)
+    metrics.finish(args.metrics_path)
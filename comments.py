@@ -1,21 +1,30 @@
 """Scrape youtube comments given a video id."""
-from selenium.webdriver import Chrome
-from selenium.webdriver.common.by import By
-import pandas as pd
 import argparse
-import time
-from database import Video, Comment, get_db
-import spacy
-from spacy.language import Language
-from spacy_language_detection import LanguageDetector
-from common import options, find_all_in_scrollable
+from database import (Video, Comment, DirectWriter, content_hash, get_db,
+                      is_known_comment, is_stale)
+from common import (CommentData, count_to_int, iter_scrollable, rechunk,
+                    relative_to_timestamp)
 import os
 from logger import log
+from metrics import add_metrics_arguments, labels, metrics
+import ratelimit
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+UNKNOWN_LANGUAGE = 'UNKNOWN'
+# comments detected and saved at a time, so memory use doesn't grow with the
+# number of comments scraped
+CHUNK_SIZE = 250
+DETECTORS = ['spacy', 'langdetect']
+BACKENDS = ['selenium', 'innertube']
 
-def find_youtube_comments_with_retries(url, max_comments, max_retries):
+# selenium, the innertube scraper and the language detectors are imported in
+# the functions that use them, so commands start quickly
+
+
+def find_youtube_comments_with_retries(url, max_comments, max_retries,
+                                       backend='selenium', known_hashes=None,
+                                       known_ids=None):
     """
     Find youtube comments for a video, retrying if necessary.
 
@@ -24,111 +33,394 @@ def find_youtube_comments_with_retries(url, max_comments, max_retries):
     for n in range(max_retries):
         log.info('Finding comments for %s, attempt %d', url, n + 1)
         try:
-            return find_youtube_comments(
-                url,
-                max_comments,
-                options=options
-            )
+            return find_comments(url, max_comments, backend, known_hashes,
+                                 known_ids)
+        except Exception as e:
+            log.debug('Error finding comments for %s: %s', url, e)
+            if n + 1 < max_retries:
+                ratelimit.backoff(n)
+
+    raise Exception('Could not find comments for %s after %d retries'
+                    % (url, max_retries))
+
+
+def iter_comments_with_retries(url, max_comments, max_retries,
+                               backend='selenium', known_hashes=None,
+                               known_ids=None):
+    """
+    Find youtube comments for a video, retrying if necessary.
+
+    Lists of comments are yielded as they are found. Each attempt starts again
+    from the first comment, so comments yielded by a failed attempt are yielded
+    again. Raises an exception after max_retries.
+    """
+    for n in range(max_retries):
+        log.info('Finding comments for %s, attempt %d', url, n + 1)
+        try:
+            yield from iter_comments(url, max_comments, backend, known_hashes,
+                                     known_ids)
+            return
         except Exception as e:
             log.debug('Error finding comments for %s: %s', url, e)
+            if n + 1 < max_retries:
+                ratelimit.backoff(n)
 
     raise Exception('Could not find comments for %s after %d retries'
                     % (url, max_retries))
 
 
-def find_youtube_comments(url, max_comments, options=None):
+def find_comments(url, max_comments, backend, known_hashes=None,
+                  known_ids=None):
+    """
+    Find youtube comments for a video with the given backend.
+
+    Returns a list of comments, see `iter_comments`.
+    """
+    return [comment for comments in iter_comments(
+                url, max_comments, backend, known_hashes, known_ids)
+            for comment in comments]
+
+
+def iter_comments(url, max_comments, backend, known_hashes=None,
+                  known_ids=None):
+    """
+    Find youtube comments for a video with the given backend.
+
+    Lists of CommentData are yielded as they are found. The innertube backend
+    falls back to selenium if it fails before finding any comments.
+    """
+    if backend == 'innertube':
+        import innertube
+        n_comments = 0
+        try:
+            for comments in innertube.iter_youtube_comments(
+                    url, max_comments, known_hashes=known_hashes,
+                    known_ids=known_ids):
+                n_comments += len(comments)
+                yield comments
+            return
+        except Exception as e:
+            # comments already yielded can't be taken back
+            if n_comments > 0:
+                raise
+            log.debug('Error finding comments for %s with innertube, '
+                      'falling back to selenium: %s', url, e)
+    yield from iter_youtube_comments(url, max_comments,
+                                     known_hashes=known_hashes,
+                                     known_ids=known_ids)
+
+
+def find_youtube_comments(url, max_comments, pool=None, known_hashes=None,
+                          known_ids=None):
     """
     Find youtube comments for a video.
 
+    Returns a list of comments, see `iter_youtube_comments`.
+    """
+    return [comment for comments in iter_youtube_comments(
+                url, max_comments, pool, known_hashes, known_ids)
+            for comment in comments]
+
+
+def iter_youtube_comments(url, max_comments, pool=None, known_hashes=None,
+                          known_ids=None):
+    """
+    Find youtube comments for a video as the page loads them.
+
+    Lists of CommentData are yielded, and comments are removed from the page
+    once they are read, so the browser's memory doesn't grow with the number
+    of comments.
+
+    If `known_hashes` is given, comments are sorted newest first, and
+    scrolling stops after MAX_KNOWN comments in a row whose youtube id is in
+    `known_ids` or whose content hash is known.
+
     Raises an exception if no comments are found, unless the video is
     specified as have 0 comments, or comments are turned off.
     """
-    COMMENT_SELECTOR = '#content-text'
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.wait import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from pool import get_pool
+
+    COMMENTS_SECTION = 'ytd-comments'
+    # the element holding a comment and its replies
+    THREAD_SELECTOR = 'ytd-comment-thread-renderer'
     STARTUP_WAIT_TIME = 5
     MAX_WAIT_TIME = 30
 
-    comments = []
-    with Chrome(options=options) as driver:
-        driver.get(url)
-        time.sleep(STARTUP_WAIT_TIME)
+    is_known = (None if known_hashes is None
+                else lambda record: is_known_comment(
+                    record_to_comment(record), known_hashes, known_ids))
 
-        comments = find_all_in_scrollable(
-            driver, COMMENT_SELECTOR, MAX_WAIT_TIME, max_elements=max_comments)
-        comments = [comment.text for comment in comments]
+    n_comments = 0
+    pool = pool or get_pool()
+    with pool.driver() as driver:
+        with ratelimit.limit('watch'):
+            with metrics.timer('page_load'):
+                driver.get(url)
+            WebDriverWait(driver, STARTUP_WAIT_TIME).until(
+                EC.presence_of_element_located(
+                    (By.CSS_SELECTOR, COMMENTS_SECTION)))
+        if known_hashes is not None:
+            sort_by_newest(driver)
 
-        if len(comments) == 0:
+        for records in iter_scrollable(
+                driver, THREAD_SELECTOR, MAX_WAIT_TIME,
+                max_elements=max_comments, extract=EXTRACT_COMMENT,
+                is_known=is_known, prune=THREAD_SELECTOR):
+            n_comments += len(records)
+            yield [record_to_comment(record) for record in records]
+
+        if n_comments == 0:
             body = driver.find_element(By.TAG_NAME, 'body')
             if 'Comments are turned off' in body.text:
                 log.debug('Comments are turned off for %s', url)
-                return []
+                return
             if '\n0 Comments' in body.text:
                 log.debug('%s has 0 comments', url)
-                return []
+                return
             raise Exception(
                 'Video URL %s has no comments, but was expected to have some'
                 % url)
 
-    log.info('Found %d comments for %s', len(comments), url)
-    return comments
+    log.info('Found %d comments for %s', n_comments, url)
+
+
+# extract a comment from its thread, the replies come after the comment so
+# the first match of each selector is the comment's own
+EXTRACT_COMMENT = '''
+const text = el.querySelector('#content-text');
+if (text === null) return null;
+const link = el.querySelector('#published-time-text a');
+const author = el.querySelector('#author-text');
+const likes = el.querySelector('#vote-count-middle');
+const replies = el.querySelector('#more-replies');
+return {
+    text: text.innerText,
+    id: link && new URL(link.href).searchParams.get('lc'),
+    published: link && link.innerText,
+    author: author && author.getAttribute('href'),
+    likes: likes ? likes.innerText : '',
+    replies: replies ? replies.innerText : '',
+};
+'''
+
+
+def record_to_comment(record, now=None):
+    """Convert a record extracted from a comment thread to CommentData."""
+    author = record.get('author')
+    return CommentData(
+        record['text'],
+        record.get('id'),
+        # links are to /@handle, or /channel/<id> for older channels
+        author.rsplit('/', 1)[-1] if author else None,
+        count_to_int(record.get('likes', '')),
+        relative_to_timestamp(record.get('published'), now),
+        count_to_int(record.get('replies', '')))
+
+
+def sort_by_newest(driver):
+    """Sort the comments on a video page newest first, if there is a menu."""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.wait import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException
+
+    COMMENTS_SECTION = 'ytd-comments'
+    SORT_MENU = 'ytd-comments-header-renderer #sort-menu #label'
+    # the menu lists top comments, then newest first
+    NEWEST_OPTION = '#sort-menu tp-yt-paper-listbox a:nth-of-type(2)'
+    MENU_WAIT_TIME = 10
+
+    # the comments header is only loaded once it is scrolled into view
+    comments_section = driver.find_element(By.CSS_SELECTOR, COMMENTS_SECTION)
+    driver.execute_script('arguments[0].scrollIntoView()', comments_section)
+    wait = WebDriverWait(driver, MENU_WAIT_TIME)
+    try:
+        wait.until(EC.element_to_be_clickable(
+            (By.CSS_SELECTOR, SORT_MENU))).click()
+        wait.until(EC.element_to_be_clickable(
+            (By.CSS_SELECTOR, NEWEST_OPTION))).click()
+        log.debug('Sorted comments newest first')
+    except TimeoutException:
+        log.debug('No sort menu found, using top comments')
 
 
-@Language.factory('language_detector')
 def get_lang_detector(nlp, name):
     """Language detector factory."""
+    from spacy_language_detection import LanguageDetector
     return LanguageDetector(seed=42)
 
 
-def detect_languages(texts):
-    """Detect languages for a list of texts using spacy."""
-    nlp_model = spacy.load('en_core_web_sm')
-    nlp_model.add_pipe('language_detector', last=True)
+_nlp_model = None
 
-    languages = [nlp_model(text)._.language['language'] for text in texts]
-    return languages
 
+def get_nlp_model():
+    """Load the spacy model with a language detector, once per process."""
+    global _nlp_model
+    if _nlp_model is None:
+        import spacy
+        from spacy.language import Language
+        if not Language.has_factory('language_detector'):
+            Language.factory('language_detector', func=get_lang_detector)
+        _nlp_model = spacy.load('en_core_web_sm')
+        _nlp_model.add_pipe('language_detector', last=True)
+        log.debug('Loaded spacy model')
+    return _nlp_model
 
-def create_dataframe(video_id, comments, languages):
-    """Create a dataframe for a list of comments."""
-    rows = [
-        {
-            Comment.VIDEO_ID: video_id,
-            Comment.LANGUAGE: language,
-            Comment.CONTENT: comment
-        }
-        for (comment, language) in zip(comments, languages)
-    ]
 
-    return pd.DataFrame(
-        rows, columns=[Comment.VIDEO_ID, Comment.CONTENT, Comment.LANGUAGE])
+def detect_language_fast(text):
+    """Detect the language of a text with langdetect, skipping spacy."""
+    import langdetect
+    from langdetect.lang_detect_exception import LangDetectException
+    # make langdetect deterministic, as the spacy detector is seeded
+    langdetect.DetectorFactory.seed = 42
+    try:
+        return langdetect.detect(text)
+    except LangDetectException:
+        return UNKNOWN_LANGUAGE
 
 
-def main(db_path, video_id, max_comments, max_retries):
-    """Scrape youtube comments for a video and save them to the database."""
-    con, cur = get_db(db_path)
+def detect_languages(texts, detector='spacy', batch_size=256, n_process=1):
+    """Detect languages for a list of texts."""
+    if detector == 'langdetect':
+        return [detect_language_fast(text) for text in texts]
+
+    nlp_model = get_nlp_model()
+    # the detector only needs the text, so skip the rest of the pipeline
+    disable = [name for name in nlp_model.pipe_names
+               if name != 'language_detector']
+    docs = nlp_model.pipe(texts, batch_size=batch_size,
+                          n_process=n_process, disable=disable)
+    return [doc._.language['language'] for doc in docs]
 
+
+def split_known(comments, known_ids):
+    """
+    Split comments into known and new comments, by their youtube ids.
+
+    Known comments have a youtube id that is already saved, so only their
+    counts need updating.
+    """
+    known = []
+    unknown = []
+    for comment in comments:
+        if comment.youtube_id is not None and comment.youtube_id in known_ids:
+            known.append(comment)
+        else:
+            unknown.append(comment)
+    return known, unknown
+
+
+def remove_duplicates(comments, known_hashes):
+    """
+    Remove comments whose content hash is already known.
+
+    Comments repeated by comments without a youtube id are removed too.
+    Returns the new comments and their hashes, and adds the hashes of those
+    without a youtube id to `known_hashes`, so it can be used for each chunk
+    of a video's comments.
+    """
+    new_comments = []
+    hashes = []
+    for comment in comments:
+        comment_hash = content_hash(comment.text)
+        if comment_hash in known_hashes:
+            continue
+        # comments with a youtube id are told apart by it, as different
+        # comments can have the same text, like a single emoji
+        if comment.youtube_id is None:
+            known_hashes.add(comment_hash)
+        new_comments.append(comment)
+        hashes.append(comment_hash)
+    return new_comments, hashes
+
+
+def get_rows(video_id, comments, languages, hashes):
+    """Convert a list of comments to rows for the comment table."""
+    for (comment, language, comment_hash) in zip(comments, languages, hashes):
+        yield (video_id, comment.text, language, comment_hash,
+               comment.youtube_id, comment.author, comment.likes,
+               comment.published_at, comment.replies)
+
+
+def get_count_rows(video_id, comments):
+    """Convert a list of known comments to rows updating their counts."""
+    for comment in comments:
+        yield (comment.likes, comment.replies, video_id, comment.youtube_id)
+
+
+def save_comments(cur, writer, video_id, max_comments, max_retries,
+                  detector='spacy', backend='selenium', force=False,
+                  incremental=False, detect_processes=1):
+    """
+    Scrape youtube comments for a video and save them to the database.
+
+    Videos updated recently are skipped, unless `force` is set.
+    If `incremental` is set, only comments newer than those already in the
+    database are scraped.
+    Languages are detected by `detect_processes` processes, with spacy.
+    Returns False if the video or its comments couldn't be found.
+    """
     video = Video.get_by_id(cur, video_id)
     if video is None:
         log.error('ID: %s not found in database', video_id)
-        return
+        return False
+    if not force and not is_stale(video.updated_at):
+        log.info('Comments for %s were updated recently, skipping',
+                 video.youtube_url)
+        return True
 
+    known_hashes = Comment.get_hashes_by_video(cur, video_id)
+    known_ids = Comment.get_youtube_ids_by_video(cur, video_id)
+    # comments saved before this scrape, as known_hashes grows as it goes
+    stop_hashes = set(known_hashes) if incremental else None
+    # comments are detected and saved a chunk at a time as they are scraped
+    chunks = rechunk(iter_comments_with_retries(
+        video.youtube_url, max_comments, max_retries, backend, stop_hashes,
+        known_ids), CHUNK_SIZE)
+    n_saved = 0
     try:
-        comments = find_youtube_comments_with_retries(
-            video[Video.YOUTUBE], max_comments, max_retries)
+        for comments in chunks:
+            # comments already saved only have their likes and replies
+            # updated, without hashing or detecting their language again
+            known, comments = split_known(comments, known_ids)
+            comments, hashes = remove_duplicates(comments, known_hashes)
+            with metrics.timer('detect_languages'):
+                languages = detect_languages(
+                    [comment.text for comment in comments], detector=detector,
+                    n_process=detect_processes)
+            metrics.count('comments_found', len(comments))
+            writer.submit('Comment.update_counts_many',
+                          get_count_rows(video_id, known))
+            writer.submit('Comment.save_many',
+                          get_rows(video_id, comments, languages, hashes))
+            writer.flush()
+            n_saved += len(comments)
+            log.debug('Saved %d new comments for %s so far',
+                      n_saved, video.youtube_url)
     except Exception as e:
+        # comments saved so far are kept, and the video is scraped again
         log.exception('Error finding comments for %s: %s',
-                      video[Video.YOUTUBE], e)
-    languages = detect_languages(comments)
-    log.debug('Finished detecting languages')
+                      video.youtube_url, e)
+        return False
+
+    writer.submit('Video.set_updated', video_id)
+    writer.flush()
+    log.info('Saved %d new comments for %s', n_saved, video.youtube_url)
+    return True
 
-    df = create_dataframe(video_id, comments, languages)
-    comments_in_db = Comment.get_by_video(cur, video_id)
-    new_comments_df = df[~df[Comment.CONTENT].isin(comments_in_db)]
 
-    Comment.save_many(cur, new_comments_df)
-    Video.set_updated(cur, video_id)
-    con.commit()
-    log.info('Saved %d new comments for %s',
-             len(new_comments_df), video[Video.YOUTUBE])
+def main(db_path, video_id, max_comments, max_retries, detector, backend,
+         force, incremental, detect_processes):
+    """Scrape youtube comments for a video and save them to the database."""
+    con, cur = get_db(db_path)
+    ratelimit.configure(db_path)
+    with labels(stage='comments', item=video_id):
+        save_comments(cur, DirectWriter(con), video_id, max_comments,
+                      max_retries, detector, backend, force, incremental,
+                      detect_processes)
 
 
 if __name__ == '__main__':
@@ -137,7 +429,23 @@ if __name__ == '__main__':
     parser.add_argument('--video-id', type=str)
     parser.add_argument('--max-comments', type=int, default=1000)
     parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--detector', choices=DETECTORS, default='spacy')
+    parser.add_argument('--detect-processes', type=int, default=1,
+                        help='processes spacy detects the languages of each '
+                        'chunk of comments with')
+    parser.add_argument('--backend', choices=BACKENDS, default='selenium')
+    parser.add_argument('--force', action=argparse.BooleanOptionalAction,
+                        help='scrape even if the video was updated recently')
+    parser.add_argument('--incremental',
+                        action=argparse.BooleanOptionalAction,
+                        help='sort comments newest first and stop scrolling '
+                        'at known comments')
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
 
-    main(args.db_path, args.video_id, args.max_comments, args.max_retries)
+    metrics.start(args.trace_path)
+    main(args.db_path, args.video_id, args.max_comments, args.max_retries,
+         args.detector, args.backend, args.force, args.incremental,
+         args.detect_processes)
+    metrics.finish(args.metrics_path)
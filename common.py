@@ -1,36 +1,324 @@
 """Common functions for all scrapers."""
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
+from dataclasses import dataclass
+import re
 import time
 from logger import log
+from metrics import metrics
 
+# consecutive known items after which an incremental scrape stops, as the
+# rest of a newest first list has been scraped before
+MAX_KNOWN = 20
 
-options = Options()
-options.add_argument('--headless=new')
-options.add_argument('--window-size=2560,1440')
-options.add_argument('--mute-audio')
-options.add_argument('--disable-gpu')
-
-
-def find_all_in_scrollable(driver, selector, max_wait_time, max_elements=None):
-    """Find all elements matching selector in a scrollable page."""
-    last_len = None
-    last_different_len_time = time.time()
-    while True:
-        elements = driver.find_elements(By.CSS_SELECTOR, selector)
-        if max_elements is not None and len(elements) >= max_elements:
-            log.debug('Found max of %d elements, stopping', len(elements))
-            break
-        if len(elements) == last_len:
-            if time.time() - last_different_len_time > max_wait_time:
-                log.debug('No new elements for %d seconds, stopping',
-                          max_wait_time)
-                break
+_options = None
+
+
+def get_options():
+    """Get the Chrome options for all scrapers, importing selenium on use."""
+    global _options
+    if _options is None:
+        from selenium.webdriver.chrome.options import Options
+        _options = Options()
+        _options.add_argument('--headless=new')
+        _options.add_argument('--window-size=2560,1440')
+        _options.add_argument('--mute-audio')
+        _options.add_argument('--disable-gpu')
+    return _options
+
+
+@dataclass
+class VideoData:
+    """Store video data before it is inserted into the database."""
+
+    url: str
+    title: str
+    views: int
+
+
+@dataclass
+class CommentData:
+    """Store comment data before it is inserted into the database."""
+
+    text: str
+    youtube_id: str = None
+    # the handle of the commenter's channel, like @name
+    author: str = None
+    likes: int = None
+    # unix time, estimated from relative times like '3 weeks ago'
+    published_at: int = None
+    replies: int = None
+
+
+SUFFIXES = {'K': 1_000, 'M': 1_000_000, 'B': 1_000_000_000}
+
+
+def count_to_int(count):
+    """
+    Convert a count such as '1,234', '1.2K' or '12 replies' to an integer.
+
+    Returns 0 for an empty count, as youtube shows no count for 0 likes.
+    """
+    words = count.split()
+    if len(words) == 0:
+        return 0
+    count = words[0].replace(',', '')
+    if count[-1] in SUFFIXES:
+        return int(float(count[:-1]) * SUFFIXES[count[-1]])
+    return int(count)
+
+
+RELATIVE_TIME_RE = re.compile(
+    r'(\d+)\s+(second|minute|hour|day|week|month|year)s?\s+ago')
+UNIT_SECONDS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+    'week': 7 * 24 * 60 * 60,
+    'month': 30 * 24 * 60 * 60,
+    'year': 365 * 24 * 60 * 60,
+}
+
+
+def relative_to_timestamp(published, now=None):
+    """
+    Estimate the unix time of a relative time such as '3 weeks ago (edited)'.
+
+    Returns None if the text isn't a relative time.
+    """
+    match = RELATIVE_TIME_RE.search(published or '')
+    if match is None:
+        return None
+    now = time.time() if now is None else now
+    return int(now) - int(match.group(1)) * UNIT_SECONDS[match.group(2)]
+
+
+def known_run(items, is_known, run=0):
+    """Extend a run of consecutive known items, returning its new length."""
+    for item in items:
+        run = run + 1 if is_known(item) else 0
+    return run
+
+
+# extract the text of an element, used when no extract script is given
+EXTRACT_TEXT = 'return {text: el.innerText};'
+
+# install a MutationObserver that queues elements matching a selector as they
+# are added to the page, so each element is only looked at once
+INSTALL_OBSERVER_SCRIPT = '''
+const [selector, extractBody, prune, maxPendingMs] = arguments;
+const state = {
+    extract: new Function('el', extractBody),
+    prune: prune,
+    maxPendingMs: maxPendingMs,
+    seen: new WeakSet(),
+    pending: [],
+    pendingSince: new WeakMap(),
+    added: 0,
+    skipped: 0,
+    drainedAdded: 0,
+    notify: null,
+};
+window.__scrollableState = state;
+
+function visit(root) {
+    if (root.nodeType !== Node.ELEMENT_NODE) return;
+    const elements = root.matches(selector) ? [root] : [];
+    elements.push(...root.querySelectorAll(selector));
+    const addedBefore = state.added;
+    for (const el of elements) {
+        if (state.seen.has(el)) continue;
+        state.seen.add(el);
+        state.pending.push(el);
+        state.pendingSince.set(el, Date.now());
+        state.added++;
+    }
+    if (state.added > addedBefore && state.notify !== null) state.notify();
+}
+
+visit(document.body);
+state.observer = new MutationObserver((mutations) => {
+    for (const mutation of mutations) {
+        for (const node of mutation.addedNodes) visit(node);
+    }
+});
+state.observer.observe(document.body, {childList: true, subtree: true});
+'''
+
+# scroll to the bottom of the page, wait until new elements are added or a
+# timeout passes, then return the records for every element that is ready,
+# removing the elements from the page if pruning. elements that are still not
+# ready after maxPendingMs are skipped
+SCROLL_AND_DRAIN_SCRIPT = '''
+const [timeoutMs, final] = arguments;
+const done = arguments[arguments.length - 1];
+const state = window.__scrollableState;
+
+function drain() {
+    const records = [];
+    const notReady = [];
+    for (const el of state.pending) {
+        const record = state.extract(el);
+        if (record === null || record === undefined) {
+            if (Date.now() - state.pendingSince.get(el) > state.maxPendingMs) {
+                state.skipped++;
+            } else {
+                notReady.push(el);
+            }
+        } else {
+            records.push(record);
+            if (state.prune !== null) (el.closest(state.prune) || el).remove();
+        }
+    }
+    state.pending = notReady;
+    state.drainedAdded = state.added;
+    if (final) state.observer.disconnect();
+    done({
+        records: records,
+        pending: state.pending.length,
+        skipped: state.skipped,
+        added: state.added,
+    });
+}
+
+window.scrollTo(0, document.documentElement.scrollHeight);
+if (final) {
+    drain();
+} else {
+    const timer = setTimeout(() => { state.notify = null; drain(); },
+                             timeoutMs);
+    // wait a frame after new elements are added so they can finish rendering
+    state.notify = () => {
+        state.notify = null;
+        clearTimeout(timer);
+        requestAnimationFrame(drain);
+    };
+    if (state.added > state.drainedAdded) state.notify();
+}
+'''
+
+
+def find_all_in_scrollable(driver, selector, max_wait_time, max_elements=None,
+                           extract=EXTRACT_TEXT, is_known=None):
+    """
+    Find all elements matching selector in a scrollable page.
+
+    Returns a list of records, as dicts, see `iter_scrollable`.
+    """
+    return [record for records in iter_scrollable(
+                driver, selector, max_wait_time, max_elements, extract,
+                is_known)
+            for record in records]
+
+
+def iter_scrollable(driver, selector, max_wait_time, max_elements=None,
+                    extract=EXTRACT_TEXT, is_known=None, prune=None):
+    """
+    Yield lists of records of elements matching selector as a page scrolls.
+
+    `extract` is the body of a javascript function taking the element `el` and
+    returning a record for it, or null if the element hasn't finished
+    rendering yet. Records are dicts. Elements that still haven't finished
+    rendering after `max_wait_time` seconds, such as premium videos that never
+    show a view count, are skipped.
+
+    Elements are collected by a MutationObserver as the page adds them, and
+    scrolling stops once no new elements have been added for a while.
+    The idle cutoff adapts to how long the page has been taking to load more
+    elements, up to `max_wait_time` seconds.
+
+    Scrolling stops once `max_elements` records have been yielded.
+
+    If `is_known` is given, scrolling also stops once it returns True for
+    MAX_KNOWN records in a row.
+
+    If `prune` is given, each element's closest ancestor matching it is
+    removed from the page once its record is extracted, so the page's memory
+    doesn't grow with the number of elements scrolled past.
+    """
+    MIN_IDLE_TIME = 2
+    IDLE_GAP_MULTIPLIER = 4
+    POLL_TIME = 1
+
+    driver.set_script_timeout(max_wait_time + POLL_TIME + 5)
+    driver.execute_script(INSTALL_OBSERVER_SCRIPT, selector, extract, prune,
+                          max_wait_time * 1000)
+
+    n_records = 0
+    n_known = 0
+    n_added = 0
+    longest_gap = 0
+    last_new_time = time.time()
+    # time spent by the caller between yields isn't counted as scrolling
+    scroll_seconds = 0
+    stop = False
+    while not stop:
+        start = time.time()
+        result = driver.execute_async_script(
+            SCROLL_AND_DRAIN_SCRIPT, POLL_TIME * 1000, False)
+        now = time.time()
+        scroll_seconds += now - start
+        new_records = result['records']
+        if max_elements is not None:
+            new_records = new_records[:max_elements - n_records]
+        n_records += len(new_records)
+
+        if result['added'] > n_added:
+            longest_gap = max(longest_gap, now - last_new_time)
+            last_new_time = now
+        n_added = result['added']
+
+        # pending elements may never finish rendering, so only records count
+        if max_elements is not None and n_records >= max_elements:
+            log.debug('Found max of %d elements, stopping', n_records)
+            stop = True
+
+        if is_known is not None:
+            n_known = known_run(new_records, is_known, n_known)
+            if n_known >= MAX_KNOWN:
+                log.debug('Found %d known elements in a row, stopping',
+                          n_known)
+                stop = True
+
+        if n_added == 0:
+            # nothing has loaded yet, so there is no gap to adapt to
+            idle_cutoff = max_wait_time
         else:
-            last_different_len_time = time.time()
-        last_len = len(elements)
+            idle_cutoff = min(max_wait_time,
+                              max(MIN_IDLE_TIME,
+                                  longest_gap * IDLE_GAP_MULTIPLIER))
+        if not stop and now - last_new_time > idle_cutoff:
+            log.debug('No new elements for %.1f seconds, stopping',
+                      idle_cutoff)
+            stop = True
+
+        if len(new_records) > 0:
+            yield new_records
+            # the page keeps loading while the caller handles the records,
+            # so that time isn't idle either
+            last_new_time += time.time() - now
+
+    metrics.observe('scroll', scroll_seconds)
+    result = driver.execute_async_script(SCROLL_AND_DRAIN_SCRIPT, 0, True)
+    new_records = result['records']
+    if max_elements is not None:
+        new_records = new_records[:max_elements - n_records]
+    n_records += len(new_records)
+    n_skipped = result['skipped'] + result['pending']
+    if n_skipped > 0:
+        log.debug('Skipped %d elements that did not finish rendering',
+                  n_skipped)
+    metrics.count('elements_extracted', n_records)
+    if len(new_records) > 0:
+        yield new_records
+
 
-        driver.find_element(By.TAG_NAME, 'body').send_keys(Keys.END)
-        time.sleep(1)
-    return elements
+def rechunk(chunks, size):
+    """Regroup an iterable of lists into lists of at least `size` items."""
+    chunk = []
+    for items in chunks:
+        chunk.extend(items)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
@@ -1,7 +1,26 @@
 """Methods for interacting with the database."""
-import pandas as pd
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import hashlib
+import heapq
+import json
+import math
+import queue
+import random
+import re
 import sqlite3
+import threading
+import time
+from types import GeneratorType
+import unicodedata
 from logger import log
+from metrics import labels, metrics
+
+BUSY_TIMEOUT = 30
+# artists and videos are scraped again once they are this many days old
+STALE_AFTER_DAYS = 28
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 
 def generate_schema():
@@ -36,17 +55,457 @@ CREATE TABLE IF NOT EXISTS comment (
 '''
 
 
+def normalize_content(content):
+    """
+    Normalize comment content before hashing.
+
+    The browser and innertube scrapers can return the same comment with
+    different whitespace or unicode forms, these should hash the same.
+    """
+    content = unicodedata.normalize('NFKC', content)
+    return re.sub(r'\s+', ' ', content).strip()
+
+
+def content_hash(content):
+    """Hash normalized comment content to a signed 64 bit integer."""
+    normalized = normalize_content(content).encode()
+    digest = hashlib.blake2b(normalized, digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def is_known_comment(comment, known_hashes, known_ids=None):
+    """
+    Check if a scraped comment is already saved.
+
+    Comments are looked up by their youtube id if they have one, or else by
+    their content hash. A comment with an unknown youtube id is still known
+    if its content hash matches a comment saved without an id.
+    """
+    if comment.youtube_id is not None and known_ids is not None:
+        if comment.youtube_id in known_ids:
+            return True
+    return content_hash(comment.text) in known_hashes
+
+
+# runs of letters, joined by apostrophes, in any script
+WORD_RE = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)*")
+
+
+def tokenize(content):
+    """Split comment content into lowercase words, for word counts."""
+    return WORD_RE.findall(normalize_content(content).lower())
+
+
+def count_words(comments):
+    """
+    Count the words in (video_id, content, language) comments.
+
+    Returns a Counter keyed by (video_id, language, word).
+    """
+    counts = Counter()
+    for video_id, content, language in comments:
+        for word in tokenize(content):
+            counts[(video_id, language, word)] += 1
+    return counts
+
+
+def hash_comments(cur, only_missing=True, batch_size=10_000,
+                  word_counts=False, youtube_ids=True):
+    """
+    Set the content hash of comments in bulk, returning the number hashed.
+
+    Comments without a youtube id that turn out to be duplicates are
+    removed, keeping the oldest. If `word_counts` is set, the words of
+    removed comments are taken off the word counts in the same transaction.
+    `youtube_ids` is false for migrations from before comments had them.
+
+    The unique key is dropped while hashing, so this should be run in a
+    `transaction`, which restores it if hashing fails.
+    """
+    # the unique key is rebuilt afterwards, so rows can be rehashed in any
+    # order without conflicting with each other
+    cur.execute('DROP INDEX IF EXISTS comment_video_content_hash')
+    missing = (f'AND {Comment.CONTENT_HASH} IS NULL' if only_missing
+               else '')
+    last_id = 0
+    n_hashed = 0
+    while True:
+        cur.execute(
+            f'''SELECT {Comment.ID}, {Comment.CONTENT} FROM comment
+               WHERE {Comment.ID} > ? {missing}
+               ORDER BY {Comment.ID} LIMIT ?''',
+            (last_id, batch_size))
+        rows = cur.fetchall()
+        if len(rows) == 0:
+            break
+        cur.executemany(
+            f'''UPDATE comment SET {Comment.CONTENT_HASH} = ?
+               WHERE {Comment.ID} = ?''',
+            ((content_hash(content), comment_id)
+             for comment_id, content in rows))
+        last_id = rows[-1][0]
+        n_hashed += len(rows)
+        log.debug('Hashed %d comments', n_hashed)
+
+    # comments with a youtube id are told apart by it, as different comments
+    # can have the same text, like a single emoji
+    without_id = (f'{Comment.YOUTUBE_ID} IS NULL' if youtube_ids
+                  else 'TRUE')
+    duplicates = f'''{without_id} AND {Comment.ID} NOT IN (
+        SELECT MIN({Comment.ID}) FROM comment WHERE {without_id}
+        GROUP BY {Comment.VIDEO_ID}, {Comment.CONTENT_HASH})'''
+    if word_counts:
+        # duplicates had their words counted when they were saved
+        read_cur = cur.connection.cursor()
+        read_cur.execute(
+            f'''SELECT {Comment.VIDEO_ID}, {Comment.CONTENT},
+                {Comment.LANGUAGE} FROM comment WHERE {duplicates}''')
+        while True:
+            rows = read_cur.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            WordCount.remove_many(cur, count_words(rows))
+    cur.execute(f'DELETE FROM comment WHERE {duplicates}')
+    log.debug('Removed %d duplicate comments', cur.rowcount)
+    cur.execute(f'''CREATE UNIQUE INDEX comment_video_content_hash
+                   ON comment ({Comment.VIDEO_ID}, {Comment.CONTENT_HASH})
+                   WHERE {without_id}''')
+    return n_hashed
+
+
+SEARCH_MODES = ['term', 'phrase', 'prefix']
+
+
+def search_query(text, mode='term'):
+    """
+    Build an FTS5 query from text.
+
+    The query matches comments with all of its words (term), the words in
+    order (phrase), or words starting with the last word (prefix).
+    """
+    words = ['"%s"' % word.replace('"', '""') for word in text.split()]
+    if len(words) == 0:
+        raise ValueError('Search text is empty')
+    if mode == 'phrase':
+        return '"%s"' % ' '.join(word[1:-1] for word in words)
+    if mode == 'prefix':
+        words[-1] += '*'
+    return ' '.join(words)
+
+
+def add_indexes(cur):
+    """
+    Add lookup indexes, a unique video key and comment content hashes.
+
+    The unique key on video skips duplicate videos in SQL, and also indexes
+    its parent id column. Existing duplicates are removed, keeping the oldest
+    row.
+    """
+    cur.execute(f'''CREATE INDEX IF NOT EXISTS artist_spotify_uri
+                   ON artist ({Artist.SPOTIFY})''')
+    cur.execute(f'''CREATE INDEX IF NOT EXISTS artist_youtube_url
+                   ON artist ({Artist.YOUTUBE})''')
+
+    cur.execute(f'''DELETE FROM video WHERE {Video.ID} NOT IN (
+                       SELECT MIN({Video.ID}) FROM video
+                       GROUP BY {Video.ARTIST_ID}, {Video.YOUTUBE})''')
+    cur.execute(f'''CREATE UNIQUE INDEX IF NOT EXISTS video_artist_youtube_url
+                   ON video ({Video.ARTIST_ID}, {Video.YOUTUBE})''')
+
+    # comments are hashed, and their unique key added, by rehash_comments
+    cur.execute(
+        f'ALTER TABLE comment ADD COLUMN {Comment.CONTENT_HASH} INTEGER')
+
+
+def rehash_comments(cur):
+    """Hash all comments with normalized content."""
+    hash_comments(cur, only_missing=False, youtube_ids=False)
+
+
+def add_schedule_indexes(cur):
+    """Add indexes used to find stale artists and each artist's top videos."""
+    cur.execute(f'''CREATE INDEX IF NOT EXISTS artist_updated_at
+                   ON artist ({Artist.UPDATED})''')
+    cur.execute(f'''CREATE INDEX IF NOT EXISTS video_artist_views
+                   ON video ({Video.ARTIST_ID}, {Video.VIEWS} DESC)''')
+
+
+def add_job_table(cur):
+    """Add the job table, which tracks leased work items across workers."""
+    cur.execute(f'''
+CREATE TABLE IF NOT EXISTS job (
+    {Job.ID} INTEGER PRIMARY KEY,
+    {Job.STAGE} TEXT NOT NULL,
+    {Job.ITEM} TEXT NOT NULL,
+    {Job.STATUS} TEXT NOT NULL,
+    {Job.OWNER} TEXT,
+    {Job.LEASE_EXPIRES} INTEGER,
+    {Job.ATTEMPTS} INTEGER NOT NULL DEFAULT 0,
+    {Job.LAST_ERROR} TEXT,
+    {Job.AVAILABLE} INTEGER NOT NULL,
+    {Job.UPDATED} INTEGER NOT NULL,
+    UNIQUE ({Job.STAGE}, {Job.ITEM})
+)''')
+    cur.execute(f'''CREATE INDEX IF NOT EXISTS job_claim
+                   ON job ({Job.STAGE}, {Job.STATUS}, {Job.AVAILABLE})''')
+
+
+def add_video_stats(cur):
+    """
+    Add the video_stats table, which records the history of video views.
+
+    Each video's history starts with its views as of when its artist's videos
+    were last scraped.
+    """
+    cur.execute(f'''
+CREATE TABLE IF NOT EXISTS video_stats (
+    {VideoStats.VIDEO_ID} INTEGER NOT NULL,
+    {VideoStats.DAY} INTEGER NOT NULL,
+    {VideoStats.VIEWS} INTEGER NOT NULL,
+    PRIMARY KEY ({VideoStats.VIDEO_ID}, {VideoStats.DAY}),
+    FOREIGN KEY ({VideoStats.VIDEO_ID}) REFERENCES video ({Video.ID})
+) WITHOUT ROWID''')
+    cur.execute(f'''
+INSERT OR IGNORE INTO video_stats (
+    {VideoStats.VIDEO_ID}, {VideoStats.DAY}, {VideoStats.VIEWS})
+SELECT video.{Video.ID},
+    CAST(strftime('%s', artist.{Artist.UPDATED}) AS INTEGER) / 86400,
+    video.{Video.VIEWS}
+FROM video JOIN artist ON artist.{Artist.ID} = video.{Video.ARTIST_ID}''')
+
+
+def add_rate_limit_table(cur):
+    """Add the rate_limit table, which holds a token bucket per endpoint."""
+    cur.execute(f'''
+CREATE TABLE IF NOT EXISTS rate_limit (
+    {RateLimit.ENDPOINT} TEXT PRIMARY KEY,
+    {RateLimit.TOKENS} REAL NOT NULL,
+    {RateLimit.RATE} REAL NOT NULL,
+    {RateLimit.UPDATED} REAL NOT NULL,
+    {RateLimit.DECREASED} REAL NOT NULL
+)''')
+
+
+def add_channel_cache(cur):
+    """Add the channel_cache table, of channels found by searching youtube."""
+    cur.execute(f'''
+CREATE TABLE IF NOT EXISTS channel_cache (
+    {ChannelCache.QUERY} TEXT PRIMARY KEY,
+    {ChannelCache.YOUTUBE} TEXT NOT NULL,
+    {ChannelCache.UPDATED} TEXT NOT NULL
+) WITHOUT ROWID''')
+
+
+def add_comment_search(cur):
+    """
+    Add a full text search index of comment content.
+
+    The index is kept in sync with the comment table by triggers, and
+    existing comments are indexed.
+    """
+    # the index stores only the terms, content is read from the comment table
+    cur.execute(f'''
+CREATE VIRTUAL TABLE IF NOT EXISTS comment_fts USING fts5(
+    {Comment.CONTENT},
+    content='comment',
+    content_rowid='{Comment.ID}',
+    tokenize='unicode61 remove_diacritics 2'
+)''')
+    cur.execute(f'''
+CREATE TRIGGER IF NOT EXISTS comment_fts_insert AFTER INSERT ON comment BEGIN
+    INSERT INTO comment_fts (rowid, {Comment.CONTENT})
+    VALUES (new.{Comment.ID}, new.{Comment.CONTENT});
+END''')
+    cur.execute(f'''
+CREATE TRIGGER IF NOT EXISTS comment_fts_delete AFTER DELETE ON comment BEGIN
+    INSERT INTO comment_fts (comment_fts, rowid, {Comment.CONTENT})
+    VALUES ('delete', old.{Comment.ID}, old.{Comment.CONTENT});
+END''')
+    cur.execute(f'''
+CREATE TRIGGER IF NOT EXISTS comment_fts_update
+AFTER UPDATE OF {Comment.CONTENT} ON comment BEGIN
+    INSERT INTO comment_fts (comment_fts, rowid, {Comment.CONTENT})
+    VALUES ('delete', old.{Comment.ID}, old.{Comment.CONTENT});
+    INSERT INTO comment_fts (rowid, {Comment.CONTENT})
+    VALUES (new.{Comment.ID}, new.{Comment.CONTENT});
+END''')
+    rebuild_comment_search(cur)
+
+
+def rebuild_comment_search(cur):
+    """Rebuild the full text search index from every comment."""
+    cur.execute("INSERT INTO comment_fts (comment_fts) VALUES ('rebuild')")
+    # merge the index into as few segments as possible, for faster queries
+    cur.execute("INSERT INTO comment_fts (comment_fts) VALUES ('optimize')")
+
+
+def add_word_counts(cur):
+    """Add the word_count table, of word counts by artist and language."""
+    cur.execute(f'''
+CREATE TABLE IF NOT EXISTS word_count (
+    {WordCount.ARTIST_ID} INTEGER NOT NULL,
+    {WordCount.LANGUAGE} TEXT NOT NULL,
+    {WordCount.WORD} TEXT NOT NULL,
+    {WordCount.COUNT} INTEGER NOT NULL,
+    PRIMARY KEY ({WordCount.ARTIST_ID}, {WordCount.LANGUAGE}, {WordCount.WORD})
+) WITHOUT ROWID''')
+    # for counting the artists using a word, in tf-idf
+    cur.execute(f'''CREATE INDEX IF NOT EXISTS word_count_language_word
+                   ON word_count ({WordCount.LANGUAGE}, {WordCount.WORD})''')
+    rebuild_word_counts(cur)
+
+
+def rebuild_word_counts(cur, batch_size=10_000):
+    """Recount the words of every comment, returning the number counted."""
+    cur.execute('DELETE FROM word_count')
+    read_cur = cur.connection.cursor()
+    last_id = 0
+    n_counted = 0
+    while True:
+        read_cur.execute(
+            f'''SELECT {Comment.ID}, {Comment.VIDEO_ID}, {Comment.CONTENT},
+                {Comment.LANGUAGE} FROM comment
+               WHERE {Comment.ID} > ?
+               ORDER BY {Comment.ID} LIMIT ?''',
+            (last_id, batch_size))
+        rows = read_cur.fetchall()
+        if len(rows) == 0:
+            break
+        WordCount.add_many(cur, count_words(row[1:] for row in rows))
+        last_id = rows[-1][0]
+        n_counted += len(rows)
+        log.debug('Counted words in %d comments', n_counted)
+    return n_counted
+
+
+def add_comment_metadata(cur):
+    """
+    Add comments' youtube id, author, like and reply counts and publish time.
+
+    These are all null for comments scraped before they were recorded.
+    Youtube's comment id is unique per video, so a refresh can tell which
+    comments it already has without comparing content.
+    """
+    for column, column_type in [(Comment.YOUTUBE_ID, 'TEXT'),
+                                (Comment.AUTHOR, 'TEXT'),
+                                (Comment.LIKES, 'INTEGER'),
+                                (Comment.PUBLISHED, 'INTEGER'),
+                                (Comment.REPLIES, 'INTEGER')]:
+        cur.execute(f'ALTER TABLE comment ADD COLUMN {column} {column_type}')
+    cur.execute(f'''CREATE UNIQUE INDEX IF NOT EXISTS comment_video_youtube_id
+                   ON comment ({Comment.VIDEO_ID}, {Comment.YOUTUBE_ID})''')
+    # for a video's most liked comments
+    cur.execute(f'''CREATE INDEX IF NOT EXISTS comment_video_likes
+                   ON comment ({Comment.VIDEO_ID}, {Comment.LIKES})''')
+
+
+def add_screenshot_table(cur):
+    """Add the screenshot table, of the last screenshot of each channel."""
+    cur.execute(f'''
+CREATE TABLE IF NOT EXISTS screenshot (
+    {Screenshot.ARTIST_ID} INTEGER PRIMARY KEY,
+    {Screenshot.YOUTUBE} TEXT NOT NULL,
+    {Screenshot.PHASH} INTEGER NOT NULL,
+    {Screenshot.PATH} TEXT NOT NULL,
+    {Screenshot.UPDATED} TEXT NOT NULL,
+    FOREIGN KEY ({Screenshot.ARTIST_ID}) REFERENCES artist ({Artist.ID})
+)''')
+
+
+def add_partial_content_hash_key(cur):
+    """
+    Only keep content hashes unique for comments without a youtube id.
+
+    This way comments with the same text but different ids are all saved.
+    """
+    cur.execute('DROP INDEX comment_video_content_hash')
+    cur.execute(f'''CREATE UNIQUE INDEX comment_video_content_hash
+                   ON comment ({Comment.VIDEO_ID}, {Comment.CONTENT_HASH})
+                   WHERE {Comment.YOUTUBE_ID} IS NULL''')
+
+
+# changes to the schema of an existing database, in order, tracked by the
+# database's user_version
+MIGRATIONS = [
+    add_indexes,
+    rehash_comments,
+    add_schedule_indexes,
+    add_job_table,
+    add_video_stats,
+    add_rate_limit_table,
+    add_channel_cache,
+    add_comment_search,
+    add_word_counts,
+    add_comment_metadata,
+    add_screenshot_table,
+    add_partial_content_hash_key,
+]
+
+
+@contextmanager
+def transaction(con):
+    """
+    Run a block as one transaction, rolled back if the block raises.
+
+    Python's sqlite3 only begins transactions before inserts and updates, so
+    schema changes like dropping an index are otherwise committed on their
+    own. The connection is put in autocommit mode for the block, and the
+    transaction is begun and committed explicitly. It is begun immediately,
+    taking the write lock up front.
+    """
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+    try:
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+        con.execute('COMMIT')
+    finally:
+        con.isolation_level = isolation_level
+
+
+def migrate(con):
+    """Apply any migrations the database hasn't had yet."""
+    cur = con.cursor()
+    # take the write lock first, so only one connection migrates, and roll
+    # back every migration if one fails
+    with transaction(con):
+        cur.execute('PRAGMA user_version')
+        version = cur.fetchone()[0]
+        for n, migration in enumerate(MIGRATIONS[version:],
+                                      start=version + 1):
+            log.info('Migrating database to version %d (%s)',
+                     n, migration.__name__)
+            migration(cur)
+        cur.execute('PRAGMA user_version = %d' % len(MIGRATIONS))
+
+
 def get_db(db_path):
     """Get a connection to the database, creating it if necessary."""
-    con = sqlite3.connect(db_path)
+    con = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT)
     cur = con.cursor()
+    # WAL lets workers read while another connection writes, and only syncs
+    # to disk at checkpoints rather than every commit
+    cur.execute('PRAGMA journal_mode = WAL')
+    cur.execute('PRAGMA synchronous = NORMAL')
+    cur.execute('PRAGMA busy_timeout = %d' % (BUSY_TIMEOUT * 1000))
     schema = generate_schema()
     cur.executescript(schema)
     con.commit()
+    migrate(con)
     log.debug('Connected to database at %s', db_path)
     return con, cur
 
 
+def is_stale(updated_at, max_age_days=STALE_AFTER_DAYS):
+    """Check if an updated_at value from the database is older than max age."""
+    updated = datetime.strptime(updated_at, DATETIME_FORMAT)
+    return datetime.utcnow() - updated > timedelta(days=max_age_days)
+
+
 class Artist:
     """Methods for interacting with the artist table."""
 
@@ -56,47 +515,44 @@ class Artist:
     YOUTUBE = 'youtube_url'
     UPDATED = 'updated_at'
 
-    def sql_result_to_df(db_items):
-        """Convert a SQL result to a pandas DataFrame."""
-        df = pd.DataFrame(db_items, columns=[
-            Artist.ID,
-            Artist.NAME,
-            Artist.SPOTIFY,
-            Artist.YOUTUBE,
-            Artist.UPDATED
-        ])
-        df.set_index(Artist.ID, inplace=True)
-        return df
+    COLUMNS = [ID, NAME, SPOTIFY, YOUTUBE, UPDATED]
+    Row = namedtuple('ArtistRow', COLUMNS)
+    SELECT = 'SELECT %s FROM artist' % ', '.join(COLUMNS)
 
     def get_all(cur):
-        """Get all artists from the database."""
-        cur.execute(' SELECT * FROM artist')
-        return Artist.sql_result_to_df(cur.fetchall())
+        """Get all artists from the database, as a stream of rows."""
+        cur.execute(Artist.SELECT)
+        return map(Artist.Row._make, cur)
 
     def get_by_id(cur, artist_id):
         """Get an artist by their ID."""
         cur.execute(
-            f'SELECT * FROM artist WHERE {Artist.ID} = ?', (artist_id,))
-        artists = Artist.sql_result_to_df(cur.fetchall())
-        if artists.shape[0] == 0:
+            f'{Artist.SELECT} WHERE {Artist.ID} = ?', (artist_id,))
+        row = cur.fetchone()
+        if row is None:
             log.debug('No artist found with id:%s', artist_id)
             return None
-        return artists.iloc[0]
+        return Artist.Row._make(row)
 
     def get_by_spotify(cur, spotify_uri):
         """Get artists by their Spotify URI."""
         cur.execute(
-            f'SELECT * FROM artist WHERE {Artist.SPOTIFY} = ?',
+            f'{Artist.SELECT} WHERE {Artist.SPOTIFY} = ?',
             (spotify_uri,))
+        return [Artist.Row._make(row) for row in cur.fetchall()]
 
-        return Artist.sql_result_to_df(cur.fetchall())
+    def get_ids_by_spotify(cur):
+        """Get a dict of every artist's id by their Spotify URI."""
+        # only reads the spotify_uri index, which includes the id
+        cur.execute(f'SELECT {Artist.SPOTIFY}, {Artist.ID} FROM artist')
+        return dict(cur.fetchall())
 
     def get_by_youtube(cur, youtube_channel):
         """Get artists by their YouTube channel."""
         cur.execute(
-            f'SELECT * FROM artist WHERE {Artist.YOUTUBE} = ?',
+            f'{Artist.SELECT} WHERE {Artist.YOUTUBE} = ?',
             (youtube_channel,))
-        return Artist.sql_result_to_df(cur.fetchall())
+        return [Artist.Row._make(row) for row in cur.fetchall()]
 
     def save(cur, name, spotify_uri, youtube_url):
         """Save an artist to the database."""
@@ -143,38 +599,44 @@ class Video:
     VIEWS = 'views'
     UPDATED = 'updated_at'
 
-    def sql_result_to_df(db_items):
-        """Convert a SQL result to a pandas DataFrame."""
-        df = pd.DataFrame(db_items, columns=[
-            Video.ID,
-            Video.ARTIST_ID,
-            Video.TITLE,
-            Video.YOUTUBE,
-            Video.VIEWS,
-            Video.UPDATED
-        ])
-        df.set_index(Video.ID, inplace=True)
-        return df
+    COLUMNS = [ID, ARTIST_ID, TITLE, YOUTUBE, VIEWS, UPDATED]
+    Row = namedtuple('VideoRow', COLUMNS)
+    SELECT = 'SELECT %s FROM video' % ', '.join(COLUMNS)
 
     def get_by_id(cur, video_id):
         """Get a video by its ID."""
         cur.execute(
-            f'SELECT * FROM video WHERE {Video.ID} = ?', (video_id,))
-        videos = Video.sql_result_to_df(cur.fetchall())
-        if videos.shape[0] == 0:
+            f'{Video.SELECT} WHERE {Video.ID} = ?', (video_id,))
+        row = cur.fetchone()
+        if row is None:
             return None
-        return videos.iloc[0]
+        return Video.Row._make(row)
 
     def get_by_artist(cur, artist_id):
         """Get videos by their artist."""
         cur.execute(f'''
-    SELECT * FROM video
+    {Video.SELECT}
     WHERE {Video.ARTIST_ID} = ?''',
                     (artist_id,))
-        return Video.sql_result_to_df(cur.fetchall())
+        return [Video.Row._make(row) for row in cur.fetchall()]
+
+    def get_urls_by_artist(cur, artist_id):
+        """Get the set of youtube urls for an artist's videos."""
+        cur.execute(
+            f'''SELECT {Video.YOUTUBE} FROM video
+               WHERE {Video.ARTIST_ID} = ?''',
+            (artist_id,))
+        return {row[0] for row in cur.fetchall()}
+
+    def save_many(cur, videos):
+        """
+        Save many videos, updating the views of existing videos.
 
-    def save_many(cur, videos_df):
-        """Save many videos to the database."""
+        A snapshot of each video's views is recorded in video_stats.
+        `videos` is an iterable of (artist_id, title, youtube_url, views).
+        """
+        videos = list(videos)
+        # updated_at tracks when comments were scraped, so is left alone
         cur.executemany(
             f'''INSERT INTO video (
                 {Video.ARTIST_ID},
@@ -182,11 +644,16 @@ class Video:
                 {Video.YOUTUBE},
                 {Video.VIEWS},
                 {Video.UPDATED})
-            VALUES (?, ?, ?, ?, datetime('2001-01-01'))''',
-            videos_df[[Video.ARTIST_ID, Video.TITLE,
-                       Video.YOUTUBE, Video.VIEWS]].itertuples(index=False)
+            VALUES (?, ?, ?, ?, datetime('2001-01-01'))
+            ON CONFLICT ({Video.ARTIST_ID}, {Video.YOUTUBE}) DO UPDATE SET
+                {Video.TITLE} = excluded.{Video.TITLE},
+                {Video.VIEWS} = excluded.{Video.VIEWS}
+            WHERE {Video.VIEWS} != excluded.{Video.VIEWS}
+                OR {Video.TITLE} != excluded.{Video.TITLE}''',
+            videos
         )
-        log.debug('Saved %s videos', videos_df.shape[0])
+        log.debug('Saved %s new or changed videos', cur.rowcount)
+        VideoStats.save_many(cur, videos)
 
     def set_updated(cur, video_id):
         """Set the updated_at field for a video."""
@@ -199,6 +666,56 @@ class Video:
         log.debug('Set updated_at for video id:%s to now', video_id)
 
 
+class VideoStats:
+    """
+    Methods for interacting with the video_stats table.
+
+    The table holds a snapshot of a video's views for each day it was
+    scraped. Days are counted from the unix epoch, so each row is three
+    integers, clustered by video.
+    """
+
+    VIDEO_ID = 'video_id'
+    DAY = 'day'
+    VIEWS = 'views'
+
+    COLUMNS = [VIDEO_ID, DAY, VIEWS]
+    Row = namedtuple('VideoStatsRow', COLUMNS)
+    SELECT = 'SELECT %s FROM video_stats' % ', '.join(COLUMNS)
+
+    def today():
+        """Get the number of days since the unix epoch."""
+        return int(time.time() // 86_400)
+
+    def get_by_video(cur, video_id):
+        """Get the history of a video's views, oldest first."""
+        cur.execute(
+            f'''{VideoStats.SELECT} WHERE {VideoStats.VIDEO_ID} = ?
+               ORDER BY {VideoStats.DAY}''',
+            (video_id,))
+        return [VideoStats.Row._make(row) for row in cur.fetchall()]
+
+    def save_many(cur, videos):
+        """
+        Save today's views for many videos, replacing any from earlier today.
+
+        `videos` is an iterable of (artist_id, title, youtube_url, views).
+        """
+        today = VideoStats.today()
+        # looks up each video by the (artist_id, youtube_url) unique key
+        cur.executemany(
+            f'''INSERT INTO video_stats (
+                {VideoStats.VIDEO_ID}, {VideoStats.DAY}, {VideoStats.VIEWS})
+            SELECT {Video.ID}, ?, ? FROM video
+            WHERE {Video.ARTIST_ID} = ? AND {Video.YOUTUBE} = ?
+            ON CONFLICT ({VideoStats.VIDEO_ID}, {VideoStats.DAY}) DO UPDATE
+            SET {VideoStats.VIEWS} = excluded.{VideoStats.VIEWS}''',
+            ((today, views, artist_id, url)
+             for artist_id, _, url, views in videos)
+        )
+        log.debug('Saved views for %s videos', cur.rowcount)
+
+
 class Comment:
     """Methods for interacting with the comment table."""
 
@@ -207,54 +724,700 @@ class Comment:
     CONTENT = 'content'
     LANGUAGE = 'language'
     UPDATED = 'updated_at'
+    CONTENT_HASH = 'content_hash'
+    YOUTUBE_ID = 'youtube_id'
+    AUTHOR = 'author'
+    LIKES = 'likes'
+    PUBLISHED = 'published_at'
+    REPLIES = 'replies'
 
-    def sql_result_to_df(db_items):
-        """Convert a SQL result to a pandas DataFrame."""
-        df = pd.DataFrame(db_items, columns=[
-            Comment.ID,
-            Comment.VIDEO_ID,
-            Comment.CONTENT,
-            Comment.LANGUAGE,
-            Comment.UPDATED
-        ])
-        df.set_index(Comment.ID, inplace=True)
-        return df
+    COLUMNS = [ID, VIDEO_ID, CONTENT, LANGUAGE, UPDATED, CONTENT_HASH,
+               YOUTUBE_ID, AUTHOR, LIKES, PUBLISHED, REPLIES]
+    Row = namedtuple('CommentRow', COLUMNS)
+    SELECT = 'SELECT %s FROM comment' % ', '.join(COLUMNS)
 
     def get_all(cur):
-        """Get all comments from the database."""
-        cur.execute('SELECT * FROM comment')
-        return Comment.sql_result_to_df(cur.fetchall())
+        """Get all comments from the database, as a stream of rows."""
+        cur.execute(Comment.SELECT)
+        return map(Comment.Row._make, cur)
 
     def get_by_artist(cur, artist_id):
         """Get comments by their artist."""
         cur.execute(f'''SELECT
-                    comment.{Comment.ID},
-                    {Comment.VIDEO_ID},
-                    {Comment.CONTENT},
-                    {Comment.LANGUAGE},
-                    comment.{Comment.UPDATED} FROM comment
+                    {', '.join('comment.' + c for c in Comment.COLUMNS)}
+                    FROM comment
                     LEFT JOIN video ON
                         comment.{Comment.VIDEO_ID} = video.{Video.ID}
                     WHERE video.{Video.ARTIST_ID} = ? LIMIT 1000''',
                     (artist_id,))
-        return Comment.sql_result_to_df(cur.fetchall())
+        return [Comment.Row._make(row) for row in cur.fetchall()]
 
     def get_by_video(cur, video_id):
         """Get comments by their video."""
-        cur.execute(f''' SELECT * FROM comment WHERE {Comment.VIDEO_ID} = ?''',
+        cur.execute(f'{Comment.SELECT} WHERE {Comment.VIDEO_ID} = ?',
                     (video_id,))
-        return Comment.sql_result_to_df(cur.fetchall())
+        return [Comment.Row._make(row) for row in cur.fetchall()]
+
+    def search(cur, query, artist_id=None, video_id=None, language=None,
+               after_id=0, page_size=100):
+        """
+        Search comments' content with a full text query.
+
+        Results can be filtered by artist, video and language. `query` is an
+        FTS5 query, see `search_query` to build one from text. Results are
+        paged in id order, pass the id of the last comment of a page as
+        `after_id` to get the next page.
+        """
+        filters = []
+        params = [query, after_id]
+        if artist_id is not None:
+            filters.append(f'video.{Video.ARTIST_ID} = ?')
+            params.append(artist_id)
+        if video_id is not None:
+            filters.append(f'comment.{Comment.VIDEO_ID} = ?')
+            params.append(video_id)
+        if language is not None:
+            filters.append(f'comment.{Comment.LANGUAGE} = ?')
+            params.append(language)
+        # only join videos when filtering by artist
+        join = (f'JOIN video ON video.{Video.ID} = comment.{Comment.VIDEO_ID}'
+                if artist_id is not None else '')
+        where = ''.join(' AND %s' % f for f in filters)
+        cur.execute(f'''SELECT
+                    {', '.join('comment.' + c for c in Comment.COLUMNS)}
+                    FROM comment_fts
+                    JOIN comment ON comment.{Comment.ID} = comment_fts.rowid
+                    {join}
+                    WHERE comment_fts MATCH ? AND comment_fts.rowid > ?
+                    {where}
+                    ORDER BY comment_fts.rowid LIMIT ?''',
+                    (*params, page_size))
+        return [Comment.Row._make(row) for row in cur.fetchall()]
 
-    def save_many(cur, comments_df):
-        """Save many comments to the database."""
+    def get_hashes_by_video(cur, video_id):
+        """
+        Get the set of content hashes for a video's comments without an id.
+
+        Comments without a youtube id are told apart by their content.
+        """
+        cur.execute(
+            f'''SELECT {Comment.CONTENT_HASH} FROM comment
+               WHERE {Comment.VIDEO_ID} = ?
+               AND {Comment.YOUTUBE_ID} IS NULL''',
+            (video_id,))
+        return {row[0] for row in cur.fetchall()}
+
+    def get_youtube_ids_by_video(cur, video_id):
+        """Get the set of youtube's ids for a video's comments."""
+        cur.execute(
+            f'''SELECT {Comment.YOUTUBE_ID} FROM comment
+               WHERE {Comment.VIDEO_ID} = ?
+               AND {Comment.YOUTUBE_ID} IS NOT NULL''',
+            (video_id,))
+        return {row[0] for row in cur.fetchall()}
+
+    def get_top_by_likes(cur, video_id, k):
+        """Get a video's k most liked comments."""
+        cur.execute(f'''{Comment.SELECT} WHERE {Comment.VIDEO_ID} = ?
+                       ORDER BY {Comment.LIKES} DESC LIMIT ?''',
+                    (video_id, k))
+        return [Comment.Row._make(row) for row in cur.fetchall()]
+
+    def update_counts_many(cur, comments):
+        """
+        Update the like and reply counts of comments already saved.
+
+        The time they were updated is set if either count changed.
+
+        `comments` is an iterable of (likes, replies, video_id, youtube_id).
+        """
         cur.executemany(
-            f'''INSERT INTO comment (
-                {Comment.VIDEO_ID},
-                {Comment.CONTENT},
-                {Comment.LANGUAGE},
-                {Comment.UPDATED})
-            VALUES (?, ?, ?, datetime('2001-01-01'))''',
-            comments_df[[Comment.VIDEO_ID, Comment.CONTENT, Comment.LANGUAGE]
-                        ].itertuples(index=False)
+            f'''UPDATE comment
+               SET {Comment.LIKES} = ?1, {Comment.REPLIES} = ?2,
+                   {Comment.UPDATED} = datetime('now')
+               WHERE {Comment.VIDEO_ID} = ?3 AND {Comment.YOUTUBE_ID} = ?4
+               AND ({Comment.LIKES} IS NOT ?1
+                    OR {Comment.REPLIES} IS NOT ?2)''',
+            comments)
+
+    # rows inserted by each statement of save_many, within sqlite's limit
+    # on the number of parameters
+    INSERT_BATCH = 500
+
+    def save_many(cur, comments):
+        """
+        Save many comments to the database, skipping existing comments.
+
+        The words of new comments are added to the word counts. `comments`
+        is an iterable of (video_id, content, language, hash, youtube_id,
+        author, likes, published_at, replies).
+        """
+        comments = list(comments)
+        counts = Counter()
+        n_saved = 0
+        for start in range(0, len(comments), Comment.INSERT_BATCH):
+            batch = comments[start:start + Comment.INSERT_BATCH]
+            values = ', '.join(
+                ["(?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))"]
+                * len(batch))
+            # only comments that weren't already saved are returned, so
+            # scraping a video again doesn't count its words twice
+            cur.execute(
+                f'''INSERT INTO comment (
+                    {Comment.VIDEO_ID},
+                    {Comment.CONTENT},
+                    {Comment.LANGUAGE},
+                    {Comment.CONTENT_HASH},
+                    {Comment.YOUTUBE_ID},
+                    {Comment.AUTHOR},
+                    {Comment.LIKES},
+                    {Comment.PUBLISHED},
+                    {Comment.REPLIES},
+                    {Comment.UPDATED})
+                VALUES {values}
+                ON CONFLICT DO NOTHING
+                RETURNING {Comment.VIDEO_ID}, {Comment.CONTENT},
+                    {Comment.LANGUAGE}''',
+                [value for comment in batch for value in comment])
+            saved = cur.fetchall()
+            counts.update(count_words(saved))
+            n_saved += len(saved)
+        WordCount.add_many(cur, counts)
+        log.debug('Saved %s new comments', n_saved)
+
+
+class WordCount:
+    """
+    Methods for interacting with the word_count table.
+
+    Counts are kept up to date as comments are saved, so word frequencies
+    are read from here rather than by tokenizing every comment again.
+    """
+
+    ARTIST_ID = 'artist_id'
+    LANGUAGE = 'language'
+    WORD = 'word'
+    COUNT = 'count'
+
+    def add_many(cur, counts):
+        """Add a Counter of (video_id, language, word) to the word counts."""
+        cur.executemany(
+            f'''INSERT INTO word_count (
+                {WordCount.ARTIST_ID},
+                {WordCount.LANGUAGE},
+                {WordCount.WORD},
+                {WordCount.COUNT})
+            SELECT {Video.ARTIST_ID}, ?, ?, ? FROM video WHERE {Video.ID} = ?
+            ON CONFLICT DO UPDATE SET {WordCount.COUNT} =
+                {WordCount.COUNT} + excluded.{WordCount.COUNT}''',
+            ((language, word, count, video_id)
+             for (video_id, language, word), count in counts.items()))
+
+    def remove_many(cur, counts):
+        """
+        Take a Counter of (video_id, language, word) off the word counts.
+
+        Words that are no longer used are removed.
+        """
+        key = f'''{WordCount.ARTIST_ID} = (
+                   SELECT {Video.ARTIST_ID} FROM video WHERE {Video.ID} = ?)
+               AND {WordCount.LANGUAGE} = ? AND {WordCount.WORD} = ?'''
+        cur.executemany(
+            f'''UPDATE word_count SET {WordCount.COUNT} = {WordCount.COUNT} - ?
+               WHERE {key}''',
+            ((count, video_id, language, word)
+             for (video_id, language, word), count in counts.items()))
+        cur.executemany(
+            f'''DELETE FROM word_count
+               WHERE {key} AND {WordCount.COUNT} <= 0''',
+            counts.keys())
+
+    def get_top(cur, artist_id, language, k):
+        """Get an artist's k most used words in a language, with counts."""
+        cur.execute(
+            f'''SELECT {WordCount.WORD}, {WordCount.COUNT} FROM word_count
+               WHERE {WordCount.ARTIST_ID} = ? AND {WordCount.LANGUAGE} = ?
+               ORDER BY {WordCount.COUNT} DESC, {WordCount.WORD} LIMIT ?''',
+            (artist_id, language, k))
+        return cur.fetchall()
+
+    def get_top_tfidf(cur, artist_id, language, k):
+        """
+        Get the k words most distinctive of an artist in a language.
+
+        Words are returned with their tf-idf scores. Each artist's comments
+        are treated as one document, so words used for many artists score
+        lower than words used for few.
+        """
+        cur.execute(
+            f'''SELECT COUNT(DISTINCT {WordCount.ARTIST_ID}) FROM word_count
+               WHERE {WordCount.LANGUAGE} = ?''',
+            (language,))
+        n_artists = cur.fetchone()[0]
+        cur.execute(
+            f'''SELECT word.{WordCount.WORD}, word.{WordCount.COUNT},
+                (SELECT COUNT(*) FROM word_count AS other
+                 WHERE other.{WordCount.LANGUAGE} = word.{WordCount.LANGUAGE}
+                 AND other.{WordCount.WORD} = word.{WordCount.WORD})
+               FROM word_count AS word
+               WHERE word.{WordCount.ARTIST_ID} = ?
+               AND word.{WordCount.LANGUAGE} = ?''',
+            (artist_id, language))
+        rows = cur.fetchall()
+        total = sum(count for _, count, _ in rows)
+        scores = ((word, count / total * math.log(n_artists / n_using))
+                  for word, count, n_using in rows)
+        return heapq.nlargest(k, scores, key=lambda score: score[1])
+
+
+class Job:
+    """
+    Methods for interacting with the job table.
+
+    A job is one work item for a stage. Workers claim jobs with a lease, and
+    a job whose lease expires without being completed can be claimed again.
+    Times are unix epoch seconds.
+    """
+
+    ID = 'id'
+    STAGE = 'stage'
+    ITEM = 'item'
+    STATUS = 'status'
+    OWNER = 'owner'
+    LEASE_EXPIRES = 'lease_expires_at'
+    ATTEMPTS = 'attempts'
+    LAST_ERROR = 'last_error'
+    AVAILABLE = 'available_at'
+    UPDATED = 'updated_at'
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    Row = namedtuple('JobRow', [ID, ITEM, ATTEMPTS])
+
+    def enqueue_many(cur, stage, items):
+        """
+        Add jobs for items, which are stored as json.
+
+        Items that already have a finished job are queued again, items with a
+        pending or running job are left alone.
+        """
+        now = int(time.time())
+        cur.executemany(
+            f'''INSERT INTO job (
+                {Job.STAGE}, {Job.ITEM}, {Job.STATUS},
+                {Job.AVAILABLE}, {Job.UPDATED})
+            VALUES (?, ?, '{Job.PENDING}', ?, ?)
+            ON CONFLICT ({Job.STAGE}, {Job.ITEM}) DO UPDATE SET
+                {Job.STATUS} = '{Job.PENDING}',
+                {Job.ATTEMPTS} = 0,
+                {Job.LAST_ERROR} = NULL,
+                {Job.AVAILABLE} = excluded.{Job.AVAILABLE},
+                {Job.UPDATED} = excluded.{Job.UPDATED}
+            WHERE {Job.STATUS} IN ('{Job.DONE}', '{Job.FAILED}')''',
+            ((stage, json.dumps(item), now, now) for item in items)
         )
-        log.debug('Saved %s comments', comments_df.shape[0])
+        log.debug('Enqueued %d %s jobs', cur.rowcount, stage)
+
+    def claim(cur, stage, owner, n, lease_seconds, max_attempts):
+        """
+        Claim up to n jobs for a stage, returning them as rows.
+
+        Pending jobs and running jobs whose lease has expired can be claimed.
+        The claim is a single statement, so concurrent workers always get
+        disjoint jobs. Expired jobs that have been attempted max_attempts
+        times are marked as failed instead, as their item may be what killed
+        or wedged the workers holding them.
+        """
+        now = int(time.time())
+        cur.execute(
+            f'''UPDATE job SET {Job.STATUS} = '{Job.FAILED}',
+               {Job.LAST_ERROR} = 'Lease expired', {Job.UPDATED} = ?
+               WHERE {Job.STAGE} = ? AND {Job.STATUS} = '{Job.RUNNING}'
+               AND {Job.LEASE_EXPIRES} < ? AND {Job.ATTEMPTS} >= ?''',
+            (now, stage, now, max_attempts))
+        if cur.rowcount > 0:
+            log.warning('%d %s jobs failed after their lease expired on '
+                        'their last attempt', cur.rowcount, stage)
+        cur.execute(
+            f'''UPDATE job SET
+                {Job.STATUS} = '{Job.RUNNING}',
+                {Job.OWNER} = ?,
+                {Job.LEASE_EXPIRES} = ?,
+                {Job.ATTEMPTS} = {Job.ATTEMPTS} + 1,
+                {Job.UPDATED} = ?
+            WHERE {Job.ID} IN (
+                SELECT {Job.ID} FROM job
+                WHERE {Job.STAGE} = ? AND (
+                    ({Job.STATUS} = '{Job.PENDING}' AND {Job.AVAILABLE} <= ?)
+                    OR ({Job.STATUS} = '{Job.RUNNING}'
+                        AND {Job.LEASE_EXPIRES} < ?))
+                ORDER BY {Job.AVAILABLE} LIMIT ?)
+            RETURNING {Job.ID}, {Job.ITEM}, {Job.ATTEMPTS}''',
+            (owner, now + lease_seconds, now, stage, now, now, n))
+        jobs = [Job.Row(job_id, json.loads(item), attempts)
+                for job_id, item, attempts in cur.fetchall()]
+        log.debug('%s claimed %d %s jobs', owner, len(jobs), stage)
+        return jobs
+
+    def heartbeat(cur, job_ids, owner, lease_seconds):
+        """Extend the lease on jobs still held by owner."""
+        now = int(time.time())
+        cur.executemany(
+            f'''UPDATE job SET {Job.LEASE_EXPIRES} = ?, {Job.UPDATED} = ?
+               WHERE {Job.ID} = ? AND {Job.OWNER} = ?
+               AND {Job.STATUS} = ?''',
+            ((now + lease_seconds, now, job_id, owner, Job.RUNNING)
+             for job_id in job_ids))
+
+    def complete(cur, job_id, owner):
+        """Mark a job held by owner as done."""
+        cur.execute(
+            f'''UPDATE job SET {Job.STATUS} = '{Job.DONE}',
+               {Job.LAST_ERROR} = NULL, {Job.UPDATED} = ?
+               WHERE {Job.ID} = ? AND {Job.OWNER} = ?''',
+            (int(time.time()), job_id, owner))
+
+    def fail(cur, job_id, owner, error, max_attempts, backoff_seconds):
+        """
+        Record a failed attempt at a job held by owner.
+
+        The job is retried after an exponential backoff with jitter, or marked
+        as failed once it has been attempted max_attempts times.
+        """
+        cur.execute(
+            f'SELECT {Job.ATTEMPTS} FROM job WHERE {Job.ID} = ?', (job_id,))
+        attempts = cur.fetchone()[0]
+        now = int(time.time())
+        if attempts >= max_attempts:
+            status = Job.FAILED
+            available = now
+        else:
+            status = Job.PENDING
+            delay = backoff_seconds * 2 ** (attempts - 1)
+            available = now + int(delay * random.uniform(0.5, 1.5))
+        cur.execute(
+            f'''UPDATE job SET {Job.STATUS} = ?, {Job.LAST_ERROR} = ?,
+               {Job.AVAILABLE} = ?, {Job.UPDATED} = ?
+               WHERE {Job.ID} = ? AND {Job.OWNER} = ?''',
+            (status, str(error), available, now, job_id, owner))
+        log.debug('Job %s failed on attempt %d, now %s',
+                  job_id, attempts, status)
+
+    def count_by_status(cur, stage):
+        """Count the jobs for a stage in each status."""
+        cur.execute(
+            f'''SELECT {Job.STATUS}, COUNT(*) FROM job
+               WHERE {Job.STAGE} = ? GROUP BY {Job.STATUS}''',
+            (stage,))
+        return dict(cur.fetchall())
+
+
+class RateLimit:
+    """
+    Methods for interacting with the rate_limit table.
+
+    Each endpoint has a token bucket shared by every process using the
+    database. Rates are in requests a second, and times are unix epoch
+    seconds.
+    """
+
+    ENDPOINT = 'endpoint'
+    TOKENS = 'tokens'
+    RATE = 'rate'
+    UPDATED = 'updated_at'
+    DECREASED = 'decreased_at'
+
+    def create(cur, endpoint, rate, burst):
+        """Add a full bucket for an endpoint, if it doesn't have one."""
+        cur.execute(
+            f'''INSERT INTO rate_limit (
+                {RateLimit.ENDPOINT}, {RateLimit.TOKENS}, {RateLimit.RATE},
+                {RateLimit.UPDATED}, {RateLimit.DECREASED})
+            VALUES (?, ?, ?, ?, 0)
+            ON CONFLICT ({RateLimit.ENDPOINT}) DO NOTHING''',
+            (endpoint, burst, rate, time.time()))
+
+    def take(cur, endpoint, burst):
+        """
+        Take a token from an endpoint's bucket, returning the seconds to wait.
+
+        The token should not be used until the wait is over. The bucket is
+        refilled and a token taken in one statement. Tokens can go negative,
+        which reserves them for callers in the order they arrived.
+        """
+        now = time.time()
+        cur.execute(
+            f'''UPDATE rate_limit SET
+                {RateLimit.TOKENS} = MIN(?, {RateLimit.TOKENS}
+                    + (? - {RateLimit.UPDATED}) * {RateLimit.RATE}) - 1,
+                {RateLimit.UPDATED} = ?
+            WHERE {RateLimit.ENDPOINT} = ?
+            RETURNING {RateLimit.TOKENS}, {RateLimit.RATE}''',
+            (burst, now, now, endpoint))
+        tokens, rate = cur.fetchone()
+        return max(0, -tokens / rate)
+
+    def increase(cur, endpoint, step, max_rate):
+        """Additively increase an endpoint's rate, after a success."""
+        cur.execute(
+            f'''UPDATE rate_limit
+               SET {RateLimit.RATE} = MIN(?, {RateLimit.RATE} + ?)
+               WHERE {RateLimit.ENDPOINT} = ?''',
+            (max_rate, step, endpoint))
+
+    def decrease(cur, endpoint, factor, min_rate, cooldown):
+        """
+        Multiplicatively decrease an endpoint's rate, after a failure.
+
+        The rate is decreased at most once per cooldown, so a burst of
+        failures from requests made at the same time only counts once.
+        """
+        now = time.time()
+        cur.execute(
+            f'''UPDATE rate_limit
+               SET {RateLimit.RATE} = MAX(?, {RateLimit.RATE} * ?),
+                   {RateLimit.DECREASED} = ?
+               WHERE {RateLimit.ENDPOINT} = ?
+               AND {RateLimit.DECREASED} < ?
+               RETURNING {RateLimit.RATE}''',
+            (min_rate, factor, now, endpoint, now - cooldown))
+        row = cur.fetchone()
+        return row and row[0]
+
+
+class ChannelCache:
+    """
+    Methods for interacting with the channel_cache table.
+
+    Channels are cached by the artist name they were searched for, so
+    artists sharing a name, or found again in another run, aren't searched
+    for twice.
+    """
+
+    QUERY = 'query'
+    YOUTUBE = 'youtube_url'
+    UPDATED = 'updated_at'
+
+    def get(cur, query, max_age_days):
+        """Get the channel cached for a query, if it isn't too old."""
+        cur.execute(
+            f'''SELECT {ChannelCache.YOUTUBE} FROM channel_cache
+               WHERE {ChannelCache.QUERY} = ?
+               AND {ChannelCache.UPDATED} > datetime('now', ?)''',
+            (query, '-%d days' % max_age_days))
+        row = cur.fetchone()
+        return row and row[0]
+
+    def get_all(cur, max_age_days):
+        """Get a dict of the channels cached for each query, if not too old."""
+        cur.execute(
+            f'''SELECT {ChannelCache.QUERY}, {ChannelCache.YOUTUBE}
+               FROM channel_cache
+               WHERE {ChannelCache.UPDATED} > datetime('now', ?)''',
+            ('-%d days' % max_age_days,))
+        return dict(cur.fetchall())
+
+    def save(cur, query, youtube_url):
+        """Cache the channel found for a query."""
+        cur.execute(
+            f'''INSERT INTO channel_cache (
+                {ChannelCache.QUERY},
+                {ChannelCache.YOUTUBE},
+                {ChannelCache.UPDATED})
+            VALUES (?, ?, datetime('now'))
+            ON CONFLICT ({ChannelCache.QUERY}) DO UPDATE SET
+                {ChannelCache.YOUTUBE} = excluded.{ChannelCache.YOUTUBE},
+                {ChannelCache.UPDATED} = excluded.{ChannelCache.UPDATED}''',
+            (query, youtube_url))
+
+
+class Screenshot:
+    """
+    Methods for interacting with the screenshot table.
+
+    The table holds the last screenshot saved for each artist's channel.
+    """
+
+    ARTIST_ID = 'artist_id'
+    YOUTUBE = 'youtube_url'
+    # perceptual hash of the screenshot, as a signed 64 bit integer
+    PHASH = 'phash'
+    PATH = 'path'
+    UPDATED = 'updated_at'
+
+    COLUMNS = [ARTIST_ID, YOUTUBE, PHASH, PATH, UPDATED]
+    Row = namedtuple('ScreenshotRow', COLUMNS)
+
+    def get(cur, artist_id):
+        """Get the last screenshot saved for an artist, or None."""
+        cur.execute(
+            f'''SELECT {', '.join(Screenshot.COLUMNS)} FROM screenshot
+               WHERE {Screenshot.ARTIST_ID} = ?''',
+            (artist_id,))
+        row = cur.fetchone()
+        return row and Screenshot.Row._make(row)
+
+    def save(cur, artist_id, youtube_url, phash, path):
+        """Record the screenshot of an artist's channel."""
+        cur.execute(
+            f'''INSERT INTO screenshot (
+                {Screenshot.ARTIST_ID},
+                {Screenshot.YOUTUBE},
+                {Screenshot.PHASH},
+                {Screenshot.PATH},
+                {Screenshot.UPDATED})
+            VALUES (?, ?, ?, ?, datetime('now'))
+            ON CONFLICT ({Screenshot.ARTIST_ID}) DO UPDATE SET
+                {Screenshot.YOUTUBE} = excluded.{Screenshot.YOUTUBE},
+                {Screenshot.PHASH} = excluded.{Screenshot.PHASH},
+                {Screenshot.PATH} = excluded.{Screenshot.PATH},
+                {Screenshot.UPDATED} = excluded.{Screenshot.UPDATED}''',
+            (artist_id, youtube_url, phash, path))
+
+
+# writes that can be handed to a writer, by name so they can be queued
+# between processes
+WRITE_OPS = {
+    'Artist.save': Artist.save,
+    'Artist.set_youtube': Artist.set_youtube,
+    'Artist.set_updated': Artist.set_updated,
+    'Video.save_many': Video.save_many,
+    'Video.set_updated': Video.set_updated,
+    'Comment.save_many': Comment.save_many,
+    'Comment.update_counts_many': Comment.update_counts_many,
+    'ChannelCache.save': ChannelCache.save,
+}
+
+
+def count_rows(args):
+    """Count the rows written by a write op, for throughput metrics."""
+    for arg in args:
+        if hasattr(arg, '__len__') and not isinstance(arg, str):
+            return len(arg)
+    return 1
+
+
+class DirectWriter:
+    """Write to the database immediately, committing on flush."""
+
+    def __init__(self, con):
+        self.con = con
+        self.cur = con.cursor()
+
+    def submit(self, op, *args):
+        """Run a write op."""
+        WRITE_OPS[op](self.cur, *args)
+
+    def flush(self):
+        """Commit all submitted writes."""
+        with metrics.timer('db_commit'):
+            self.con.commit()
+
+
+class QueueWriter:
+    """Hand writes to a writer running in another thread or process."""
+
+    def __init__(self, write_queue):
+        self.write_queue = write_queue
+
+    def submit(self, op, *args):
+        """Queue a write op, without waiting for it to be written."""
+        # generators can't be sent between processes
+        args = tuple(list(arg) if isinstance(arg, GeneratorType) else arg
+                     for arg in args)
+        self.write_queue.put((op, args))
+
+    def flush(self):
+        """Writes are committed by the writer in batches."""
+
+
+def write_batch(con, batch):
+    """
+    Write a batch of ops in one transaction.
+
+    If the batch fails, each op is retried in its own transaction so a single
+    bad op doesn't lose the rest of the batch. Ops that fail on their own,
+    whether in sqlite or from a bad row, are logged and dropped.
+    """
+    cur = con.cursor()
+    try:
+        for op, args in batch:
+            WRITE_OPS[op](cur, *args)
+        con.commit()
+        return
+    except Exception as e:
+        con.rollback()
+        log.debug('Error writing batch of %d ops, retrying individually: %s',
+                  len(batch), e)
+
+    for op, args in batch:
+        try:
+            WRITE_OPS[op](cur, *args)
+            con.commit()
+        except Exception as e:
+            con.rollback()
+            log.exception('Error writing %s, dropping it: %s', op, e)
+
+
+def run_writer(db_path, write_queue, max_batch=500, max_delay=1,
+               metrics_queue=None):
+    """
+    Write ops from a queue until a None sentinel is received.
+
+    Ops are grouped into one transaction for up to `max_batch` ops or
+    `max_delay` seconds, whichever comes first. If `metrics_queue` is given,
+    the writer's metrics are put on it when it finishes.
+    """
+    con = None
+    try:
+        con, _ = get_db(db_path)
+        log.info('Writer started for %s', db_path)
+        stopping = False
+        while not stopping:
+            item = write_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.time() + max_delay
+            while len(batch) < max_batch:
+                try:
+                    item = write_queue.get(
+                        timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            start = time.time()
+            n_rows = sum(count_rows(args) for _, args in batch)
+            with labels(stage='writer'):
+                with metrics.timer('db_commit'):
+                    write_batch(con, batch)
+                metrics.count('rows_written', n_rows)
+            duration = time.time() - start
+            log.info('Wrote %d ops (%d rows) in %.3fs, %.0f rows/s',
+                     len(batch), n_rows, duration,
+                     n_rows / duration if duration > 0 else n_rows)
+    finally:
+        # whatever happens, the run waiting for the writer's metrics isn't
+        # left hanging
+        if con is not None:
+            con.close()
+        log.info('Writer finished for %s', db_path)
+        if metrics_queue is not None:
+            metrics_queue.put(metrics.snapshot())
+
+
+def start_writer_thread(db_path, **kwargs):
+    """Start a writer in a background thread, returning it and its queue."""
+    write_queue = queue.Queue()
+    thread = threading.Thread(target=run_writer,
+                              args=(db_path, write_queue), kwargs=kwargs,
+                              daemon=True)
+    thread.start()
+    return thread, write_queue
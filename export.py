@@ -0,0 +1,218 @@
+"""
+Export tables to Parquet or Arrow IPC stream files, streaming rows in chunks.
+
+Rows are read from the database and written a chunk at a time, so memory use
+doesn't grow with the size of a table. Each export writes one file per table,
+named by when it was run, and with `--incremental` only rows added or updated
+since the table's last export are written, so a directory of exports can be
+read as one dataset. Rows updated between exports appear in more than one
+file, the one in the newest file is current.
+"""
+import argparse
+from datetime import datetime, timezone
+import glob
+import os
+from database import (DATETIME_FORMAT, Artist, Comment, Video, VideoStats,
+                      get_db)
+from logger import log
+
+# file extension for each format, arrow files are in the IPC stream format,
+# which unlike the random access format allows each chunk its own dictionary
+FORMATS = {'parquet': 'parquet', 'arrow': 'arrows'}
+TABLES = {'artist': Artist, 'video': Video, 'comment': Comment}
+CHUNK_SIZE = 100_000
+COMPRESSION = 'zstd'
+# columns with few distinct values, stored once per chunk and referenced
+DICTIONARY_COLUMNS = [Comment.LANGUAGE, Comment.VIDEO_ID, Video.ARTIST_ID]
+# file metadata holding the time rows were exported up to
+UNTIL_KEY = b'updated_until'
+# file metadata holding the largest id exported, as new artists and videos
+# are saved with an old updated_at so they are scraped first
+MAX_ID_KEY = b'max_id'
+# queries for the ids of rows changed since a unix day without their
+# updated_at changing, as video views are refreshed by each channel scrape
+CHANGED_SINCE_DAY = {
+    'video': f'''SELECT {VideoStats.VIDEO_ID} FROM video_stats
+                WHERE {VideoStats.DAY} >= ?''',
+}
+
+
+def get_schema(table):
+    """Get the arrow schema of a table's export."""
+    import pyarrow as pa
+    types = {
+        'id': pa.int64(),
+        'artist_id': pa.int64(),
+        'video_id': pa.int64(),
+        'views': pa.int64(),
+        'content_hash': pa.int64(),
+        'likes': pa.int64(),
+        'replies': pa.int64(),
+        'updated_at': pa.timestamp('s'),
+        # unix times, unlike updated_at
+        'published_at': pa.timestamp('s'),
+    }
+    fields = []
+    for column in table.COLUMNS:
+        field_type = types.get(column, pa.string())
+        if column in DICTIONARY_COLUMNS:
+            field_type = pa.dictionary(pa.int32(), field_type)
+        fields.append(pa.field(column, field_type))
+    return pa.schema(fields)
+
+
+def to_batch(rows, table, schema):
+    """Convert a chunk of rows to an arrow record batch."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    arrays = []
+    for column, values in zip(table.COLUMNS, zip(*rows)):
+        field = schema.field(column)
+        if column == table.UPDATED:
+            array = pc.strptime(pa.array(values, pa.string()),
+                                format=DATETIME_FORMAT, unit='s')
+        elif pa.types.is_dictionary(field.type):
+            array = pa.array(values, field.type.value_type).dictionary_encode()
+        else:
+            array = pa.array(values, field.type)
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def open_writer(path, schema, export_format):
+    """Open a compressed Parquet or Arrow IPC stream writer."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if export_format == 'parquet':
+        return pq.ParquetWriter(path, schema, compression=COMPRESSION,
+                                use_dictionary=[
+                                    column for column in schema.names
+                                    if column in DICTIONARY_COLUMNS])
+    options = pa.ipc.IpcWriteOptions(compression=COMPRESSION)
+    return pa.ipc.new_stream(path, schema, options=options)
+
+
+def to_day(since):
+    """Convert a UTC time from the database to days since the unix epoch."""
+    since = datetime.strptime(since, DATETIME_FORMAT)
+    return int(since.replace(tzinfo=timezone.utc).timestamp() // 86_400)
+
+
+def last_export(out_dir, name, export_format):
+    """
+    Get the time a table was last exported up to and the largest id exported.
+
+    Returns None if the table hasn't been exported.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    paths = sorted(glob.glob(os.path.join(
+        out_dir, '%s-*.%s' % (name, FORMATS[export_format]))))
+    if len(paths) == 0:
+        return None
+    if export_format == 'parquet':
+        metadata = pq.read_schema(paths[-1]).metadata
+    else:
+        with pa.memory_map(paths[-1]) as source:
+            metadata = pa.ipc.open_stream(source).schema.metadata
+    # files from before ids were recorded
+    max_id = metadata.get(MAX_ID_KEY)
+    return (metadata[UNTIL_KEY].decode(),
+            None if max_id is None else int(max_id))
+
+
+def export_table(cur, name, out_dir, export_format, since=None,
+                 after_id=None, chunk_size=CHUNK_SIZE):
+    """
+    Export the rows of a table, returning the path written and the row count.
+
+    Rows updated at or after `since`, or with an id after `after_id`, are
+    exported, or all rows if neither is given.
+    """
+    table = TABLES[name]
+    # rows are read from one snapshot, taken after this time, so rows
+    # changed while exporting are exported again by the next export rather
+    # than missed
+    until = datetime.utcnow().strftime(DATETIME_FORMAT)
+    cur.execute('BEGIN')
+    cur.execute(f'SELECT MAX({table.ID}) FROM {name}')
+    max_id = cur.fetchone()[0] or 0
+    schema = get_schema(table).with_metadata({
+        UNTIL_KEY: until.encode(), MAX_ID_KEY: str(max_id).encode()})
+    path = os.path.join(out_dir, '%s-%s.%s' % (
+        name, until.replace(' ', 'T').replace(':', ''),
+        FORMATS[export_format]))
+
+    changed = []
+    params = []
+    if since is not None:
+        changed.append(f'{table.UPDATED} >= ?')
+        params.append(since)
+        if name in CHANGED_SINCE_DAY:
+            changed.append(f'{table.ID} IN ({CHANGED_SINCE_DAY[name]})')
+            params.append(to_day(since))
+    if after_id is not None:
+        changed.append(f'{table.ID} > ?')
+        params.append(after_id)
+    query = table.SELECT
+    if len(changed) > 0:
+        query += ' WHERE ' + ' OR '.join(changed)
+    cur.execute(query, params)
+
+    n_rows = 0
+    # written to a temporary file first, so readers never see half a file
+    tmp_path = path + '.tmp'
+    with open_writer(tmp_path, schema, export_format) as writer:
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            writer.write_batch(to_batch(rows, table, schema))
+            n_rows += len(rows)
+            log.debug('Exported %d %s rows', n_rows, name)
+    cur.connection.commit()
+    os.replace(tmp_path, path)
+    log.info('Exported %d %s rows to %s', n_rows, name, path)
+    return path, n_rows
+
+
+def main(db_path, out_dir, tables, export_format, since, incremental):
+    """Export tables from the database to a directory."""
+    con, cur = get_db(db_path)
+    os.makedirs(out_dir, exist_ok=True)
+    for name in tables:
+        table_since = since
+        after_id = None
+        if incremental:
+            last = last_export(out_dir, name, export_format)
+            if last is not None:
+                last_until, after_id = last
+                table_since = table_since or last_until
+        export_table(cur, name, out_dir, export_format, table_since,
+                     after_id)
+    con.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tables', nargs='*',
+                        help='tables to export, defaults to all of %s'
+                        % ', '.join(TABLES))
+    parser.add_argument('--db-path', type=str)
+    parser.add_argument('--out-dir', type=str, default='datasets/export')
+    parser.add_argument('--format', choices=FORMATS, default='parquet')
+    parser.add_argument('--since', type=str, default=None,
+                        help='only export rows updated at or after this '
+                        'UTC time, as YYYY-MM-DD HH:MM:SS')
+    parser.add_argument('--incremental',
+                        action=argparse.BooleanOptionalAction,
+                        help='only export rows added or updated since the '
+                        'last export in the output directory')
+
+    args = parser.parse_args()
+    for name in args.tables:
+        if name not in TABLES:
+            parser.error('unknown table %s' % name)
+
+    main(args.db_path, args.out_dir, args.tables or list(TABLES),
+         args.format, args.since, args.incremental)
@@ -0,0 +1,310 @@
+"""
+A local stand-in for youtube, serving synthetic channels and videos.
+
+Pages are generated for any size, so the scrapers can be run offline against
+channels with a known number of videos and videos with a known number of
+comments. Paths are:
+
+- `/@fake<n>/videos` a channel with n videos
+- `/watch?v=fake<n>` a video with n comments
+- `/results?search_query=fake<n>` a search with n videos in the artist sidebar
+- `/youtubei/v1/browse` and `/youtubei/v1/next` innertube continuations
+
+Channel and video pages work in a browser, loading more items as they are
+scrolled, and embed the same `ytInitialData` the innertube scraper reads.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+from urllib.parse import parse_qs, urlparse
+
+VIDEOS_PER_PAGE = 30
+COMMENTS_PER_PAGE = 20
+# milliseconds the browser pages take to load more items once scrolled
+LOAD_DELAY = 50
+
+API_KEY = 'fake-api-key'
+YTCFG = {
+    'INNERTUBE_API_KEY': API_KEY,
+    'INNERTUBE_CLIENT_VERSION': '2.20230101.00.00',
+}
+
+CHANNEL_RE = re.compile(r'^/@fake(\d+)/videos$')
+WATCH_RE = re.compile(r'^fake(\d+)$')
+SEARCH_RE = WATCH_RE
+
+PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head><title>Fake youtube</title></head>
+<body>
+%(header)s
+<div id="items"></div>
+<script>
+const total = %(total)d;
+const pageSize = %(page_size)d;
+const items = document.getElementById('items');
+let loaded = 0;
+let loading = false;
+
+function load() {
+    const holder = document.createElement('div');
+    for (let i = 0; i < pageSize && loaded < total; i++, loaded++) {
+        holder.innerHTML = render(loaded);
+        items.appendChild(holder.firstElementChild);
+    }
+    loading = false;
+}
+
+function render(n) {
+    %(render)s
+}
+
+window.addEventListener('scroll', () => {
+    const bottom = window.innerHeight + window.scrollY
+        >= document.documentElement.scrollHeight - 200;
+    if (bottom && !loading && loaded < total) {
+        loading = true;
+        setTimeout(load, %(delay)d);
+    }
+});
+load();
+</script>
+<script>var ytInitialData = %(initial_data)s;</script>
+<script>var ytcfg = {set() {}}; ytcfg.set(%(ytcfg)s);</script>
+</body>
+</html>
+'''
+
+CHANNEL_HEADER = '''
+<button aria-label="Reject all" onclick="this.remove()">Reject all</button>
+<div id="channel-name">Fake channel</div>
+'''
+RENDER_VIDEO = '''
+    return '<div id="content" class="ytd-rich-item-renderer" '
+        + 'style="height: 100px">'
+        + '<a id="thumbnail" href="/watch?v=fake' + n + '">thumbnail</a>'
+        + '<span id="video-title">Fake video ' + n + '</span>'
+        + '<div id="metadata-line"><span>' + (n * 7) + ' views</span></div>'
+        + '</div>';
+'''
+
+VIDEO_HEADER = '<ytd-comments><div>%d Comments</div></ytd-comments>'
+RENDER_COMMENT = '''
+    return '<ytd-comment-thread-renderer style="display: block; '
+        + 'height: 100px">'
+        + '<a id="author-text" href="/@fan' + n + '">@fan' + n + '</a>'
+        + '<span id="published-time-text"><a href="/watch?v=fake&lc=fake-'
+        + 'comment-' + n + '">' + (n + 1) + ' hours ago</a></span>'
+        + '<span id="content-text">Fake comment number ' + n + '</span>'
+        + '<span id="vote-count-middle">' + (n % 100 || '') + '</span>'
+        + (n % 5 ? '<div id="more-replies">' + (n % 5) + ' replies</div>'
+           : '')
+        + '</ytd-comment-thread-renderer>';
+'''
+
+
+def video_title(n):
+    """Get the title of the nth video of a channel."""
+    return 'Fake video %d' % n
+
+
+def comment_text(n):
+    """Get the text of the nth comment on a video."""
+    return 'Fake comment number %d' % n
+
+
+def continuation_item(token):
+    """Get an innertube item continuing a list with a token."""
+    return {'continuationItemRenderer': {'continuationEndpoint': {
+        'continuationCommand': {'token': token}}}}
+
+
+def video_items(total, start):
+    """Get a page of videoRenderer items, continuing if there are more."""
+    end = min(total, start + VIDEOS_PER_PAGE)
+    items = [
+        {'richItemRenderer': {'content': {'videoRenderer': {
+            'videoId': 'fake%d' % n,
+            'title': {'runs': [{'text': video_title(n)}]},
+            'viewCountText': {'simpleText': '%d views' % (n * 7)},
+        }}}}
+        for n in range(start, end)
+    ]
+    if end < total:
+        items.append(continuation_item('videos:%d:%d' % (total, end)))
+    return items
+
+
+def comment_items(total, start):
+    """Get a page of commentThreadRenderer items, continuing if needed."""
+    end = min(total, start + COMMENTS_PER_PAGE)
+    items = [
+        {'commentThreadRenderer': {'comment': {'commentRenderer': {
+            'commentId': 'fake-comment-%d' % n,
+            'authorText': {'simpleText': '@fan%d' % n},
+            'contentText': {'runs': [{'text': comment_text(n)}]},
+            'publishedTimeText': {
+                'runs': [{'text': '%d hours ago' % (n + 1)}]},
+            # youtube leaves out the vote count of comments without likes
+            **({'voteCount': {'simpleText': str(n % 100)}} if n % 100 else {}),
+            'replyCount': n % 5,
+        }}}}
+        for n in range(start, end)
+    ]
+    if end < total:
+        items.append(continuation_item('comments:%d:%d' % (total, end)))
+    return items
+
+
+def channel_page(total):
+    """Get the videos page of a channel with `total` videos."""
+    initial_data = {'contents': {'richGridRenderer': {
+        'contents': video_items(total, 0)}}}
+    return PAGE_TEMPLATE % {
+        'header': CHANNEL_HEADER,
+        'total': total,
+        'page_size': VIDEOS_PER_PAGE,
+        'render': RENDER_VIDEO,
+        'delay': LOAD_DELAY,
+        'initial_data': json.dumps(initial_data),
+        'ytcfg': json.dumps(YTCFG),
+    }
+
+
+def watch_page(total):
+    """Get the watch page of a video with `total` comments."""
+    initial_data = {'contents': {'itemSectionRenderer': {
+        'sectionIdentifier': 'comment-item-section',
+        'contents': [continuation_item('comments:%d:0' % total)],
+    }}}
+    return PAGE_TEMPLATE % {
+        'header': VIDEO_HEADER % total,
+        'total': total,
+        'page_size': COMMENTS_PER_PAGE,
+        'render': RENDER_COMMENT,
+        'delay': LOAD_DELAY,
+        'initial_data': json.dumps(initial_data),
+        'ytcfg': json.dumps(YTCFG),
+    }
+
+
+def search_page(total):
+    """Get a search page with `total` videos in the artist sidebar."""
+    cards = ''.join(
+        '<ytd-watch-card-compact-video-renderer '
+        'class="ytd-vertical-watch-card-list-renderer">'
+        '<a href="/watch?v=fake%d&list=fake">'
+        '<div class="title">%s</div><div class="subtitle">%dK views</div>'
+        '</a></ytd-watch-card-compact-video-renderer>'
+        % (n, video_title(n), n + 1) for n in range(total))
+    items = [
+        {'watchCardCompactVideoRenderer': {
+            'title': {'simpleText': video_title(n)},
+            'subtitle': {'simpleText': '%dK views' % (n + 1)},
+            'navigationEndpoint': {'watchEndpoint': {'videoId': 'fake%d' % n}},
+        }}
+        for n in range(total)
+    ]
+    initial_data = {'contents': {'twoColumnSearchResultsRenderer': {
+        'secondaryContents': {'universalWatchCardRenderer': {'sections': [
+            {'watchCardSectionSequenceRenderer': {'lists': [
+                {'verticalWatchCardListRenderer': {'items': items}}]}}]}}}}}
+    return PAGE_TEMPLATE % {
+        'header': ('<div class="ytd-two-column-search-results-renderer">%s'
+                   '</div>' % cards),
+        'total': 0,
+        'page_size': VIDEOS_PER_PAGE,
+        'render': "return '';",
+        'delay': LOAD_DELAY,
+        'initial_data': json.dumps(initial_data),
+        'ytcfg': json.dumps(YTCFG),
+    }
+
+
+def continuation(token):
+    """Get the innertube response for a continuation token."""
+    kind, total, start = token.split(':')
+    if kind == 'videos':
+        items = video_items(int(total), int(start))
+    else:
+        items = comment_items(int(total), int(start))
+    return {'onResponseReceivedActions': [
+        {'appendContinuationItemsAction': {'continuationItems': items}}]}
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve fake youtube pages and innertube responses."""
+
+    def _send(self, body, content_type):
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Serve a channel, watch or search page."""
+        url = urlparse(self.path)
+        channel = CHANNEL_RE.match(url.path)
+        if channel is not None:
+            return self._send(channel_page(int(channel.group(1))),
+                              'text/html')
+        if url.path == '/watch':
+            video = WATCH_RE.match(parse_qs(url.query).get('v', [''])[0])
+            if video is not None:
+                return self._send(watch_page(int(video.group(1))),
+                                  'text/html')
+        if url.path == '/results':
+            search = SEARCH_RE.match(
+                parse_qs(url.query).get('search_query', [''])[0])
+            if search is not None:
+                return self._send(search_page(int(search.group(1))),
+                                  'text/html')
+        self.send_error(404)
+
+    def do_POST(self):
+        """Serve an innertube continuation."""
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or '{}')
+        if 'continuation' not in body:
+            return self.send_error(400)
+        self._send(json.dumps(continuation(body['continuation'])),
+                   'application/json')
+
+    def log_message(self, format, *args):
+        """Don't log every request."""
+
+
+def start_server(port=0):
+    """Start serving in a background thread, returning its url and server."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return 'http://127.0.0.1:%d' % server.server_address[1], server
+
+
+class LocalSession:
+    """
+    Wrap a requests session, sending requests for youtube to a local server.
+
+    Innertube continuations are always posted to youtube, so these are
+    redirected along with pages.
+    """
+
+    def __init__(self, session, base_url):
+        self.session = session
+        self.base_url = base_url
+
+    def _local(self, url):
+        import innertube
+        return url.replace(innertube.BASE_URL, self.base_url)
+
+    def get(self, url, **kwargs):
+        """Make a GET request to the local server."""
+        return self.session.get(self._local(url), **kwargs)
+
+    def post(self, url, **kwargs):
+        """Make a POST request to the local server."""
+        return self.session.post(self._local(url), **kwargs)
@@ -0,0 +1,407 @@
+"""
+Scrape youtube videos and comments from the JSON embedded in youtube pages.
+
+This reads the `ytInitialData` of a page and follows its continuation tokens
+through youtube's internal (innertube) API over plain HTTP, without a browser.
+"""
+import json
+import re
+import time
+from urllib.parse import quote_plus
+import requests
+from requests.adapters import HTTPAdapter
+from common import (MAX_KNOWN, CommentData, VideoData, count_to_int,
+                    known_run, relative_to_timestamp)
+from database import is_known_comment
+from logger import log
+from metrics import metrics
+import ratelimit
+
+BASE_URL = 'https://www.youtube.com'
+API_URL = BASE_URL + '/youtubei/v1/%s?key=%s&prettyPrint=false'
+WATCH_URL = BASE_URL + '/watch?v=%s'
+SEARCH_URL = BASE_URL + '/results?search_query=%s'
+
+INITIAL_DATA_RE = re.compile(
+    r'(?:var ytInitialData|window\["ytInitialData"\])\s*=\s*(\{.*?\});\s*'
+    r'(?:var |</script>)', re.DOTALL)
+YTCFG_RE = re.compile(r'ytcfg\.set\((\{.*?\})\);', re.DOTALL)
+
+HEADERS = {
+    'User-Agent': ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+                   '(KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36'),
+    'Accept-Language': 'en-GB,en;q=0.9',
+}
+# skip the cookie consent page, the same as rejecting all cookies
+COOKIES = {'SOCS': 'CAE='}
+# rate limits shared by innertube endpoints and the pages they continue
+RATE_LIMITS = {'browse': 'channel', 'next': 'watch'}
+
+_session = None
+
+
+def get_session():
+    """Get the process wide HTTP session, creating it if necessary."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        _session.mount('https://', adapter)
+        _session.headers.update(HEADERS)
+        _session.cookies.update(COOKIES)
+    return _session
+
+
+def fetch_page(session, url, endpoint):
+    """
+    Fetch a page, returning its initial data and innertube config.
+
+    Requests are limited by the rate limit for `endpoint`.
+    """
+    with ratelimit.limit(endpoint), metrics.timer('http_request'):
+        response = session.get(url, timeout=30)
+        response.raise_for_status()
+    html = response.text
+
+    match = INITIAL_DATA_RE.search(html)
+    if match is None:
+        raise Exception('No ytInitialData found in %s' % url)
+    data = json.loads(match.group(1))
+
+    config = {}
+    for ytcfg in YTCFG_RE.findall(html):
+        try:
+            config.update(json.loads(ytcfg))
+        except json.JSONDecodeError:
+            continue
+    if 'INNERTUBE_API_KEY' not in config:
+        raise Exception('No innertube config found in %s' % url)
+    return data, config
+
+
+def fetch_continuation(session, endpoint, config, token):
+    """Fetch the next page of results for a continuation token."""
+    context = config.get('INNERTUBE_CONTEXT') or {
+        'client': {
+            'clientName': 'WEB',
+            'clientVersion': config['INNERTUBE_CLIENT_VERSION'],
+        }
+    }
+    with ratelimit.limit(RATE_LIMITS[endpoint]), \
+            metrics.timer('http_request'):
+        response = session.post(
+            API_URL % (endpoint, config['INNERTUBE_API_KEY']),
+            json={'context': context, 'continuation': token},
+            timeout=30)
+        response.raise_for_status()
+    return response.json()
+
+
+def find_key(obj, key):
+    """Find all values for a key anywhere in nested dicts and lists."""
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if k == key:
+                yield v
+            else:
+                yield from find_key(v, key)
+    elif isinstance(obj, list):
+        for item in obj:
+            yield from find_key(item, key)
+
+
+def get_text(text):
+    """Get the plain text of a youtube text object."""
+    if text is None:
+        return None
+    if 'simpleText' in text:
+        return text['simpleText']
+    if 'content' in text:
+        return text['content']
+    return ''.join(run['text'] for run in text.get('runs', []))
+
+
+def get_continuation_token(items):
+    """Get the continuation token from the end of a list of items."""
+    for item in items:
+        renderer = item.get('continuationItemRenderer')
+        if renderer is None:
+            continue
+        endpoint = renderer.get('continuationEndpoint')
+        if endpoint is None:
+            # newer pages wrap the endpoint in a button
+            endpoint = next(find_key(renderer, 'continuationCommand'), None)
+            return endpoint and endpoint['token']
+        return endpoint['continuationCommand']['token']
+    return None
+
+
+def get_continuation_items(response):
+    """Get the items from a continuation response."""
+    items = []
+    for key in ['onResponseReceivedActions', 'onResponseReceivedEndpoints']:
+        for action in response.get(key, []):
+            for command in action.values():
+                if isinstance(command, dict):
+                    items.extend(command.get('continuationItems', []))
+    return items
+
+
+def views_from_text(views):
+    """Convert an exact view count, like '1,234,567 views', to an integer."""
+    digits = re.sub(r'[^0-9]', '', views)
+    if digits == '':
+        # 'No views'
+        return 0
+    return int(digits)
+
+
+def parse_video(video_renderer):
+    """Convert a videoRenderer to VideoData, or None if it has no views."""
+    views = get_text(video_renderer.get('viewCountText'))
+    if views is None:
+        # premium and upcoming videos don't list the view count
+        return None
+    return VideoData(
+        WATCH_URL % video_renderer['videoId'],
+        get_text(video_renderer['title']),
+        views_from_text(views))
+
+
+def find_youtube_videos(url, max_videos=800, session=None, known_urls=None):
+    """
+    Find youtube videos for a channel.
+
+    Channels list their newest videos first, so if `known_urls` is given,
+    paging stops after MAX_KNOWN known videos in a row.
+    """
+    VIDEOS_URL = '%s/videos'
+
+    session = session or get_session()
+    data, config = fetch_page(session, VIDEOS_URL % url, 'channel')
+
+    tab_contents = None
+    for grid in find_key(data, 'richGridRenderer'):
+        tab_contents = grid['contents']
+        break
+    if tab_contents is None:
+        raise Exception('No video grid found for %s' % url)
+
+    videos = []
+    n_known = 0
+    items = tab_contents
+    while True:
+        new_videos = []
+        for item in items:
+            for video_renderer in find_key(item, 'videoRenderer'):
+                video = parse_video(video_renderer)
+                if video is not None:
+                    new_videos.append(video)
+        videos.extend(new_videos)
+        if len(videos) >= max_videos:
+            break
+        if known_urls is not None:
+            n_known = known_run(new_videos,
+                                lambda video: video.url in known_urls,
+                                n_known)
+            if n_known >= MAX_KNOWN:
+                log.debug('Found %d known videos in a row for %s, stopping',
+                          n_known, url)
+                break
+        token = get_continuation_token(items)
+        if token is None:
+            break
+        items = get_continuation_items(
+            fetch_continuation(session, 'browse', config, token))
+
+    log.debug('Found %d videos for %s with innertube', len(videos), url)
+    return videos[:max_videos]
+
+
+def find_youtube_music_videos(artist_name, session=None):
+    """
+    Find videos linked in the artist sidebar when searching for the artist.
+
+    Returns an empty list if the search has no artist sidebar, and raises an
+    exception if the page has no search results at all.
+    """
+    session = session or get_session()
+    data, _ = fetch_page(session, SEARCH_URL % quote_plus(artist_name),
+                         'search')
+    if next(find_key(data, 'twoColumnSearchResultsRenderer'), None) is None:
+        raise Exception('No search results found for %s' % artist_name)
+
+    videos = []
+    for card in find_key(data, 'verticalWatchCardListRenderer'):
+        for renderer in find_key(card, 'watchCardCompactVideoRenderer'):
+            video_id = next(find_key(renderer.get('navigationEndpoint', {}),
+                                     'videoId'), None)
+            # like '1.2B views', premium videos have no views
+            views = get_text(renderer.get('subtitle'))
+            if video_id is None or not views:
+                continue
+            videos.append(VideoData(WATCH_URL % video_id,
+                                    get_text(renderer['title']),
+                                    count_to_int(views)))
+    log.debug('Found %d music videos for %s with innertube', len(videos),
+              artist_name)
+    return videos
+
+
+def get_comments_token(data):
+    """
+    Get the first continuation token for the comments section of a video.
+
+    Returns None if comments are turned off.
+    """
+    for section in find_key(data, 'itemSectionRenderer'):
+        if section.get('sectionIdentifier') != 'comment-item-section':
+            continue
+        contents = section.get('contents', [])
+        if any('messageRenderer' in item for item in contents):
+            return None
+        return get_continuation_token(contents)
+    raise Exception('No comments section found')
+
+
+def get_newest_token(response):
+    """
+    Get the continuation token for the comments sorted newest first.
+
+    Returns None if the response has no sort menu.
+    """
+    for menu in find_key(response, 'sortFilterSubMenuRenderer'):
+        # the menu lists top comments, then newest first
+        sub_menu_items = menu.get('subMenuItems', [])
+        if len(sub_menu_items) < 2:
+            return None
+        command = next(find_key(sub_menu_items[1], 'continuationCommand'),
+                       None)
+        return command and command['token']
+    return None
+
+
+def parse_comment_renderer(renderer, now):
+    """Convert a commentRenderer to CommentData."""
+    return CommentData(
+        get_text(renderer['contentText']),
+        renderer.get('commentId'),
+        get_text(renderer.get('authorText')),
+        # there is no vote count for comments without likes
+        count_to_int(get_text(renderer.get('voteCount')) or ''),
+        relative_to_timestamp(get_text(renderer.get('publishedTimeText')),
+                              now),
+        renderer.get('replyCount', 0))
+
+
+def parse_comment_payload(payload, now):
+    """Convert a commentEntityPayload to CommentData."""
+    properties = payload['properties']
+    toolbar = payload.get('toolbar', {})
+    return CommentData(
+        properties['content']['content'],
+        properties.get('commentId'),
+        payload.get('author', {}).get('displayName'),
+        count_to_int(toolbar.get('likeCountNotliked', '')),
+        relative_to_timestamp(properties.get('publishedTime'), now),
+        count_to_int(toolbar.get('replyCount', '')))
+
+
+def parse_comments(response, items):
+    """Get each top level comment in a continuation response."""
+    # newer responses keep comment content in entity payloads, keyed by id
+    entities = {}
+    for payload in find_key(response.get('frameworkUpdates', {}),
+                            'commentEntityPayload'):
+        entities[payload['key']] = payload
+
+    now = time.time()
+    comments = []
+    for item in items:
+        thread = item.get('commentThreadRenderer')
+        if thread is None:
+            continue
+        if 'comment' in thread:
+            comments.append(parse_comment_renderer(
+                thread['comment']['commentRenderer'], now))
+            continue
+        view_model = thread['commentViewModel']['commentViewModel']
+        payload = entities.get(view_model['commentKey'])
+        if payload is not None:
+            comments.append(parse_comment_payload(payload, now))
+    return comments
+
+
+def find_youtube_comments(url, max_comments, session=None,
+                          known_hashes=None, known_ids=None):
+    """
+    Find youtube comments for a video.
+
+    Returns a list of comments, see `iter_youtube_comments`.
+    """
+    return [comment for comments in iter_youtube_comments(
+                url, max_comments, session, known_hashes, known_ids)
+            for comment in comments]
+
+
+def iter_youtube_comments(url, max_comments, session=None,
+                          known_hashes=None, known_ids=None):
+    """
+    Find youtube comments for a video, yielding a list of CommentData a page.
+
+    If `known_hashes` is given, comments are sorted newest first, and paging
+    stops after MAX_KNOWN comments in a row whose youtube id is in
+    `known_ids` or whose content hash is known.
+
+    Raises an exception if no comments are found, unless comments are
+    turned off.
+    """
+    session = session or get_session()
+    data, config = fetch_page(session, url, 'watch')
+
+    token = get_comments_token(data)
+    if token is None:
+        log.debug('Comments are turned off for %s', url)
+        return
+
+    response = None
+    if known_hashes is not None:
+        # the first page holds the sort menu, along with top comments
+        response = fetch_continuation(session, 'next', config, token)
+        newest_token = get_newest_token(response)
+        if newest_token is None:
+            log.debug('No sort menu for %s, using top comments', url)
+        else:
+            token = newest_token
+            response = None
+
+    n_comments = 0
+    n_known = 0
+    while token is not None and n_comments < max_comments:
+        if response is None:
+            response = fetch_continuation(session, 'next', config, token)
+        items = get_continuation_items(response)
+        new_comments = parse_comments(response, items)
+        new_comments = new_comments[:max_comments - n_comments]
+        n_comments += len(new_comments)
+        token = get_continuation_token(items)
+        response = None
+        if len(new_comments) > 0:
+            yield new_comments
+
+        if known_hashes is not None:
+            n_known = known_run(
+                new_comments,
+                lambda comment: is_known_comment(comment, known_hashes,
+                                                 known_ids),
+                n_known)
+            if n_known >= MAX_KNOWN:
+                log.debug('Found %d known comments in a row for %s, '
+                          'stopping', n_known, url)
+                break
+
+    if n_comments == 0:
+        raise Exception(
+            'Video URL %s has no comments, but was expected to have some'
+            % url)
+    log.info('Found %d comments for %s with innertube', n_comments, url)
@@ -15,7 +15,8 @@ stdout_handler.setLevel(logging.INFO)
 stdout_handler.setFormatter(fmt)
 log.addHandler(stdout_handler)
 
-file_handler = logging.FileHandler('spotify-youtube-scraper.log')
+# delay opening the log file until the first message is written
+file_handler = logging.FileHandler('spotify-youtube-scraper.log', delay=True)
 file_handler.setLevel(logging.DEBUG)
 file_handler.setFormatter(fmt)
 log.addHandler(file_handler)
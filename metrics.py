@@ -0,0 +1,203 @@
+"""
+Counters and timers for the scrapers' hot paths.
+
+Metrics are labelled with the stage being run, and summarised at the end of
+a run or exported in the Prometheus text format. Each timed span can also be
+written to a JSON lines trace, labelled with the artist or video being
+scraped, to see where the time went for a single item.
+"""
+from contextlib import contextmanager
+import contextvars
+import json
+import os
+import threading
+import time
+from logger import log
+
+PREFIX = 'scraper'
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+# labels for the work in progress, inherited by threads and asyncio tasks
+_labels = contextvars.ContextVar('labels', default={})
+
+
+@contextmanager
+def labels(**kwargs):
+    """Label all metrics recorded in a with block, such as stage or item."""
+    token = _labels.set({**_labels.get(), **kwargs})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+class Metrics:
+    """
+    Counters and histograms for a process.
+
+    Only the stage is used as a label in aggregates, so their size doesn't
+    grow with the number of items. Item ids are only written to the trace.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        # (name, stage) -> [count in each bucket, count, sum]
+        self.histograms = {}
+        self.trace_file = None
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def start(self, trace_path=None):
+        """Start timing a run, appending spans to trace_path if given."""
+        self.start_time = time.time()
+        if trace_path is not None:
+            # line buffered, so lines from several processes don't interleave
+            self.trace_file = open(trace_path, 'a', buffering=1)
+
+    def count(self, name, n=1):
+        """Add n to a counter."""
+        key = (name, _labels.get().get('stage', ''))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, seconds):
+        """Record a duration in a histogram."""
+        key = (name, _labels.get().get('stage', ''))
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                key, [0] * len(BUCKETS) + [0, 0])
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        """Time a with block, recording it in a histogram and the trace."""
+        start_time = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(name, seconds)
+            if self.trace_file is not None:
+                self.trace(name, start_time, seconds, error)
+
+    def trace(self, name, start_time, seconds, error):
+        """Write a span to the trace."""
+        span = {
+            'name': name,
+            'start': round(start_time, 6),
+            'seconds': round(seconds, 6),
+            'pid': os.getpid(),
+            **_labels.get(),
+        }
+        if error is not None:
+            span['error'] = error
+        line = json.dumps(span, default=str) + '\n'
+        with self.lock:
+            self.trace_file.write(line)
+
+    def snapshot(self):
+        """Get the metrics as a picklable dict, to merge in another process."""
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {key: list(histogram) for key, histogram
+                               in self.histograms.items()},
+            }
+
+    def merge(self, snapshot):
+        """Add the metrics from a snapshot of another process."""
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in snapshot['histograms'].items():
+                histogram = self.histograms.setdefault(
+                    key, [0] * len(BUCKETS) + [0, 0])
+                for i, value in enumerate(other):
+                    histogram[i] += value
+
+    def to_prometheus(self):
+        """Format the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name in sorted(set(name for name, _ in self.counters)):
+                metric = '%s_%s_total' % (PREFIX, name)
+                lines.append('# TYPE %s counter' % metric)
+                for (key_name, stage), value in sorted(self.counters.items()):
+                    if key_name == name:
+                        lines.append('%s{stage="%s"} %s'
+                                     % (metric, stage, value))
+
+            for name in sorted(set(name for name, _ in self.histograms)):
+                metric = '%s_%s_seconds' % (PREFIX, name)
+                lines.append('# TYPE %s histogram' % metric)
+                for (key_name, stage), histogram in sorted(
+                        self.histograms.items()):
+                    if key_name != name:
+                        continue
+                    for bound, n in zip(BUCKETS, histogram):
+                        lines.append('%s_bucket{stage="%s",le="%s"} %d'
+                                     % (metric, stage, bound, n))
+                    lines.append('%s_bucket{stage="%s",le="+Inf"} %d'
+                                 % (metric, stage, histogram[-2]))
+                    lines.append('%s_count{stage="%s"} %d'
+                                 % (metric, stage, histogram[-2]))
+                    lines.append('%s_sum{stage="%s"} %f'
+                                 % (metric, stage, histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """Write the metrics to a file, for node exporter's textfile reader."""
+        # written to a temporary file first, so readers never see half a file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+        log.info('Wrote metrics to %s', path)
+
+    def log_summary(self):
+        """Log the throughput of each counter, and where time went."""
+        elapsed = time.time() - self.start_time
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(),
+                                key=lambda item: -item[1][-1])
+        log.info('Run took %.1fs', elapsed)
+        for (name, stage), value in counters:
+            log.info('%-10s %-24s %10d  %8.2f/s',
+                     stage, name, value, value / elapsed)
+        for (name, stage), histogram in histograms:
+            n, total = histogram[-2], histogram[-1]
+            log.info('%-10s %-24s %10d  %8.1fs total  %8.3fs mean',
+                     stage, name, n, total, total / n if n > 0 else 0)
+
+    def finish(self, metrics_path=None):
+        """Log a summary of the run, and export the metrics if asked to."""
+        self.log_summary()
+        if metrics_path is not None:
+            self.write_prometheus(metrics_path)
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+
+
+# the metrics for this process
+metrics = Metrics()
+
+
+def add_metrics_arguments(parser):
+    """Add the arguments for exporting metrics to a parser."""
+    parser.add_argument('--metrics-path', type=str, default=None,
+                        help='write metrics in the Prometheus text format '
+                        'at the end of the run')
+    parser.add_argument('--trace-path', type=str, default=None,
+                        help='append a JSON line for every timed span')
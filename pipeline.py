@@ -0,0 +1,234 @@
+"""
+Scrape comments for many videos in an asyncio pipeline.
+
+Scraping, language detection and database writes run as separate stages
+joined by bounded queues, so browsers keep scraping while earlier videos are
+having their languages detected in a process pool and written in batches.
+"""
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from batch import get_items
+from comments import (BACKENDS, CHUNK_SIZE, DETECTORS, detect_languages,
+                      get_count_rows, get_rows, iter_comments_with_retries,
+                      remove_duplicates, split_known)
+from common import rechunk
+from database import (Comment, QueueWriter, Video, get_db, is_stale,
+                      start_writer_thread)
+from logger import log
+from metrics import add_metrics_arguments, labels, metrics
+import ratelimit
+import scheduler
+
+STAGE = 'comments'
+
+
+@dataclass
+class VideoProgress:
+    """Track the chunks of a video's comments still to be written."""
+
+    pending: int = 0
+    scraped: bool = False
+    failed: bool = False
+
+    def finish_chunk(self, writer, video_id):
+        """
+        Mark the video as updated once all its chunks are queued for writing.
+
+        The video must have been scraped, and every chunk queued without
+        failing. The writer writes in the order it is given, so the video is
+        only marked after its comments are written.
+        """
+        if self.scraped and self.pending == 0 and not self.failed:
+            writer.submit('Video.set_updated', video_id)
+
+
+async def feed(items, scrape_queue, n_scrapers):
+    """Put work items on the scrape queue, then a sentinel per scraper."""
+    # the scheduler may sleep to limit the rate, so iterate in a thread
+    items = iter(items)
+    while True:
+        item = await asyncio.to_thread(next, items, None)
+        if item is None:
+            break
+        await scrape_queue.put(item)
+    for _ in range(n_scrapers):
+        await scrape_queue.put(None)
+
+
+async def scrape(cur, args, scrape_queue, detect_queue):
+    """Scrape comments for videos from the scrape queue."""
+    while True:
+        video_id = await scrape_queue.get()
+        if video_id is None:
+            break
+        with labels(stage=STAGE, item=video_id):
+            await scrape_video(cur, args, video_id, detect_queue)
+
+
+async def scrape_video(cur, args, video_id, detect_queue):
+    """
+    Scrape comments for a video, queueing them for detection in chunks.
+
+    A sentinel is queued after the last chunk, so the video can be marked as
+    updated.
+    """
+    video = Video.get_by_id(cur, video_id)
+    if video is None:
+        log.error('ID: %s not found in database', video_id)
+        return
+    # scheduled items have already been checked for staleness
+    if (not args.force and not args.schedule
+            and not is_stale(video.updated_at)):
+        log.info('Comments for %s were updated recently, skipping',
+                 video.youtube_url)
+        return
+
+    known_hashes = Comment.get_hashes_by_video(cur, video_id)
+    known_ids = Comment.get_youtube_ids_by_video(cur, video_id)
+    stop_hashes = set(known_hashes) if args.incremental else None
+    chunks = rechunk(iter_comments_with_retries(
+        video.youtube_url, args.max_comments, args.max_retries, args.backend,
+        stop_hashes, known_ids), CHUNK_SIZE)
+    progress = VideoProgress()
+    try:
+        while True:
+            # the browser is driven in a thread, a chunk at a time
+            comments = await asyncio.to_thread(next, chunks, None)
+            if comments is None:
+                break
+            known, comments = split_known(comments, known_ids)
+            comments, hashes = remove_duplicates(comments, known_hashes)
+            progress.pending += 1
+            await detect_queue.put((video, progress, comments, hashes, known))
+    except Exception as e:
+        log.exception('Error finding comments for %s: %s',
+                      video.youtube_url, e)
+        return
+    await detect_queue.put((video, progress, None, None, None))
+
+
+async def detect(executor, args, detect_queue, writer):
+    """Detect languages for scraped comments, then hand them to the writer."""
+    loop = asyncio.get_running_loop()
+    while True:
+        scraped = await detect_queue.get()
+        if scraped is None:
+            break
+        video, progress, comments, hashes, known = scraped
+        if comments is None:
+            # every chunk of the video has been scraped, but other detectors
+            # may still be working on some of them
+            progress.scraped = True
+            progress.finish_chunk(writer, video.id)
+            continue
+        with labels(stage=STAGE, item=video.id):
+            try:
+                with metrics.timer('detect_languages'):
+                    languages = await loop.run_in_executor(
+                        executor, partial(
+                            detect_languages,
+                            [comment.text for comment in comments],
+                            args.detector,
+                            n_process=args.detect_processes))
+            except Exception as e:
+                log.exception('Error detecting languages for %s: %s',
+                              video.youtube_url, e)
+                # the video is scraped again next time, for the lost chunk
+                progress.failed = True
+                progress.pending -= 1
+                continue
+            metrics.count('comments_found', len(comments))
+
+        # comments already saved only have their counts updated
+        writer.submit('Comment.update_counts_many',
+                      get_count_rows(video.id, known))
+        writer.submit('Comment.save_many',
+                      get_rows(video.id, comments, languages, hashes))
+        progress.pending -= 1
+        progress.finish_chunk(writer, video.id)
+        log.info('Queued %d new comments for %s',
+                 len(comments), video.youtube_url)
+
+
+async def run_pipeline(args):
+    """Run the scrape, detect and write stages until all items are done."""
+    from pool import get_pool
+    # a browser for each scraper
+    get_pool(size=args.scrapers)
+    # scrapers share rate limits with any other process using the database
+    ratelimit.configure(args.db_path)
+
+    scrape_queue = asyncio.Queue(maxsize=args.scrapers * 2)
+    detect_queue = asyncio.Queue(maxsize=args.detectors * 2)
+    writer_thread, write_queue = start_writer_thread(args.db_path)
+    writer = QueueWriter(write_queue)
+    con, cur = get_db(args.db_path)
+
+    with ProcessPoolExecutor(max_workers=args.detectors) as executor:
+        feeder = asyncio.create_task(
+            feed(get_items(args), scrape_queue, args.scrapers))
+        scrapers = [
+            asyncio.create_task(scrape(cur, args, scrape_queue, detect_queue))
+            for _ in range(args.scrapers)
+        ]
+        detectors = [
+            asyncio.create_task(detect(executor, args, detect_queue, writer))
+            for _ in range(args.detectors)
+        ]
+
+        await feeder
+        await asyncio.gather(*scrapers)
+        for _ in detectors:
+            await detect_queue.put(None)
+        await asyncio.gather(*detectors)
+
+    write_queue.put(None)
+    await asyncio.to_thread(writer_thread.join)
+    con.close()
+
+
+def main(args):
+    """Scrape comments for all items from the scheduler or input file."""
+    from pool import close_pool
+    args.stage = STAGE
+    metrics.start(args.trace_path)
+    try:
+        asyncio.run(run_pipeline(args))
+    finally:
+        close_pool()
+    log.info('Finished comments pipeline')
+    metrics.finish(args.metrics_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-path', type=str)
+    parser.add_argument('--input', type=str, default=None,
+                        help='list of video ids, reads from stdin by default')
+    parser.add_argument('--scrapers', type=int, default=2,
+                        help='videos scraped at a time, each in a browser')
+    parser.add_argument('--detectors', type=int, default=2,
+                        help='processes detecting languages')
+    parser.add_argument('--max-comments', type=int, default=1000)
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--detector', choices=DETECTORS, default='spacy')
+    parser.add_argument('--detect-processes', type=int, default=1,
+                        help='processes each detector runs spacy with')
+    parser.add_argument('--backend', choices=BACKENDS, default='selenium')
+    parser.add_argument('--force', action=argparse.BooleanOptionalAction,
+                        help='scrape even if a video was updated recently')
+    parser.add_argument('--incremental',
+                        action=argparse.BooleanOptionalAction,
+                        help='sort comments newest first and stop scrolling '
+                        'at known comments')
+    parser.add_argument('--schedule', action=argparse.BooleanOptionalAction,
+                        help='take videos from the scheduler')
+    scheduler.add_schedule_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+
+    main(args)
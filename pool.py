@@ -0,0 +1,181 @@
+"""A pool of long-lived Chrome drivers shared by all scrapers."""
+import atexit
+from contextlib import contextmanager
+import queue
+import threading
+import psutil
+from selenium.webdriver import Chrome
+from common import get_options
+from logger import log
+from metrics import metrics
+
+
+class DriverPool:
+    """
+    A bounded set of warm headless Chrome drivers.
+
+    Drivers are checked out with `driver()` and returned when the block exits.
+    A driver is reset between uses, and is recycled after `max_pages` uses or
+    when the browser's memory exceeds `max_memory_mb`.
+    """
+
+    def __init__(self, size=1, options=None, max_pages=50,
+                 max_memory_mb=1500):
+        self.size = size
+        self.options = options or get_options()
+        self.max_pages = max_pages
+        self.max_memory_mb = max_memory_mb
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def _launch(self):
+        """Start a new Chrome driver."""
+        with metrics.timer('chrome_launch'):
+            driver = Chrome(options=self.options)
+        self._pages[id(driver)] = 0
+        log.debug('Launched Chrome driver (pid:%s)', _browser_pid(driver))
+        return driver
+
+    def _quit(self, driver):
+        """Quit a driver, ignoring errors from an already dead browser."""
+        self._pages.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception as e:
+            log.debug('Error quitting Chrome driver: %s', e)
+
+    def _memory_mb(self, driver):
+        """Get the resident memory of a driver's browser and its children."""
+        pid = _browser_pid(driver)
+        if pid is None:
+            return 0
+        try:
+            process = psutil.Process(pid)
+            processes = [process] + process.children(recursive=True)
+            rss = 0
+            for p in processes:
+                try:
+                    rss += p.memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+            return rss / 1024 / 1024
+        except psutil.NoSuchProcess:
+            return 0
+
+    def _is_healthy(self, driver):
+        """Check the browser is still responding to commands."""
+        try:
+            driver.execute_script('return 1')
+            return True
+        except Exception as e:
+            log.debug('Chrome driver failed health check: %s', e)
+            return False
+
+    def _reset(self, driver):
+        """Clear state left by the previous user of a driver."""
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+        driver.delete_all_cookies()
+        driver.get('about:blank')
+
+    def _should_recycle(self, driver):
+        """Check if a driver has been used enough to be replaced."""
+        if self._pages.get(id(driver), 0) >= self.max_pages:
+            log.debug('Recycling Chrome driver after %d pages',
+                      self._pages[id(driver)])
+            return True
+        memory = self._memory_mb(driver)
+        if memory > self.max_memory_mb:
+            log.debug('Recycling Chrome driver using %dMB', memory)
+            return True
+        return False
+
+    def _checkout(self):
+        """Get an idle driver, or launch one if none are idle."""
+        self._slots.acquire()
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                try:
+                    return self._launch()
+                except Exception:
+                    self._slots.release()
+                    raise
+            if self._is_healthy(driver):
+                return driver
+            self._quit(driver)
+
+    def _checkin(self, driver, broken=False):
+        """Return a driver to the pool, or quit it if it can't be reused."""
+        try:
+            with self._lock:
+                self._pages[id(driver)] = self._pages.get(id(driver), 0) + 1
+            if broken or self._should_recycle(driver):
+                self._quit(driver)
+                return
+            try:
+                self._reset(driver)
+            except Exception as e:
+                log.debug('Error resetting Chrome driver: %s', e)
+                self._quit(driver)
+                return
+            self._idle.put(driver)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def driver(self):
+        """Check out a driver for the duration of a with block."""
+        driver = self._checkout()
+        try:
+            yield driver
+        except Exception:
+            # the page may be left in an unknown state, only keep the
+            # driver if it is still healthy
+            self._checkin(driver, broken=not self._is_healthy(driver))
+            raise
+        self._checkin(driver)
+
+    def close(self):
+        """Quit all idle drivers."""
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._quit(driver)
+        log.debug('Closed driver pool')
+
+
+def _browser_pid(driver):
+    """Get the process id of the chromedriver service for a driver."""
+    try:
+        return driver.service.process.pid
+    except AttributeError:
+        return None
+
+
+_pool = None
+
+
+def get_pool(size=1):
+    """Get the process wide driver pool, creating it if necessary."""
+    global _pool
+    if _pool is None:
+        _pool = DriverPool(size=size)
+        atexit.register(close_pool)
+    return _pool
+
+
+def close_pool():
+    """Quit all drivers in the process wide pool."""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
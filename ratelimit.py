@@ -0,0 +1,118 @@
+"""
+Limit the rate of requests to youtube, across every scraping process.
+
+Each endpoint has a token bucket in the database, so processes started by
+`parallel` or `batch.py` share one budget per endpoint. Rates adapt to how
+youtube responds: they grow a little after each success, and halve after a
+failure, as in TCP's additive increase, multiplicative decrease.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+import random
+import threading
+import time
+from database import RateLimit, get_db
+from logger import log
+from metrics import metrics
+
+Budget = namedtuple('Budget', ['rate', 'min_rate', 'max_rate', 'burst'])
+
+# requests a second for each kind of page, and the bounds they adapt within
+BUDGETS = {
+    'search': Budget(rate=0.5, min_rate=0.05, max_rate=2, burst=5),
+    'channel': Budget(rate=0.5, min_rate=0.05, max_rate=2, burst=5),
+    'watch': Budget(rate=1, min_rate=0.1, max_rate=4, burst=10),
+}
+# fraction of an endpoint's starting rate added after each success
+INCREASE = 0.05
+DECREASE = 0.5
+# seconds after a decrease before another failure can decrease the rate
+DECREASE_COOLDOWN = 10
+
+BACKOFF_SECONDS = 2
+MAX_BACKOFF_SECONDS = 60
+
+
+class RateLimiter:
+    """Token buckets shared through a database, one for each endpoint."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # sqlite connections can't be shared between threads
+        self.local = threading.local()
+
+    def _db(self):
+        if not hasattr(self.local, 'con'):
+            self.local.con, self.local.cur = get_db(self.db_path)
+            for endpoint, budget in BUDGETS.items():
+                RateLimit.create(self.local.cur, endpoint, budget.rate,
+                                 budget.burst)
+            self.local.con.commit()
+        return self.local.con, self.local.cur
+
+    def acquire(self, endpoint):
+        """Wait until a request can be made to an endpoint."""
+        con, cur = self._db()
+        wait = RateLimit.take(cur, endpoint, BUDGETS[endpoint].burst)
+        con.commit()
+        if wait > 0:
+            log.debug('Waiting %.1fs to request %s', wait, endpoint)
+            with metrics.timer('rate_limit_wait'):
+                time.sleep(wait)
+
+    def succeeded(self, endpoint):
+        """Speed up requests to an endpoint after a success."""
+        con, cur = self._db()
+        budget = BUDGETS[endpoint]
+        RateLimit.increase(cur, endpoint, budget.rate * INCREASE,
+                           budget.max_rate)
+        con.commit()
+
+    def failed(self, endpoint):
+        """Slow down requests to an endpoint after an error or timeout."""
+        con, cur = self._db()
+        budget = BUDGETS[endpoint]
+        rate = RateLimit.decrease(cur, endpoint, DECREASE, budget.min_rate,
+                                  DECREASE_COOLDOWN)
+        con.commit()
+        if rate is not None:
+            log.info('Slowed requests to %s to %.2f a second', endpoint, rate)
+
+
+_limiter = None
+
+
+def configure(db_path):
+    """Share rate limits through a database, for the rest of the process."""
+    global _limiter
+    _limiter = RateLimiter(db_path)
+
+
+@contextmanager
+def limit(endpoint):
+    """
+    Wait for a request to an endpoint, then adapt its rate to the result.
+
+    Any exception in the with block counts as a failure, so it should only
+    wrap loading a page and waiting for it to appear. Does nothing unless the
+    process has been configured with a database.
+    """
+    if _limiter is None:
+        yield
+        return
+    _limiter.acquire(endpoint)
+    try:
+        yield
+    except Exception:
+        _limiter.failed(endpoint)
+        metrics.count('requests_failed')
+        raise
+    _limiter.succeeded(endpoint)
+
+
+def backoff(attempt):
+    """Sleep before retrying, for a jittered delay doubling each attempt."""
+    delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** attempt)
+    delay *= random.uniform(0.5, 1.5)
+    log.debug('Retrying in %.1fs', delay)
+    time.sleep(delay)
@@ -0,0 +1,88 @@
+"""
+Record and replay HTTP responses, to test the innertube scraper offline.
+
+Fixtures are stored in a directory with an `index.json` mapping each request
+to the file holding its response.
+"""
+import json
+import os
+from urllib.parse import urlparse
+from logger import log
+
+INDEX_FILE = 'index.json'
+
+
+def request_key(method, url, json_body=None):
+    """Get a key identifying a request, ignoring the API key."""
+    path = urlparse(url).path if method == 'POST' else url
+    key = '%s %s' % (method, path)
+    if json_body is not None and 'continuation' in json_body:
+        key += ' %s' % json_body['continuation']
+    return key
+
+
+class ReplayResponse:
+    """A stored response, with the parts of the requests API we use."""
+
+    def __init__(self, text):
+        self.text = text
+
+    def raise_for_status(self):
+        """Stored responses are always successful."""
+
+    def json(self):
+        """Parse the response body as json."""
+        return json.loads(self.text)
+
+
+class ReplaySession:
+    """Serve stored responses in place of a requests session."""
+
+    def __init__(self, fixture_dir):
+        self.fixture_dir = fixture_dir
+        with open(os.path.join(fixture_dir, INDEX_FILE)) as f:
+            self.index = json.load(f)
+
+    def _response(self, key):
+        if key not in self.index:
+            raise Exception('No fixture recorded for %s' % key)
+        with open(os.path.join(self.fixture_dir, self.index[key])) as f:
+            return ReplayResponse(f.read())
+
+    def get(self, url, **kwargs):
+        """Replay a GET request."""
+        return self._response(request_key('GET', url))
+
+    def post(self, url, json=None, **kwargs):
+        """Replay a POST request."""
+        return self._response(request_key('POST', url, json))
+
+
+class RecordingSession:
+    """Wrap a requests session, storing every response as a fixture."""
+
+    def __init__(self, session, fixture_dir):
+        self.session = session
+        self.fixture_dir = fixture_dir
+        os.makedirs(fixture_dir, exist_ok=True)
+        self.index = {}
+
+    def _record(self, key, response, extension):
+        name = '%03d.%s' % (len(self.index), extension)
+        with open(os.path.join(self.fixture_dir, name), 'w') as f:
+            f.write(response.text)
+        self.index[key] = name
+        with open(os.path.join(self.fixture_dir, INDEX_FILE), 'w') as f:
+            json.dump(self.index, f, indent=2)
+        log.debug('Recorded %s to %s', key, name)
+        return response
+
+    def get(self, url, **kwargs):
+        """Make and record a GET request."""
+        response = self.session.get(url, **kwargs)
+        return self._record(request_key('GET', url), response, 'html')
+
+    def post(self, url, json=None, **kwargs):
+        """Make and record a POST request."""
+        response = self.session.post(url, json=json, **kwargs)
+        return self._record(request_key('POST', url, json), response, 'json')
@@ -0,0 +1,137 @@
+"""
+Choose which artists and videos to scrape next.
+
+Work items are streamed from indexed queries, ordered by priority in SQL,
+rather than selected by scanning every video.
+"""
+import argparse
+from collections import namedtuple
+import time
+from database import Artist, Video, Comment, STALE_AFTER_DAYS, get_db
+from logger import log
+
+STAGES = ['videos', 'comments']
+PRIORITIES = ['age', 'views', 'yield']
+
+WorkItem = namedtuple('WorkItem', ['id', 'updated_at', 'views', 'n_found'])
+
+# how to order work items for each priority in SQL, most urgent first, with
+# ids breaking ties so the order is stable
+PRIORITY_ORDER = {
+    'age': 'updated_at, id',
+    'views': 'views DESC, id',
+    'yield': 'n_found DESC, id',
+}
+
+
+def stale_before(max_age_days):
+    """Get the SQL datetime modifier for items older than max age."""
+    return '-%d days' % max_age_days
+
+
+def stale_artists(con, max_age_days, priority):
+    """
+    Stream artists whose videos are stale, most urgent first.
+
+    Each artist's views are its most viewed video, and its yield is the
+    number of videos found for it so far.
+    """
+    cur = con.cursor()
+    # stale artists are found through the updated_at index, and their
+    # videos through the (artist_id, views) index
+    cur.execute(
+        f'''SELECT {Artist.ID} AS id, {Artist.UPDATED} AS updated_at,
+               (SELECT COALESCE(MAX({Video.VIEWS}), 0) FROM video
+                WHERE {Video.ARTIST_ID} = artist.{Artist.ID}) AS views,
+               (SELECT COUNT(*) FROM video
+                WHERE {Video.ARTIST_ID} = artist.{Artist.ID}) AS n_found
+           FROM artist
+           WHERE {Artist.UPDATED} < datetime('now', ?)
+           ORDER BY {PRIORITY_ORDER[priority]}''',
+        (stale_before(max_age_days),))
+    for row in cur:
+        yield WorkItem._make(row)
+
+
+def stale_top_videos(con, max_age_days, top_n, priority):
+    """
+    Stream the stale videos among each artist's top_n, most urgent first.
+
+    An artist's top videos are its most viewed. Each video's yield is the
+    number of comments found for it so far.
+    """
+    cur = con.cursor()
+    # each artist's top videos are a range scan of the (artist_id, views)
+    # index, not a window over every video
+    cur.execute(
+        f'''SELECT video.{Video.ID} AS id,
+               video.{Video.UPDATED} AS updated_at,
+               video.{Video.VIEWS} AS views,
+               (SELECT COUNT(*) FROM comment
+                WHERE {Comment.VIDEO_ID} = video.{Video.ID}) AS n_found
+           FROM artist JOIN video ON video.{Video.ID} IN (
+               SELECT top.{Video.ID} FROM video AS top
+               WHERE top.{Video.ARTIST_ID} = artist.{Artist.ID}
+               ORDER BY top.{Video.VIEWS} DESC LIMIT ?)
+           WHERE video.{Video.UPDATED} < datetime('now', ?)
+           ORDER BY {PRIORITY_ORDER[priority]}''',
+        (top_n, stale_before(max_age_days)))
+    for row in cur:
+        yield WorkItem._make(row)
+
+
+def limit_rate(items, budget=None, rate=None):
+    """Yield at most `budget` items, at no more than `rate` items a minute."""
+    interval = 60 / rate if rate else 0
+    next_time = time.time()
+    for n, item in enumerate(items):
+        if budget is not None and n >= budget:
+            log.info('Reached budget of %d items', budget)
+            break
+        wait = next_time - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        next_time = max(next_time, time.time()) + interval
+        yield item
+
+
+def schedule(con, stage, priority=None, max_age_days=STALE_AFTER_DAYS,
+             top_n=10, budget=None, rate=None):
+    """Stream the ids of items to scrape next for a stage."""
+    if stage == 'videos':
+        items = stale_artists(con, max_age_days, priority or 'age')
+    elif stage == 'comments':
+        items = stale_top_videos(con, max_age_days, top_n,
+                                 priority or 'views')
+    else:
+        raise Exception('No schedule for stage %s' % stage)
+
+    for item in limit_rate(items, budget, rate):
+        yield item.id
+
+
+def add_schedule_arguments(parser):
+    """Add the arguments for choosing work items to a parser."""
+    parser.add_argument('--priority', choices=PRIORITIES, default=None,
+                        help='defaults to age for videos, views for comments')
+    parser.add_argument('--max-age-days', type=int, default=STALE_AFTER_DAYS)
+    parser.add_argument('--top-n', type=int, default=10,
+                        help='scrape comments for each artist\'s top n videos')
+    parser.add_argument('--budget', type=int, default=None,
+                        help='maximum number of items to schedule')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='maximum number of items a minute')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('stage', choices=STAGES)
+    parser.add_argument('--db-path', type=str)
+    add_schedule_arguments(parser)
+
+    args = parser.parse_args()
+
+    con, _ = get_db(args.db_path)
+    for item_id in schedule(con, args.stage, args.priority, args.max_age_days,
+                            args.top_n, args.budget, args.rate):
+        print(item_id, flush=True)
@@ -0,0 +1,207 @@
+"""
+Save screenshots of channels in a background thread, so scraping doesn't wait.
+
+The browser captures the page, and the capture is handed to a thread which
+resizes and encodes it as WebP or JPEG, then writes it to disk named by the
+artist's id. Each screenshot's perceptual hash is kept in the database, and a
+screenshot that looks the same as the last one saved for an artist isn't
+stored again.
+"""
+import base64
+import io
+import os
+import queue
+import threading
+from database import Screenshot, get_db
+from logger import log
+from metrics import metrics
+
+# file extension for each format
+FORMATS = {'webp': 'webp', 'jpeg': 'jpg'}
+# which channels to screenshot, every channel scraped, or only channels
+# without a screenshot, or whose url has changed since theirs
+SAMPLES = ['all', 'new']
+WIDTH = 1280
+QUALITY = 80
+# the browser encodes captures as JPEG, which is much faster than PNG, and
+# good enough to be resized and encoded again
+CAPTURE = {'format': 'jpeg', 'quality': 90}
+HASH_SIZE = 8
+# bits of the perceptual hash that can differ between screenshots that look
+# the same, allowing for new thumbnails and view counts
+MAX_DISTANCE = 6
+# captures waiting to be saved, more are dropped rather than waiting
+MAX_PENDING = 16
+
+# Pillow is imported by the writer thread, so commands start quickly
+
+
+def capture(driver):
+    """Capture the visible page, as base64 encoded JPEG."""
+    return driver.execute_cdp_cmd('Page.captureScreenshot', CAPTURE)['data']
+
+
+def perceptual_hash(image):
+    """
+    Hash an image as a signed 64 bit integer, so similar images hash alike.
+
+    Images that look alike have hashes differing in few bits. This is a
+    difference hash, of whether each pixel of a small grayscale copy of the
+    image is brighter than the pixel to its right.
+    """
+    from PIL import Image
+    small = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE),
+                                      Image.Resampling.LANCZOS)
+    pixels = small.load()
+    bits = 0
+    for y in range(HASH_SIZE):
+        for x in range(HASH_SIZE):
+            bits = bits << 1 | (pixels[x, y] > pixels[x + 1, y])
+    # sqlite integers are signed
+    return bits - (1 << 64) if bits >= 1 << 63 else bits
+
+
+def hash_distance(a, b):
+    """Count the bits that differ between two perceptual hashes."""
+    return bin((a ^ b) & ((1 << 64) - 1)).count('1')
+
+
+def encode(image, image_format, width):
+    """Resize an image to a width, and encode it in a format."""
+    from PIL import Image
+    if image.width > width:
+        height = round(image.height * width / image.width)
+        image = image.resize((width, height), Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format=image_format.upper(), quality=QUALITY)
+    return output.getvalue()
+
+
+class ScreenshotWriter(threading.Thread):
+    """Encode and save screenshots handed to it, until it is closed."""
+
+    def __init__(self, db_path, out_dir, image_format='webp', width=WIDTH,
+                 sample='all'):
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.out_dir = out_dir
+        self.image_format = image_format
+        self.width = width
+        self.sample = sample
+        self.pending = queue.Queue(maxsize=MAX_PENDING)
+
+    def wants(self, cur, artist):
+        """Check if an artist's channel should be captured."""
+        if self.sample == 'all':
+            return True
+        saved = Screenshot.get(cur, artist.id)
+        return saved is None or saved.youtube_url != artist.youtube_url
+
+    def submit(self, artist, data):
+        """Queue a capture of an artist's channel to be saved."""
+        try:
+            self.pending.put_nowait((artist.id, artist.youtube_url, data))
+        except queue.Full:
+            log.warning('Too many screenshots waiting to be saved, dropping '
+                        'the screenshot of %s', artist.name)
+            metrics.count('screenshots_dropped')
+
+    def close(self):
+        """Save the screenshots still waiting, then stop."""
+        self.pending.put(None)
+        self.join()
+
+    def run(self):
+        """Save screenshots as they are queued."""
+        # sqlite connections can't be shared between threads
+        con, cur = get_db(self.db_path)
+        while True:
+            screenshot = self.pending.get()
+            if screenshot is None:
+                break
+            try:
+                with metrics.timer('screenshot_save'):
+                    self.save(cur, *screenshot)
+                con.commit()
+            except Exception as e:
+                log.exception('Error saving screenshot of artist %s: %s',
+                              screenshot[0], e)
+                con.rollback()
+        con.close()
+
+    def save(self, cur, artist_id, youtube_url, data):
+        """Save a capture, unless it looks the same as the last one."""
+        from PIL import Image
+        image = Image.open(io.BytesIO(base64.b64decode(data)))
+        phash = perceptual_hash(image)
+        saved = Screenshot.get(cur, artist_id)
+        if (saved is not None
+                and hash_distance(phash, saved.phash) <= MAX_DISTANCE):
+            # the old screenshot is kept, but recorded as current
+            Screenshot.save(cur, artist_id, youtube_url, saved.phash,
+                            saved.path)
+            metrics.count('screenshots_unchanged')
+            log.debug('Screenshot of artist %s is unchanged', artist_id)
+            return
+
+        path = os.path.join(self.out_dir, '%d.%s' % (
+            artist_id, FORMATS[self.image_format]))
+        # written to a temporary file first, so readers never see half a file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(encode(image, self.image_format, self.width))
+        os.replace(tmp_path, path)
+        Screenshot.save(cur, artist_id, youtube_url, phash, path)
+        metrics.count('screenshots_saved')
+        log.debug('Saved screenshot of artist %s to %s', artist_id, path)
+
+
+_writer = None
+
+
+def configure(db_path, out_dir, image_format='webp', width=WIDTH,
+              sample='all'):
+    """
+    Save screenshots to a directory, for the rest of the process.
+
+    Does nothing if `out_dir` is None.
+    """
+    global _writer
+    if out_dir is None:
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    _writer = ScreenshotWriter(db_path, out_dir, image_format, width, sample)
+    _writer.start()
+
+
+def close():
+    """Save the screenshots still waiting, if configured."""
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+
+def wants(cur, artist):
+    """Check if an artist's channel should be captured."""
+    return _writer is not None and _writer.wants(cur, artist)
+
+
+def submit(artist, data):
+    """Queue a capture of an artist's channel to be saved."""
+    _writer.submit(artist, data)
+
+
+def add_screenshot_arguments(parser):
+    """Add the arguments for saving screenshots to a parser."""
+    parser.add_argument('--screenshot-path', type=str, default=None,
+                        help='directory to save a screenshot of each '
+                        'channel in, named by artist id')
+    parser.add_argument('--screenshot-format', choices=FORMATS,
+                        default='webp')
+    parser.add_argument('--screenshot-width', type=int, default=WIDTH,
+                        help='width screenshots are resized to, in pixels')
+    parser.add_argument('--screenshot-sample', choices=SAMPLES,
+                        default='all',
+                        help='screenshot every channel, or only channels '
+                        'that are new or whose url has changed')
@@ -0,0 +1,37 @@
+"""Search scraped comments, printing matches as tab separated lines."""
+import argparse
+from database import SEARCH_MODES, Comment, get_db, search_query
+
+
+def main(db_path, text, mode, artist_id, video_id, language, after_id,
+         page_size):
+    """Print a page of comments matching the text."""
+    con, cur = get_db(db_path)
+    comments = Comment.search(cur, search_query(text, mode), artist_id,
+                              video_id, language, after_id, page_size)
+    for comment in comments:
+        # one comment per line, so results can be piped like other commands
+        content = ' '.join(comment.content.split())
+        print('%d\t%d\t%s\t%s' % (comment.id, comment.video_id,
+                                  comment.language, content))
+    con.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('text', type=str)
+    parser.add_argument('--db-path', type=str)
+    parser.add_argument('--mode', choices=SEARCH_MODES, default='term',
+                        help='match all words, the exact phrase, or words '
+                        'starting with the last word')
+    parser.add_argument('--artist-id', type=int, default=None)
+    parser.add_argument('--video-id', type=int, default=None)
+    parser.add_argument('--language', type=str, default=None)
+    parser.add_argument('--after-id', type=int, default=0,
+                        help='get the page after the comment with this id')
+    parser.add_argument('--page-size', type=int, default=100)
+
+    args = parser.parse_args()
+
+    main(args.db_path, args.text, args.mode, args.artist_id, args.video_id,
+         args.language, args.after_id, args.page_size)
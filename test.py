@@ -1,10 +1,27 @@
 """
 Tests.
 
-`python test.py`
+`python test.py`, or `python test.py --offline` to skip tests that use youtube
 """
+import argparse
 import os
-from database import get_db
+import subprocess
+import sys
+import tempfile
+from channels import resolve_channels
+from common import count_to_int, rechunk, relative_to_timestamp
+from database import (Artist, ChannelCache, Comment, DirectWriter, Job,
+                      RateLimit, Video, WordCount, content_hash,
+                      count_words, get_db, hash_comments, is_stale,
+                      rebuild_word_counts, search_query,
+                      start_writer_thread, transaction)
+from replay import ReplaySession
+import fakeyoutube
+import innertube
+from metrics import Metrics, labels
+
+FIXTURES_PATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), 'fixtures')
 
 con, cur = get_db('test.db')
 
@@ -40,10 +57,602 @@ def test():
     print('Found comments successfully.')
 
 
+def test_innertube():
+    session = ReplaySession(os.path.join(FIXTURES_PATH, 'innertube'))
+
+    videos = innertube.find_youtube_videos(
+        'https://www.youtube.com/@fixture', session=session)
+    assert [video.url for video in videos] == [
+        'https://www.youtube.com/watch?v=fixture0001',
+        'https://www.youtube.com/watch?v=fixture0002',
+        'https://www.youtube.com/watch?v=fixture0003',
+    ]
+    assert [video.views for video in videos] == [1234567, 0, 89]
+    assert videos[0].title == 'Fixture video 1'
+    print('Found innertube videos successfully.')
+
+    comments = innertube.find_youtube_comments(
+        'https://www.youtube.com/watch?v=fixture0001', 10, session=session)
+    assert [comment.text for comment in comments] == [
+        'First comment', 'Second comment', 'Third comment',
+        'Tercer comentario']
+    assert [comment.youtube_id for comment in comments] == [
+        'UgxFixture1', 'UgxFixture2', 'UgxFixture3', 'UgxFixture4']
+    assert [comment.likes for comment in comments] == [1200, 0, 5, 0]
+    assert [comment.replies for comment in comments] == [12, 0, 2, 0]
+    assert comments[0].author == '@fixturefan'
+    assert comments[2].author == '@thirdfan'
+    assert comments[0].published_at < comments[1].published_at
+    comments = innertube.find_youtube_comments(
+        'https://www.youtube.com/watch?v=fixture0002', 10, session=session)
+    assert comments == []
+    print('Found innertube comments successfully.')
+
+
+def test_incremental():
+    session = ReplaySession(os.path.join(FIXTURES_PATH, 'innertube'))
+    max_known = innertube.MAX_KNOWN
+    innertube.MAX_KNOWN = 2
+    try:
+        known_urls = {'https://www.youtube.com/watch?v=fixture0001',
+                      'https://www.youtube.com/watch?v=fixture0002'}
+        videos = innertube.find_youtube_videos(
+            'https://www.youtube.com/@fixture', session=session,
+            known_urls=known_urls)
+        # stops before the next page of videos
+        assert [video.url for video in videos] == sorted(known_urls)
+
+        known_hashes = {content_hash(comment) for comment in [
+            'First comment', 'Second comment',
+            'Third comment', 'Tercer comentario']}
+        comments = innertube.find_youtube_comments(
+            'https://www.youtube.com/watch?v=fixture0001', 10,
+            session=session, known_hashes=known_hashes)
+        assert [comment.text for comment in comments] == [
+            'Newest comment', 'Tercer comentario', 'Third comment']
+
+        # comments with youtube ids are known by id, whatever their content
+        comments = innertube.find_youtube_comments(
+            'https://www.youtube.com/watch?v=fixture0001', 10,
+            session=session, known_hashes=set(),
+            known_ids={'UgxFixture3', 'UgxFixture4'})
+        assert [comment.youtube_id for comment in comments] == [
+            'UgxFixture5', 'UgxFixture4', 'UgxFixture3']
+    finally:
+        innertube.MAX_KNOWN = max_known
+    print('Stopped incremental scrapes at known items successfully.')
+
+
+def test_fake_youtube():
+    base_url, server = fakeyoutube.start_server()
+    try:
+        session = fakeyoutube.LocalSession(innertube.get_session(), base_url)
+        videos = innertube.find_youtube_videos(
+            base_url + '/@fake95', session=session)
+        assert len(videos) == 95
+        assert videos[-1].title == fakeyoutube.video_title(94)
+
+        comments = innertube.find_youtube_comments(
+            base_url + '/watch?v=fake45', 1000, session=session)
+        assert [comment.text for comment in comments] == [
+            fakeyoutube.comment_text(n) for n in range(45)]
+        assert [comment.likes for comment in comments[:2]] == [0, 1]
+
+        # comments are streamed a page at a time, then regrouped in chunks
+        pages = innertube.iter_youtube_comments(
+            base_url + '/watch?v=fake45', 30, session=session)
+        chunks = list(rechunk(pages, 25))
+        assert [len(chunk) for chunk in chunks] == [30]
+        assert [comment.text for comment in chunks[0]] == [
+            fakeyoutube.comment_text(n) for n in range(30)]
+
+        music_videos = innertube.find_youtube_music_videos(
+            'fake3', session=session)
+        assert [video.url for video in music_videos] == [
+            innertube.WATCH_URL % ('fake%d' % n) for n in range(3)]
+        assert [video.views for video in music_videos] == [1000, 2000, 3000]
+    finally:
+        server.shutdown()
+    print('Scraped fake youtube successfully.')
+
+
+def test_metrics():
+    run_metrics = Metrics()
+    with labels(stage='videos', item=1):
+        with run_metrics.timer('page_load'):
+            pass
+        run_metrics.count('videos_found', 3)
+    other = Metrics()
+    with labels(stage='videos'):
+        other.count('videos_found', 2)
+    run_metrics.merge(other.snapshot())
+
+    text = run_metrics.to_prometheus()
+    assert 'scraper_videos_found_total{stage="videos"} 5' in text
+    assert 'scraper_page_load_seconds_count{stage="videos"} 1' in text
+    print('Recorded metrics successfully.')
+
+
+def test_rate_limit():
+    from unittest import mock
+    import ratelimit
+    sleeps = []
+    # the clock stands still, so waits are exactly those the buckets compute
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            mock.patch('time.time', return_value=1_000_000.0), \
+            mock.patch('time.sleep', sleeps.append):
+        limit_con, limit_cur = get_db(os.path.join(tmp_dir, 'limit.db'))
+        RateLimit.create(limit_cur, 'test', 1, 2)
+        # a full bucket lets a burst through, then makes callers wait in turn
+        waits = [RateLimit.take(limit_cur, 'test', 2) for _ in range(4)]
+        assert waits == [0, 0, 1, 2]
+        assert RateLimit.decrease(limit_cur, 'test', 0.5, 0.1, 10) == 0.5
+        # failures within the cooldown only decrease the rate once
+        assert RateLimit.decrease(limit_cur, 'test', 0.5, 0.1, 10) is None
+        RateLimit.increase(limit_cur, 'test', 1, 1.2)
+        limit_cur.execute(
+            "SELECT rate FROM rate_limit WHERE endpoint = 'test'")
+        assert limit_cur.fetchone()[0] == 1.2
+        limit_con.commit()
+
+        # processes sleep for the wait their bucket gives them
+        limiter = ratelimit.RateLimiter(os.path.join(tmp_dir, 'limit.db'))
+        budget = ratelimit.BUDGETS['search']
+        for _ in range(budget.burst + 2):
+            limiter.acquire('search')
+        assert sleeps == [1 / budget.rate, 2 / budget.rate]
+        limiter.local.con.close()
+        limit_con.close()
+    print('Limited requests successfully.')
+
+
+def test_channel_cache():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_con, cache_cur = get_db(os.path.join(tmp_dir, 'cache.db'))
+        Artist.save(cache_cur, 'Drake', 'spotify:artist:drake', 'drake-url')
+        ChannelCache.save(cache_cur, 'bad bunny', 'bad-bunny-url')
+        cache_con.commit()
+        # cached and already saved artists are resolved without a browser
+        artists = [('Drake', 'spotify:artist:drake'),
+                   ('Bad Bunny', 'spotify:artist:bad-bunny'),
+                   ('bad  bunny', 'spotify:artist:bad-bunny-2'),
+                   ('Bad Bunny', 'spotify:artist:bad-bunny')]
+        n_failed = resolve_channels(cache_cur, DirectWriter(cache_con),
+                                    artists, 1, False, 1)
+        assert n_failed == 0
+        urls = {row.spotify_uri: row.youtube_url
+                for row in Artist.get_all(cache_cur)}
+        assert urls == {'spotify:artist:drake': 'drake-url',
+                        'spotify:artist:bad-bunny': 'bad-bunny-url',
+                        'spotify:artist:bad-bunny-2': 'bad-bunny-url'}
+        cache_con.close()
+    print('Resolved cached channels successfully.')
+
+
+def test_export():
+    import pyarrow.parquet as pq
+    import export
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        export_con, export_cur = get_db(os.path.join(tmp_dir, 'export.db'))
+        Artist.save(export_cur, 'Artist', 'spotify:artist:1', 'url')
+        Video.save_many(export_cur, [(1, 'Video %d' % n, 'video-url-%d' % n,
+                                      n) for n in range(3)])
+
+        def save(texts):
+            Comment.save_many(export_cur, [
+                (1, text, 'en', content_hash(text), 'Ugx%s' % text, None, 0,
+                 None, 0) for text in texts])
+            export_con.commit()
+
+        def export_new(name):
+            since, after_id = export.last_export(tmp_dir, name, 'parquet')
+            path, _ = export.export_table(export_cur, name, tmp_dir,
+                                          'parquet', since, after_id)
+            return path
+
+        save(['comment %d' % n for n in range(10)])
+        # exported in chunks, then only what was added or changed since the
+        # last export, which can include rows changed as it ran
+        path, n_rows = export.export_table(
+            export_cur, 'comment', tmp_dir, 'parquet', chunk_size=3)
+        assert n_rows == 10
+        table = pq.read_table(path)
+        assert table.column('content').to_pylist()[9] == 'comment 9'
+        assert table.schema.field('language').type.value_type == 'string'
+        save(['new comment'])
+        Comment.update_counts_many(export_cur, [(5, 0, 1, 'Ugxcomment 1')])
+        export_con.commit()
+        contents = pq.read_table(export_new('comment')).column(
+            'content').to_pylist()
+        assert {'new comment', 'comment 1'} <= set(contents)
+        _, n_rows = export.export_table(export_cur, 'comment', tmp_dir,
+                                        'arrow')
+        assert n_rows == 11
+
+        # new videos, and videos with new views, are exported, though their
+        # updated_at only changes when their comments are scraped
+        export.export_table(export_cur, 'video', tmp_dir, 'parquet')
+        Video.save_many(export_cur, [(1, 'Video 1', 'video-url-1', 10),
+                                     (1, 'Video 3', 'video-url-3', 3)])
+        export_con.commit()
+        table = pq.read_table(export_new('video'))
+        views = dict(zip(table.column('title').to_pylist(),
+                         table.column('views').to_pylist()))
+        assert views['Video 1'] == 10 and views['Video 3'] == 3
+        export_con.close()
+    print('Exported tables successfully.')
+
+
+def test_search():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        search_con, search_cur = get_db(os.path.join(tmp_dir, 'search.db'))
+        Artist.save(search_cur, 'Artist', 'spotify:artist:1', 'url')
+        Video.save_many(search_cur, [(1, 'Video', 'video-url', 1)])
+        texts = ['I love this song', 'this song is my love', 'Música buena',
+                 'lovely "quoted" song']
+        Comment.save_many(search_cur, [
+            (1, text, 'es' if 'buena' in text else 'en', content_hash(text),
+             None, None, None, None, None)
+            for text in texts])
+        search_con.commit()
+
+        def search(text, mode='term', **kwargs):
+            comments = Comment.search(search_cur, search_query(text, mode),
+                                      **kwargs)
+            return [comment.content for comment in comments]
+
+        assert search('love song') == texts[:2]
+        assert search('love this', 'phrase') == texts[:1]
+        assert search('lov', 'prefix') == [texts[0], texts[1], texts[3]]
+        assert search('"quoted"') == texts[3:]
+        # accents are ignored, and results can be filtered and paged
+        assert search('musica', language='es', artist_id=1) == texts[2:3]
+        assert search('musica', language='en') == []
+        assert search('song', page_size=1, after_id=1) == texts[1:2]
+        # comments removed as duplicates are removed from the index
+        search_cur.execute('DELETE FROM comment WHERE id = 1')
+        assert search('love song') == texts[1:2]
+        search_con.close()
+    print('Searched comments successfully.')
+
+
+def test_word_counts():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        words_con, words_cur = get_db(os.path.join(tmp_dir, 'words.db'))
+        Artist.save(words_cur, 'Artist 1', 'spotify:artist:1', 'url-1')
+        Artist.save(words_cur, 'Artist 2', 'spotify:artist:2', 'url-2')
+        Video.save_many(words_cur, [(1, 'Video 1', 'video-url-1', 1),
+                                    (2, 'Video 2', 'video-url-2', 1)])
+
+        def save(video_id, texts):
+            Comment.save_many(words_cur, [
+                (video_id, text, 'en', content_hash(text),
+                 None, None, None, None, None) for text in texts])
+
+        save(1, ['Love this SONG', 'great song'])
+        # scraping a video again only counts its new comments
+        save(1, ['Love this SONG', "don't stop"])
+        save(2, ['song of the year'])
+        words_con.commit()
+        top = WordCount.get_top(words_cur, 1, 'en', 2)
+        assert top == [('song', 2), ("don't", 1)]
+        # words used for every artist aren't distinctive
+        tfidf = dict(WordCount.get_top_tfidf(words_cur, 1, 'en', 10))
+        assert tfidf['song'] == 0 and tfidf['love'] > 0
+
+        counts = sorted(words_cur.execute('SELECT * FROM word_count'))
+        rebuild_word_counts(words_cur)
+        assert sorted(words_cur.execute('SELECT * FROM word_count')) == counts
+
+        # a duplicate saved before it was hashed is counted, until hashing
+        # removes it
+        words_cur.execute(
+            """INSERT INTO comment (video_id, content, language, updated_at)
+               VALUES (2, 'song of the year', 'en', datetime('now'))""")
+        WordCount.add_many(words_cur, count_words(
+            [(2, 'song of the year', 'en')]))
+        assert hash_comments(words_cur, word_counts=True) == 1
+        assert sorted(words_cur.execute('SELECT * FROM word_count')) == counts
+        words_con.close()
+    print('Counted words successfully.')
+
+
+def test_comment_metadata():
+    from comments import (get_count_rows, get_rows, record_to_comment,
+                          remove_duplicates, split_known)
+    from unittest import mock
+    assert [count_to_int(count) for count in [
+        '', '7', '1,234', '1.2K', '3M', '12 replies', '1 reply']] == [
+        0, 7, 1234, 1200, 3000000, 12, 1]
+    now = 1_700_000_000
+    assert relative_to_timestamp('2 days ago', now) == now - 2 * 86400
+    assert relative_to_timestamp('1 year ago (edited)', now) == \
+        now - 365 * 86400
+    assert relative_to_timestamp('yesterday', now) is None
+    comment = record_to_comment({
+        'text': 'Great song', 'id': 'Ugx1', 'published': '3 hours ago',
+        'author': '/@fan', 'likes': '1.5K', 'replies': '4 replies'}, now)
+    assert (comment.youtube_id, comment.author, comment.likes,
+            comment.published_at, comment.replies) == (
+        'Ugx1', '@fan', 1500, now - 3 * 3600, 4)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        meta_con, meta_cur = get_db(os.path.join(tmp_dir, 'metadata.db'))
+        Artist.save(meta_cur, 'Artist', 'spotify:artist:1', 'url')
+        Video.save_many(meta_cur, [(1, 'Video', 'video-url', 1)])
+
+        def save(scraped):
+            known_ids = Comment.get_youtube_ids_by_video(meta_cur, 1)
+            known, scraped = split_known(scraped, known_ids)
+            scraped, hashes = remove_duplicates(
+                scraped, Comment.get_hashes_by_video(meta_cur, 1))
+            Comment.update_counts_many(meta_cur, get_count_rows(1, known))
+            Comment.save_many(meta_cur, get_rows(
+                1, scraped, ['en'] * len(scraped), hashes))
+
+        save([comment,
+              record_to_comment({'text': 'Second', 'id': 'Ugx2',
+                                 'likes': '2'}, now)])
+        # a refresh updates the counts of comments it already has, even if
+        # their content was edited, and adds new comments
+        comment.text = 'Great song!'
+        comment.likes = 1600
+        save([comment,
+              record_to_comment({'text': 'Third', 'id': 'Ugx3',
+                                 'likes': '30'}, now)])
+        # comments with the same text but different ids are all kept, even
+        # when hashes are backfilled
+        hearts = [record_to_comment({'text': '❤️', 'id': youtube_id},
+                                    now) for youtube_id in ['Ugx4', 'Ugx5']]
+        save(hearts)
+        save(hearts)
+        hash_comments(meta_cur, only_missing=False)
+        meta_con.commit()
+        top = Comment.get_top_by_likes(meta_cur, 1, 2)
+        assert [(row.content, row.likes) for row in top] == [
+            ('Great song', 1600), ('Third', 30)]
+        assert Comment.get_youtube_ids_by_video(meta_cur, 1) == {
+            'Ugx1', 'Ugx2', 'Ugx3', 'Ugx4', 'Ugx5'}
+
+        # a failed backfill keeps the unique key it dropped
+        with mock.patch('database.content_hash', side_effect=ValueError):
+            try:
+                with transaction(meta_con):
+                    hash_comments(meta_cur, only_missing=False)
+                assert False, 'hashing should fail'
+            except ValueError:
+                pass
+        meta_cur.execute(
+            """SELECT name FROM sqlite_master
+               WHERE name = 'comment_video_content_hash'""")
+        assert meta_cur.fetchone() is not None
+        meta_con.close()
+    print('Saved comment metadata successfully.')
+
+
+def test_screenshots():
+    import base64
+    import io
+    from PIL import Image, ImageDraw
+    import screenshots
+
+    def capture(shapes):
+        image = Image.new('RGB', (2560, 1440), 'white')
+        draw = ImageDraw.Draw(image)
+        for box in shapes:
+            draw.rectangle(box, fill='black')
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=90)
+        return base64.b64encode(output.getvalue()).decode()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'screenshots.db')
+        shots_con, shots_cur = get_db(db_path)
+        Artist.save(shots_cur, 'Artist', 'spotify:artist:1', 'url')
+        shots_con.commit()
+        artist = Artist.get_by_id(shots_cur, 1)
+
+        def save(data):
+            writer = screenshots.ScreenshotWriter(
+                db_path, tmp_dir, 'webp', 640, 'new')
+            writer.start()
+            writer.submit(artist, data)
+            writer.close()
+            return writer
+
+        writer = save(capture([(0, 0, 1280, 720)]))
+        path = os.path.join(tmp_dir, '1.webp')
+        with Image.open(path) as image:
+            assert image.size == (640, 360)
+        # only new channels are captured, and a capture that looks the same
+        # as the last isn't stored again
+        assert not writer.wants(shots_cur, artist)
+        os.remove(path)
+        save(capture([(0, 0, 1280, 720), (2000, 1400, 2010, 1410)]))
+        assert not os.path.exists(path)
+        save(capture([(1280, 720, 2560, 1440)]))
+        assert os.path.exists(path)
+        shots_con.close()
+    print('Saved screenshots successfully.')
+
+
+def test_scheduler():
+    import scheduler
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sched_con, sched_cur = get_db(os.path.join(tmp_dir, 'schedule.db'))
+        Artist.save(sched_cur, 'Artist 1', 'spotify:artist:1', 'url-1')
+        Artist.save(sched_cur, 'Artist 2', 'spotify:artist:2', 'url-2')
+        Video.save_many(sched_cur, [
+            (1, 'Video 1', 'video-url-1', 1),
+            (1, 'Video 2', 'video-url-2', 2),
+            (1, 'Video 3', 'video-url-3', 3),
+            (2, 'Video 4', 'video-url-4', 100),
+            (2, 'Video 5', 'video-url-5', 5)])
+        Comment.save_many(sched_cur, [
+            (2, text, 'en', content_hash(text), None, None, None, None, None)
+            for text in ['first', 'second']])
+        Video.set_updated(sched_cur, 5)
+        sched_con.commit()
+
+        def schedule(stage, priority):
+            return list(scheduler.schedule(sched_con, stage, priority,
+                                           top_n=2))
+
+        # priorities order every item, not just those read together
+        assert schedule('comments', 'views') == [4, 3, 2]
+        assert schedule('comments', 'yield') == [2, 3, 4]
+        assert schedule('videos', 'views') == [2, 1]
+        assert schedule('videos', 'yield') == [1, 2]
+        sched_con.close()
+    print('Scheduled items by priority successfully.')
+
+
+def test_jobs():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        jobs_con, jobs_cur = get_db(os.path.join(tmp_dir, 'jobs.db'))
+        Job.enqueue_many(jobs_cur, 'videos', [1])
+        # a lease that has already expired, as if each worker holding the
+        # job had crashed
+        for attempt in range(1, 4):
+            jobs = Job.claim(jobs_cur, 'videos', 'worker', 1, -1, 3)
+            assert [(job.item, job.attempts) for job in jobs] == [
+                (1, attempt)]
+        assert Job.claim(jobs_cur, 'videos', 'worker', 1, -1, 3) == []
+        assert Job.count_by_status(jobs_cur, 'videos') == {Job.FAILED: 1}
+        jobs_con.close()
+    print('Failed jobs with expired leases successfully.')
+
+
+def test_writer():
+    import queue
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'writer.db')
+        writer_con, writer_cur = get_db(db_path)
+        Artist.save(writer_cur, 'Artist', 'spotify:artist:1', 'url')
+        writer_con.commit()
+        metrics_queue = queue.Queue()
+        thread, write_queue = start_writer_thread(
+            db_path, metrics_queue=metrics_queue)
+        # an op that raises outside sqlite is dropped, without losing the
+        # rest of its batch or stopping the writer
+        write_queue.put(('Video.set_updated', ()))
+        write_queue.put(('Video.save_many', ([(1, 'Video', 'url', 1)],)))
+        write_queue.put(None)
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+        assert metrics_queue.get(timeout=1) is not None
+        assert len(Video.get_by_artist(writer_cur, 1)) == 1
+        writer_con.close()
+    print('Dropped bad writes successfully.')
+
+
+def test_pipeline_progress():
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from common import CommentData
+    from pipeline import VideoProgress, detect
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pipe_con, pipe_cur = get_db(os.path.join(tmp_dir, 'pipeline.db'))
+        Artist.save(pipe_cur, 'Artist', 'spotify:artist:1', 'url')
+        Video.save_many(pipe_cur, [(1, 'Video 1', 'video-url-1', 1),
+                                   (2, 'Video 2', 'video-url-2', 1)])
+        pipe_con.commit()
+        args = argparse.Namespace(detector='langdetect', detect_processes=1)
+        writer = DirectWriter(pipe_con)
+
+        def chunk(video_id, progress, texts):
+            # a comment without text fails language detection
+            comments = [CommentData(text) for text in texts]
+            hashes = [content_hash(text or '') for text in texts]
+            return (Video.get_by_id(pipe_cur, video_id), progress, comments,
+                    hashes, [])
+
+        async def run(scraped):
+            detect_queue = asyncio.Queue()
+            # one thread, as langdetect doesn't load its profiles thread
+            # safely, but each detector still waits on it in turn
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                detectors = [asyncio.create_task(
+                    detect(executor, args, detect_queue, writer))
+                    for _ in range(2)]
+                for item in scraped + [None] * len(detectors):
+                    await detect_queue.put(item)
+                await asyncio.gather(*detectors)
+
+        # the sentinel can reach a detector while the other is still working
+        # on the video's last chunk
+        done = VideoProgress(pending=2)
+        failed = VideoProgress(pending=2)
+        asyncio.run(run([
+            chunk(1, done, ['great song', 'love it']),
+            chunk(1, done, ['best video']),
+            (Video.get_by_id(pipe_cur, 1), done, None, None, None),
+            chunk(2, failed, ['great song']),
+            chunk(2, failed, [None]),
+            (Video.get_by_id(pipe_cur, 2), failed, None, None, None),
+        ]))
+        writer.flush()
+        assert len(Comment.get_by_video(pipe_cur, 1)) == 3
+        assert not is_stale(Video.get_by_id(pipe_cur, 1).updated_at)
+        # a chunk was lost, so the video is scraped again next time
+        assert len(Comment.get_by_video(pipe_cur, 2)) == 1
+        assert is_stale(Video.get_by_id(pipe_cur, 2).updated_at)
+        pipe_con.close()
+    print('Marked pipeline videos as updated successfully.')
+
+
+# commands, and modules they shouldn't import to start, as the import is
+# slow
+COMMANDS = ['channels.py', 'videos.py', 'comments.py', 'batch.py',
+            'backfill.py', 'scheduler.py', 'pipeline.py', 'export.py',
+            'search.py', 'words.py']
+HEAVY_MODULES = ['selenium', 'spacy', 'pandas', 'requests', 'langdetect',
+                 'pyarrow', 'PIL']
+
+
+def test_startup():
+    for script in COMMANDS:
+        subprocess.run([sys.executable, script, '--help'], check=True,
+                       stdout=subprocess.DEVNULL)
+        module = script[:-len('.py')]
+        imported = subprocess.run(
+            [sys.executable, '-c',
+             'import sys, %s; print(" ".join(sys.modules))' % module],
+            check=True, capture_output=True, text=True).stdout.split()
+        heavy = [m for m in HEAVY_MODULES if m in imported]
+        assert heavy == [], '%s imports %s on startup' % (script, heavy)
+    print('Started commands without heavy imports successfully.')
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--offline', action='store_true')
+    args = parser.parse_args()
+
     try:
-        test()
+        test_startup()
+        test_innertube()
+        test_incremental()
+        test_fake_youtube()
+        test_metrics()
+        test_rate_limit()
+        test_channel_cache()
+        test_export()
+        test_search()
+        test_word_counts()
+        test_comment_metadata()
+        test_screenshots()
+        test_scheduler()
+        test_jobs()
+        test_writer()
+        test_pipeline_progress()
+        if not args.offline:
+            test()
         print('All tests passed.')
     finally:
         con.close()
-        os.remove('test.db')
+        # the database is in WAL mode, which can leave its log files behind
+        for path in ['test.db', 'test.db-wal', 'test.db-shm']:
+            if os.path.exists(path):
+                os.remove(path)
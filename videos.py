@@ -1,27 +1,21 @@
 """Scrape youtube videos for an artist."""
-from selenium.webdriver import Chrome
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
-import pandas as pd
-from database import Artist, Video, get_db
-from common import options, find_all_in_scrollable
+from database import Artist, DirectWriter, Video, get_db, is_stale
+from common import VideoData, find_all_in_scrollable
 import argparse
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import os
 from logger import log
+from metrics import add_metrics_arguments, labels, metrics
+import ratelimit
+import screenshots
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
+# selenium and the innertube scraper, which needs requests, are imported in
+# the functions that use them, so commands start quickly
 
-@dataclass
-class VideoData:
-    """Store video data before it is inserted into the database."""
-
-    url: str
-    title: str
-    views: int
+BACKENDS = ['selenium', 'innertube']
 
 
 def views_to_int(views):
@@ -36,7 +30,8 @@ def views_to_int(views):
     return int(views)
 
 
-def find_all_youtube_videos_with_retries(artist, max_retries, screenshot_path):
+def find_all_youtube_videos_with_retries(artist, max_retries, screenshot=None,
+                                         backend='selenium', known_urls=None):
     """
     Find all youtube videos for an artist, retrying if necessary.
 
@@ -44,89 +39,175 @@ def find_all_youtube_videos_with_retries(artist, max_retries, screenshot_path):
     """
     for n in range(max_retries):
         log.info('Finding videos for %s, attempt %d',
-                 artist[Artist.NAME], n + 1)
+                 artist.name, n + 1)
         try:
-            if screenshot_path is not None:
-                screenshot_path += '/%s.png' % artist[Artist.NAME]
-
-            videos = find_youtube_videos(
-                artist[Artist.YOUTUBE], screenshot_path, options=options)
-            log.debug('Found %d videos for %s',
-                      len(videos), artist[Artist.NAME])
-            urls = [video.url for video in videos]
-
-            music_videos = find_youtube_music_videos(
-                artist[Artist.NAME], options=options)
-            log.debug('Found %d music videos for %s', len(
-                music_videos), artist[Artist.NAME])
-
-            # join two sources of videos
-            for video in music_videos:
-                if video.url not in urls:
-                    videos.append(video)
-            log.info('Found %d total videos for %s',
-                     len(videos), artist[Artist.NAME])
-            return videos
+            return find_all_youtube_videos(artist, screenshot, backend,
+                                           known_urls)
 
         except Exception as e:
             log.debug('Error finding videos for %s: %s',
-                      artist[Artist.NAME], e)
+                      artist.name, e)
+            if n + 1 < max_retries:
+                ratelimit.backoff(n)
 
     raise Exception('Could not find videos for %s after %d retries'
-                    % (artist[Artist.NAME], max_retries))
+                    % (artist.name, max_retries))
+
+
+def find_all_youtube_videos(artist, screenshot, backend, known_urls=None):
+    """
+    Find videos on an artist's channel and in their search results.
+
+    The channel and the search are scraped at the same time, in separate
+    browsers. The innertube backend needs no browser, so a pool is only
+    started if one falls back to selenium. If `known_urls` is given, the
+    channel is only scrolled until its videos are already known.
+    """
+    pool = None
+    if backend != 'innertube' or screenshot is not None:
+        from pool import get_pool
+        pool = get_pool(size=2)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        channel_future = executor.submit(
+            find_channel_videos, artist.youtube_url, screenshot, backend,
+            pool, known_urls)
+        music_future = executor.submit(
+            find_music_videos, artist.name, backend, pool)
+        videos = channel_future.result()
+        log.debug('Found %d videos for %s',
+                  len(videos), artist.name)
+        music_videos = music_future.result()
+        log.debug('Found %d music videos for %s', len(
+            music_videos), artist.name)
+
+    # join two sources of videos
+    urls = set(video.url for video in videos)
+    for video in music_videos:
+        if video.url not in urls:
+            videos.append(video)
+    log.info('Found %d total videos for %s',
+             len(videos), artist.name)
+    return videos
+
+
+def find_channel_videos(url, screenshot, backend, pool=None, known_urls=None):
+    """
+    Find youtube videos for a channel with the given backend.
 
+    The innertube backend falls back to selenium if it fails. Screenshots need
+    a browser, so selenium is always used when a screenshot is requested.
+    """
+    if backend == 'innertube' and screenshot is None:
+        import innertube
+        try:
+            return innertube.find_youtube_videos(url, known_urls=known_urls)
+        except Exception as e:
+            log.debug('Error finding videos for %s with innertube, '
+                      'falling back to selenium: %s', url, e)
+    return find_youtube_videos(url, screenshot, pool, known_urls)
+
+
+def find_music_videos(artist_name, backend, pool=None):
+    """
+    Find music videos for an artist with the given backend.
+
+    The innertube backend falls back to selenium if it fails.
+    """
+    if backend == 'innertube':
+        import innertube
+        try:
+            return innertube.find_youtube_music_videos(artist_name)
+        except Exception as e:
+            log.debug('Error finding music videos for %s with innertube, '
+                      'falling back to selenium: %s', artist_name, e)
+    return find_youtube_music_videos(artist_name, pool)
+
+
+def find_youtube_videos(url, screenshot=None, pool=None, known_urls=None):
+    """
+    Find youtube videos for a channel.
+
+    If `screenshot` is given, it is called with a capture of the channel
+    page, see `screenshots.capture`, and should hand it off to be saved
+    rather than saving it, so scrolling isn't held up.
+
+    Channels list their newest videos first, so if `known_urls` is given,
+    scrolling stops after MAX_KNOWN known videos in a row.
+    """
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.wait import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException
+    from pool import get_pool
 
-def find_youtube_videos(url, screenshot_path=None, options=None):
-    """Find youtube videos for a channel."""
     VIDEOS_URL = '%s/videos'
     CHANNEL_NAME = '#channel-name'
+    COOKIES_REJECT = "//button[@aria-label='Reject all']"
     VIDEO_SELECTOR = '#content.ytd-rich-item-renderer'
-    ANCHOR_SELECTOR = 'a#thumbnail'
-    TITLE_SELECTOR = '#video-title'
-    VIEWS_SELECTOR = '#metadata-line span'
+    # some channels (Maroon 5) have premium videos, which don't list the
+    # view count, these are never ready and so are skipped
+    EXTRACT_VIDEO = '''
+        const anchor = el.querySelector('a#thumbnail');
+        const title = el.querySelector('#video-title');
+        const views = el.querySelector('#metadata-line span');
+        if (!anchor || !anchor.href || !title || !views
+                || !views.innerText.trim()) {
+            return null;
+        }
+        return {url: anchor.href, title: title.innerText,
+                views: views.innerText};
+    '''
     MAX_VIDEOS = 800
     MAX_WAIT_TIME = 10
+    # the consent dialog is only shown in some regions
+    COOKIES_WAIT_TIME = 2
+
+    is_known = (None if known_urls is None
+                else lambda record: record['url'] in known_urls)
 
     videos = []
-    with Chrome(options=options) as driver:
+    pool = pool or get_pool()
+    with pool.driver() as driver:
         wait = WebDriverWait(driver, MAX_WAIT_TIME)
-        driver.get(VIDEOS_URL % url)
-
-        cookies_reject = wait.until(EC.presence_of_element_located(
-            (By.XPATH, "//button[@aria-label='Reject all']")))
-        cookies_reject.click()
-
-        wait.until(EC.presence_of_element_located(
-            (By.CSS_SELECTOR, CHANNEL_NAME)))
-
-        if screenshot_path is not None:
-            driver.save_screenshot(screenshot_path)
-            log.debug('Saved screenshot to %s', screenshot_path)
-
-        video_elements = find_all_in_scrollable(
-            driver, VIDEO_SELECTOR, MAX_WAIT_TIME, max_elements=MAX_VIDEOS)
-        for video_el in video_elements:
-            anchor_tag = video_el.find_element(
-                By.CSS_SELECTOR, ANCHOR_SELECTOR)
-            url = anchor_tag.get_attribute('href')
-            title = video_el.find_element(By.CSS_SELECTOR, TITLE_SELECTOR).text
+        # the consent dialog isn't part of the page load, so a slow or
+        # missing one doesn't count as a failure against the rate limit
+        with ratelimit.limit('channel'):
+            with metrics.timer('page_load'):
+                driver.get(VIDEOS_URL % url)
+            wait.until(EC.presence_of_element_located(
+                (By.CSS_SELECTOR, CHANNEL_NAME)))
 
-            try:
-                views = video_el.find_element(
-                    By.CSS_SELECTOR, VIEWS_SELECTOR).text
-            except NoSuchElementException:
-                # some channels (Maroon 5) have premium video,
-                # which don't list the view count
-                continue
-
-            video = VideoData(url, title, views_to_int(views))
+        try:
+            cookies_reject = WebDriverWait(driver, COOKIES_WAIT_TIME).until(
+                EC.element_to_be_clickable((By.XPATH, COOKIES_REJECT)))
+            cookies_reject.click()
+        except TimeoutException:
+            log.debug('No cookie consent dialog for %s', url)
+
+        if screenshot is not None:
+            with metrics.timer('screenshot_capture'):
+                screenshot(screenshots.capture(driver))
+
+        records = find_all_in_scrollable(
+            driver, VIDEO_SELECTOR, MAX_WAIT_TIME, max_elements=MAX_VIDEOS,
+            extract=EXTRACT_VIDEO, is_known=is_known)
+        for record in records:
+            video = VideoData(record['url'], record['title'],
+                              views_to_int(record['views']))
             videos.append(video)
 
     return videos
 
 
-def find_youtube_music_videos(artist_name, options=None):
+def find_youtube_music_videos(artist_name, pool=None):
     """Find videos linked in the artist sidebar when searching for the artist."""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.wait import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException
+    from pool import get_pool
+
     SEARCH_URL = 'https://www.youtube.com/results?search_query=%s'
     VIDEO_SELECTOR = '''.ytd-two-column-search-results-renderer
     ytd-watch-card-compact-video-renderer.ytd-vertical-watch-card-list-renderer'''
@@ -136,9 +217,12 @@ def find_youtube_music_videos(artist_name, options=None):
     MAX_WAIT_TIME = 10
 
     videos = []
-    with Chrome(options=options) as driver:
+    pool = pool or get_pool()
+    with pool.driver() as driver:
         wait = WebDriverWait(driver, MAX_WAIT_TIME)
-        driver.get(SEARCH_URL % artist_name)
+        # no music videos isn't a failure, so only the page load is limited
+        with ratelimit.limit('search'), metrics.timer('page_load'):
+            driver.get(SEARCH_URL % artist_name)
 
         try:
             video_elements = wait.until(EC.presence_of_all_elements_located(
@@ -167,48 +251,61 @@ def find_youtube_music_videos(artist_name, options=None):
     return videos
 
 
-def get_dataframe(artist_id, videos):
-    """Convert a list of VideoData objects to a dataframe."""
-    rows = [
-        {
-            Video.ARTIST_ID: artist_id,
-            Video.TITLE: video.title,
-            Video.YOUTUBE: video.url,
-            Video.VIEWS: video.views
-        }
-        for video in videos
-    ]
-
-    return pd.DataFrame(rows, columns=[
-        Video.ARTIST_ID, Video.YOUTUBE, Video.TITLE, Video.VIEWS
-    ])
+def get_rows(artist_id, videos):
+    """Convert a list of VideoData objects to rows for the video table."""
+    for video in videos:
+        yield (artist_id, video.title, video.url, video.views)
 
 
-def main(db_path, artist_id, max_retries, screenshot_path):
-    """Find all youtube videos for an artist and save them to the database."""
-    con, cur = get_db(db_path)
-
+def save_videos(cur, writer, artist_id, max_retries, backend='selenium',
+                force=False, incremental=False):
+    """
+    Find all youtube videos for an artist and save them to the database.
+
+    The channel is captured for a screenshot if the process is configured to
+    save screenshots, see `screenshots.configure`.
+    Artists updated recently are skipped, unless `force` is set.
+    If `incremental` is set, only videos newer than those already in the
+    database are scraped from the channel.
+    Returns False if the artist or their videos couldn't be found.
+    """
     artist = Artist.get_by_id(cur, artist_id)
     if artist is None:
         log.error('ID: %s not found in database', artist_id)
-        return
-
+        return False
+    if not force and not is_stale(artist.updated_at):
+        log.info('Videos for %s were updated recently, skipping', artist.name)
+        return True
+
+    known_urls = (Video.get_urls_by_artist(cur, artist_id) if incremental
+                  else None)
+    screenshot = (partial(screenshots.submit, artist)
+                  if screenshots.wants(cur, artist) else None)
     try:
         videos = find_all_youtube_videos_with_retries(
-            artist, max_retries, screenshot_path)
+            artist, max_retries, screenshot, backend, known_urls)
     except Exception as e:
         log.exception('Error finding videos for %s: %s',
-                      artist[Artist.NAME], e)
+                      artist.name, e)
+        return False
 
-    df = get_dataframe(artist_id, videos)
-    videos_in_db = Video.get_by_artist(cur, artist_id)
-    new_videos_df = df[~df[Video.YOUTUBE].isin(videos_in_db[Video.YOUTUBE])]
+    metrics.count('videos_found', len(videos))
+    # videos already in the database have their views updated, and every
+    # video's views are added to its history
+    writer.submit('Video.save_many', get_rows(artist_id, videos))
+    writer.submit('Artist.set_updated', artist_id)
+    writer.flush()
+    log.info('Saved %d videos for %s', len(videos), artist.name)
+    return True
 
-    Video.save_many(cur, new_videos_df)
-    Artist.set_updated(cur, artist_id)
-    con.commit()
-    log.info('Saved %d new videos for %s',
-             new_videos_df.shape[0], artist[Artist.NAME])
+
+def main(db_path, artist_id, max_retries, backend, force, incremental):
+    """Find all youtube videos for an artist and save them to the database."""
+    con, cur = get_db(db_path)
+    ratelimit.configure(db_path)
+    with labels(stage='videos', item=artist_id):
+        save_videos(cur, DirectWriter(con), artist_id, max_retries, backend,
+                    force, incremental)
 
 
 if __name__ == '__main__':
@@ -216,8 +313,22 @@ if __name__ == '__main__':
     parser.add_argument('--db-path', type=str)
     parser.add_argument('--artist-id', type=str)
     parser.add_argument('--max-retries', type=int, default=3)
-    parser.add_argument('--screenshot-path', type=str, default=None)
+    parser.add_argument('--backend', choices=BACKENDS, default='selenium')
+    parser.add_argument('--force', action=argparse.BooleanOptionalAction,
+                        help='scrape even if the artist was updated recently')
+    parser.add_argument('--incremental',
+                        action=argparse.BooleanOptionalAction,
+                        help='stop scrolling the channel at known videos')
+    screenshots.add_screenshot_arguments(parser)
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
 
-    main(args.db_path, args.artist_id, args.max_retries, args.screenshot_path)
+    metrics.start(args.trace_path)
+    screenshots.configure(args.db_path, args.screenshot_path,
+                          args.screenshot_format, args.screenshot_width,
+                          args.screenshot_sample)
+    main(args.db_path, args.artist_id, args.max_retries, args.backend,
+         args.force, args.incremental)
+    screenshots.close()
+    metrics.finish(args.metrics_path)
@@ -0,0 +1,31 @@
+"""Report the words used most in an artist's comments, from the word counts."""
+import argparse
+from database import WordCount, get_db
+
+
+def main(db_path, artist_id, language, top, tfidf):
+    """Print an artist's top words with their counts or tf-idf scores."""
+    con, cur = get_db(db_path)
+    if tfidf:
+        for word, score in WordCount.get_top_tfidf(cur, artist_id, language,
+                                                   top):
+            print('%s\t%.6f' % (word, score))
+    else:
+        for word, count in WordCount.get_top(cur, artist_id, language, top):
+            print('%s\t%d' % (word, count))
+    con.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-path', type=str)
+    parser.add_argument('--artist-id', type=int)
+    parser.add_argument('--language', type=str, default='en')
+    parser.add_argument('--top', type=int, default=50)
+    parser.add_argument('--tfidf', action=argparse.BooleanOptionalAction,
+                        help='rank words by how distinctive they are of the '
+                        'artist, rather than by count')
+
+    args = parser.parse_args()
+
+    main(args.db_path, args.artist_id, args.language, args.top, args.tfidf)